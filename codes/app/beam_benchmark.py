@@ -0,0 +1,80 @@
+# Throughput of the batched beam search of Generator at several beam sizes (seq2seq models)
+# Run from `codes/app` : python beam_benchmark.py --config_id <seq2seq config id> --beam_sizes 1,3,5
+import argparse
+import logging
+import time
+
+import torch
+from addict import Dict
+
+from codes.experiment.experiment import load_data_util
+from codes.net.generator import Generator
+from codes.net.net_registry import choose_model
+from codes.net.trainer import Trainer, inference_mode
+from codes.utils.config import get_config
+from codes.utils.util import set_seed
+
+
+def time_beam(config, data_util, model, batches, beam_size):
+    """
+    Decode all the batches with the given beam size
+    :return: sentences per second, mean length of the top hypotheses
+    """
+    config.model.beam.beam_size = beam_size
+    generator = Generator(data_util, model, config)
+    num_sentences = 0
+    total_length = 0
+    elapsed = 0.0
+    with inference_mode():
+        for batch in batches:
+            batch = batch.clone()
+            batch.config = config
+            batch.to_device('cpu')
+            start = time.perf_counter()
+            results = generator.beam_process_batch(batch, max_length=config.model.beam.max_length,
+                                                   n_best=config.model.beam.n_best)
+            elapsed += time.perf_counter() - start
+            num_sentences += batch.batch_size
+            total_length += results.predictions[:, 0].ne(0).sum().item()
+    return num_sentences / elapsed, total_length / num_sentences
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Beam search throughput on CPU")
+    parser.add_argument('--config_id', default='sample', help='config id of a seq2seq model')
+    parser.add_argument('--checkpoint', default='', help='experiment checkpoint to load')
+    parser.add_argument('--beam_sizes', default='1,3,5', help='comma separated beam sizes')
+    parser.add_argument('--num_batches', type=int, default=20, help='number of test batches to decode')
+    parser.add_argument('--num_threads', type=int, default=0, help='torch intra-op threads, 0 keeps the default')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+
+    config = get_config(config_id=args.config_id)
+    config.log.logger = logging.getLogger()
+    config.general.device = 'cpu'
+    config.model.loss_type = 'seq2seq'
+    data_util, _ = load_data_util(config)
+    set_seed(seed=config.general.seed)
+    model = Dict()
+    model.encoder, model.decoder = choose_model(config)
+    if args.checkpoint:
+        state = torch.load(args.checkpoint, map_location=lambda storage, loc: storage)
+        model.encoder.load_state_dict(state['model.encoder'])
+        model.decoder.load_state_dict(state['model.decoder'])
+    trainer = Trainer(config.model, model.encoder, model.decoder, max_entity_id=data_util.max_entity_id)
+    trainer.eval()
+    # entity embeddings are written outside inference mode
+    trainer.update_entity_embeddings()
+
+    test_file = sorted(config.dataset.test_files)[0]
+    dataloader = data_util.get_dataloader(mode='test', test_file=test_file)
+    batches = [dataloader.dataset.batches[i] for i in range(min(args.num_batches, len(dataloader)))]
+
+    print("{:<10} {:>14} {:>12} {:>10}".format('Beam', 'Sentences/s', 'Mean length', 'Slowdown'))
+    base = None
+    for beam_size in [int(b) for b in args.beam_sizes.split(',')]:
+        tput, mean_length = time_beam(config, data_util, model, batches, beam_size)
+        base = tput if base is None else base
+        print("{:<10} {:>14.1f} {:>12.2f} {:>10.2f}".format(beam_size, tput, mean_length, base / tput))
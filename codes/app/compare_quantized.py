@@ -0,0 +1,83 @@
+# Compare the float and dynamic int8 quantized BERT encoders on the test data
+# Run from `codes/app` : python compare_quantized.py --config_id bert --checkpoint <path to checkpoint>
+import argparse
+import logging
+import os
+import time
+
+import numpy as np
+import torch
+
+from codes.experiment.experiment import load_data_util
+from codes.net.net_registry import choose_model
+from codes.net.trainer import Trainer
+from codes.utils.config import get_config
+from codes.utils.util import set_seed
+
+
+def evaluate(config, data_util, test_files, checkpoint=None, quantize=False):
+    """
+    Accuracy and throughput of the model on each test file
+    :return: dict test file -> (accuracy, stories per second)
+    """
+    set_seed(seed=config.general.seed)
+    config.model.bert.quantize = quantize
+    encoder, decoder = choose_model(config)
+    trainer = Trainer(config.model, encoder, decoder, max_entity_id=data_util.max_entity_id)
+    if checkpoint:
+        state = torch.load(checkpoint, map_location=lambda storage, loc: storage)
+        encoder.load_state_dict(state['model.encoder'])
+        decoder.load_state_dict(state['model.decoder'])
+    trainer.eval()
+    results = {}
+    for test_file in test_files:
+        dataloader = data_util.get_dataloader(mode='test', test_file=test_file)
+        # same entity embeddings for the float and the quantized run
+        set_seed(seed=config.general.seed)
+        correct = 0
+        num_examples = 0
+        elapsed = 0.0
+        with torch.no_grad():
+            for batch in dataloader:
+                batch.config = config
+                batch.to_device('cpu')
+                start = time.perf_counter()
+                outputs, _, _ = trainer.batchLoss(batch)
+                elapsed += time.perf_counter() - start
+                correct += (outputs == batch.target.squeeze(1)).sum().item()
+                num_examples += batch.batch_size
+        results[test_file] = (correct / num_examples, num_examples / elapsed)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Accuracy / throughput of the quantized BERT encoders")
+    parser.add_argument('--config_id', default='bert', help='config id to use')
+    parser.add_argument('--checkpoint', default='', help='experiment checkpoint to load')
+    parser.add_argument('--test_file', default='', help='test csv, defaults to all the test files of the dataset')
+    parser.add_argument('--num_threads', type=int, default=0, help='torch intra-op threads, 0 keeps the default')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+
+    config = get_config(config_id=args.config_id)
+    config.log.logger = logging.getLogger()
+    config.general.device = 'cpu'
+    data_util, _ = load_data_util(config)
+    test_files = [os.path.abspath(args.test_file)] if args.test_file else sorted(config.dataset.test_files)
+    if args.test_file:
+        data_util.process_test_data(os.path.dirname(test_files[0]), test_files)
+
+    float_results = evaluate(config, data_util, test_files, args.checkpoint, quantize=False)
+    int8_results = evaluate(config, data_util, test_files, args.checkpoint, quantize=True)
+
+    print("{:<40} {:>10} {:>10} {:>10} {:>12} {:>12} {:>8}".format(
+        'File', 'Acc fp32', 'Acc int8', 'Delta', 'Stories/s fp32', 'Stories/s int8', 'Speedup'))
+    for test_file in test_files:
+        f_acc, f_tput = float_results[test_file]
+        q_acc, q_tput = int8_results[test_file]
+        print("{:<40} {:>10.4f} {:>10.4f} {:>10.4f} {:>12.1f} {:>12.1f} {:>8.2f}".format(
+            test_file.split('/')[-1], f_acc, q_acc, q_acc - f_acc, f_tput, q_tput, q_tput / f_tput))
+    print("Mean accuracy delta : {:.4f}".format(
+        np.mean([int8_results[f][0] - float_results[f][0] for f in test_files])))
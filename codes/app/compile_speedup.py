@@ -0,0 +1,71 @@
+# Per-model speedup of the compiled encoder-decoder forward (model.compile) over eager mode
+# Run from `codes/app` : python compile_speedup.py --config_ids bilstm_mean,rn,mac,gat
+import argparse
+import logging
+import time
+
+import numpy as np
+import torch
+
+from codes.experiment.experiment import load_data_util
+from codes.net.net_registry import choose_model
+from codes.net.trainer import Trainer
+from codes.utils.config import get_config
+from codes.utils.util import set_seed
+
+
+def time_batches(config, data_util, batches, compiled=False, num_warmup=3):
+    """
+    Mean time of a training step (forward, backward, optimizer step) in ms
+    :return: mean time, True if the model actually ran compiled
+    """
+    set_seed(seed=config.general.seed)
+    config.model.compile = compiled
+    encoder, decoder = choose_model(config)
+    trainer = Trainer(config.model, encoder, decoder, max_entity_id=data_util.max_entity_id)
+    optimizers, _ = trainer.get_optimizers()
+    trainer.train()
+    times = []
+    for idx, batch in enumerate(batches):
+        batch = batch.clone()
+        batch.config = config
+        batch.to_device('cpu')
+        start = time.perf_counter()
+        for optimizer in optimizers:
+            optimizer.zero_grad()
+        _, loss, _ = trainer.batchLoss(batch)
+        trainer.backward(loss, optimizers)
+        elapsed = time.perf_counter() - start
+        # the first steps include the graph capture
+        if idx >= num_warmup:
+            times.append(elapsed * 1000)
+    return np.mean(times), trainer.compiled_forward is not None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Speedup of the compiled models on CPU")
+    parser.add_argument('--config_ids', default='bilstm_mean,rn,mac,gat', help='comma separated config ids')
+    parser.add_argument('--num_batches', type=int, default=20, help='number of training batches to time')
+    parser.add_argument('--num_threads', type=int, default=0, help='torch intra-op threads, 0 keeps the default')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+
+    rows = []
+    for config_id in args.config_ids.split(','):
+        config = get_config(config_id=config_id)
+        config.log.logger = logging.getLogger()
+        config.general.device = 'cpu'
+        data_util, _ = load_data_util(config)
+        dataloader = data_util.get_dataloader(mode='train')
+        batches = [dataloader.dataset.batches[i] for i in range(min(args.num_batches, len(dataloader)))]
+        eager_ms, _ = time_batches(config, data_util, batches, compiled=False)
+        compiled_ms, captured = time_batches(config, data_util, batches, compiled=True)
+        rows.append((config_id, config.model.encoder.name.split('.')[-1], eager_ms, compiled_ms, captured))
+
+    print("{:<20} {:<30} {:>12} {:>14} {:>8} {:>9}".format(
+        'Config', 'Encoder', 'Eager (ms)', 'Compiled (ms)', 'Speedup', 'Captured'))
+    for config_id, encoder_name, eager_ms, compiled_ms, captured in rows:
+        print("{:<20} {:<30} {:>12.2f} {:>14.2f} {:>8.2f} {:>9}".format(
+            config_id, encoder_name, eager_ms, compiled_ms, eager_ms / compiled_ms, str(captured)))
@@ -0,0 +1,130 @@
+# Export a trained encoder / decoder pair with its fixed entity embeddings and vocabulary to a TorchScript file,
+# which exported.py runs without the training stack
+# Run from `codes/app` : python export.py --config_id <config id> --checkpoint <path> --output <model.pt>
+# The model is traced on one story padded to a fixed length (--max_length, defaults to the longest story
+# of the dataset, the longer stories are truncated), with the length of the story before padding as an
+# input, so the encoders skip the padding as in the checkpoint : the agreement with the checkpoint on the
+# first test stories is reported. Only the models reading the word level inputs (inp, query, query_mask,
+# inp_ent_mask) can be exported.
+import argparse
+import json
+import logging
+import time
+
+import pandas as pd
+import torch
+
+from codes.app.exported import ExportedModel, META_FILE, SUPPORTED_FIELDS, encode
+from codes.app.server import InferenceModel
+from codes.net.batch import LengthPermutation
+from codes.net.compiled import TENSOR_FIELDS, TensorForward, batch_tensors
+from codes.utils.config import get_config
+from codes.utils.data import UNK_WORD
+
+
+class LengthForward(TensorForward):
+    """
+    TensorForward taking the story lengths as its last input, so that they are not constants of the trace
+    """
+    def forward(self, inp, s_inp, query, query_mask, inp_ent_mask, query_edge,
+                bert_inp, bert_input_mask, bert_segment_ids, inp_lengths):
+        self.context.inp_lengths = inp_lengths
+        self.context.inp_perm = LengthPermutation(inp_lengths)
+        return super().forward(inp, s_inp, query, query_mask, inp_ent_mask, query_edge,
+                               bert_inp, bert_input_mask, bert_segment_ids)
+
+
+def export(model, path, max_length, example):
+    """
+    Trace the model on the example story and save it with its metadata
+    :param model: InferenceModel
+    :param path: output file
+    :param max_length: story length of the exported model
+    :param example: dict with `story` and `query` (string tuple) as in the data files
+    :return: metadata
+    """
+    data_util = model.data_util
+    meta = {
+        'word2id': data_util.word2id,
+        'classes': [data_util.target_id2word[i] for i in range(len(data_util.target_id2word))],
+        'num_entities': len(data_util.entity_ids),
+        'max_length': max_length,
+        'unk_word': UNK_WORD,
+    }
+    # the entity embeddings of the checkpoint are frozen in the exported model, they are not drawn again
+    batch = data_util.precompute_batches(data_util.process_stories([example]), batch_size=1)[0]
+    batch.config = model.config
+    # every story is padded to max_length, and its length is an input
+    query = [ent.strip() for ent in example['query'].strip('()').replace("'", '').split(',')]
+    inputs = encode(example['story'], query, meta)
+    for field, value in inputs.items():
+        setattr(batch, field, value)
+    batch.to_device('cpu')
+    length_forward = LengthForward(model.trainer.encoder_model, model.trainer.decoder_model)
+    length_forward.context = batch
+    try:
+        with torch.no_grad():
+            traced = torch.jit.trace(length_forward, batch_tensors(batch) + (inputs['inp_lengths'],),
+                                     check_trace=False)
+    finally:
+        length_forward.context = None
+    inputs = list(traced.graph.inputs())[1:]
+    meta['used_fields'] = [field for field, value in zip(TENSOR_FIELDS + ['inp_lengths'], inputs)
+                           if len(value.uses()) > 0]
+    unsupported = [field for field in meta['used_fields'] if field not in SUPPORTED_FIELDS]
+    if len(unsupported) > 0:
+        raise NotImplementedError("{} reads {}, which the exported runtime cannot build".format(
+            type(model.trainer.encoder_model).__name__, ', '.join(unsupported)))
+    torch.jit.save(traced, path, _extra_files={META_FILE: json.dumps(meta)})
+    return meta
+
+
+def agreement(model, path, rows):
+    """
+    Share of the stories on which the exported model and the checkpoint predict the same relation
+    :param rows: list of dicts with `story` and `query`
+    :return: agreement, mean latency of the exported model (ms)
+    """
+    exported = ExportedModel(path)
+    data_util = model.data_util
+    same = 0
+    elapsed = 0.0
+    for row in rows:
+        batch = data_util.precompute_batches(data_util.process_stories([row]), batch_size=1)[0]
+        batch.config = model.config
+        batch.to_device(model.device)
+        # entity embeddings of the checkpoint, as the export, so not through Trainer.predict
+        with torch.no_grad():
+            logits = model.trainer.tensor_forward.run(batch)
+        expected = model.data_util.target_id2word[int(logits.float().view(1, -1).argmax(-1))]
+        query = [ent.strip() for ent in row['query'].strip('()').replace("'", '').split(',')]
+        start = time.perf_counter()
+        relation, _ = exported.predict(row['story'], query)
+        elapsed += time.perf_counter() - start
+        same += int(relation == expected)
+    return same / max(len(rows), 1), elapsed * 1000 / max(len(rows), 1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export a trained model to TorchScript")
+    parser.add_argument('--config_id', default='sample', help='config id of the trained model')
+    parser.add_argument('--checkpoint', default='', help='checkpoint saved by the experiment')
+    parser.add_argument('--output', required=True, help='exported file')
+    parser.add_argument('--max_length', type=int, default=0, help='story length, 0 for the longest story of the data')
+    parser.add_argument('--num_check', type=int, default=200, help='number of test stories to check the export on')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    config = get_config(config_id=args.config_id)
+    config.log.logger = logging.getLogger()
+    config.general.device = 'cpu'
+    model = InferenceModel(config, args.checkpoint)
+    max_length = args.max_length if args.max_length > 0 else model.data_util.max_word_length
+    test_rows = pd.read_csv(sorted(config.dataset.test_files)[0], comment='#').head(args.num_check)
+    test_rows = [{'id': row['id'], 'story': row['story'], 'query': row['query']} for _, row in test_rows.iterrows()]
+    meta = export(model, args.output, max_length, test_rows[0])
+    print("Exported {} to {} : story length {}, inputs {}".format(
+        type(model.trainer.encoder_model).__name__, args.output, max_length, ', '.join(meta['used_fields'])))
+    acc, latency = agreement(model, args.output, test_rows)
+    print("Agreement with the checkpoint on {} test stories : {:.4f} ; Mean latency (ms) : {:.2f}".format(
+        len(test_rows), acc, latency))
@@ -0,0 +1,121 @@
+# Minimal runtime of the models exported by export.py : needs torch only, not the training stack
+# Run from `codes/app` : python exported.py --artifact <model.pt> --story "[Ann] is the mother of [Bob]. ..." --query Ann,Bob
+# Reports the import and load time, and the latency of the first and the next predictions.
+import time
+_start = time.perf_counter()
+import argparse
+import json
+import re
+
+import torch
+
+IMPORT_TIME = time.perf_counter() - _start
+
+META_FILE = 'meta.json'
+# tensor inputs of the exported forward, as TENSOR_FIELDS in codes/net/compiled.py followed by the story length
+INPUT_FIELDS = ['inp', 's_inp', 'query', 'query_mask', 'inp_ent_mask', 'query_edge',
+                'bert_inp', 'bert_input_mask', 'bert_segment_ids', 'inp_lengths']
+# the inputs this runtime can build from a raw story
+SUPPORTED_FIELDS = ['inp', 'query', 'query_mask', 'inp_ent_mask', 'inp_lengths']
+
+
+def tokenize(text):
+    """
+    Word tokenization of the data files (nltk), or a regex approximation when nltk is missing
+    """
+    try:
+        from nltk.tokenize import word_tokenize
+        words = word_tokenize(text)
+    except (ImportError, LookupError):
+        return re.findall(r"@?\w+|[^\w\s]", text)
+    # correct for tokenizing @entity, as DataUtility.tokenize
+    corr_w = []
+    tmp_w = ''
+    for w in words:
+        if w == '@':
+            tmp_w = w
+        else:
+            corr_w.append(tmp_w + w)
+            tmp_w = ''
+    return corr_w
+
+
+def encode(story, query, meta):
+    """
+    Anonymize the entities of the story and build the input tensors of the exported model
+    :param story: story with the entities in brackets, eg "[Ann] is the mother of [Bob]."
+    :param query: pair of entities, eg ('Ann', 'Bob')
+    :param meta: metadata of the artifact
+    :return: dict of field -> tensor with a batch of one story, padded to the exported length, and its
+        length before padding
+    """
+    word2id = meta['word2id']
+    max_length = meta['max_length']
+    entity_map = {}
+    for ent in re.findall(r'\[(.*?)\]', story):
+        if ent not in entity_map:
+            entity_map[ent] = '@ent{}'.format(len(entity_map))
+        story = story.replace('[{}]'.format(ent), entity_map[ent])
+    unk = word2id[meta['unk_word']]
+    inp_row = [word2id.get(word, unk) for word in tokenize(story)][:max_length]
+    query_ids = [word2id[entity_map[ent]] for ent in query]
+    inp = torch.zeros(1, max_length).long()
+    inp[0, :len(inp_row)] = torch.LongTensor(inp_row)
+    query_mask = torch.zeros(1, max_length, len(query_ids)).long()
+    for ent_n, ent_id in enumerate(query_ids):
+        query_mask[0, :, ent_n] = inp[0].eq(ent_id).long()
+    inp_ent_mask = torch.zeros(1, meta['num_entities']).long()
+    for word_id in set(inp_row):
+        if 0 < word_id <= meta['num_entities']:
+            inp_ent_mask[0, word_id - 1] = 1
+    return {'inp': inp, 'query': torch.LongTensor([query_ids]), 'query_mask': query_mask,
+            'inp_ent_mask': inp_ent_mask, 'inp_lengths': torch.LongTensor([max(len(inp_row), 1)])}
+
+
+class ExportedModel:
+    """
+    TorchScript model with its vocabulary, as saved by export.py
+    """
+    def __init__(self, path):
+        extra_files = {META_FILE: ''}
+        self.module = torch.jit.load(path, map_location='cpu', _extra_files=extra_files)
+        self.module.eval()
+        self.meta = json.loads(extra_files[META_FILE])
+        self.classes = self.meta['classes']
+
+    def predict(self, story, query):
+        """
+        :return: relation, confidence
+        """
+        inputs = encode(story, query, self.meta)
+        # the inputs the exported model does not read
+        unused = torch.zeros(1).long()
+        with torch.no_grad():
+            logits = self.module(*[inputs.get(field, unused) for field in INPUT_FIELDS])
+        confidence, prediction = torch.softmax(logits.float().view(1, -1), dim=-1).max(-1)
+        return self.classes[int(prediction)], float(confidence)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run an exported model")
+    parser.add_argument('--artifact', required=True, help='file saved by export.py')
+    parser.add_argument('--story', required=True, help='story with the entities in brackets')
+    parser.add_argument('--query', required=True, help='comma separated query entities')
+    parser.add_argument('--repeat', type=int, default=20, help='number of timed predictions after the first one')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    model = ExportedModel(args.artifact)
+    load_time = time.perf_counter() - start
+    query = tuple(args.query.split(','))
+    start = time.perf_counter()
+    relation, confidence = model.predict(args.story, query)
+    first_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        model.predict(args.story, query)
+    next_time = (time.perf_counter() - start) / max(args.repeat, 1)
+
+    print("Prediction : {} ({:.4f})".format(relation, confidence))
+    print("Import (ms) : {:.1f} ; Load (ms) : {:.1f} ; First prediction (ms) : {:.1f} ; Next predictions (ms) : {:.2f}".format(
+        IMPORT_TIME * 1000, load_time * 1000, first_time * 1000, next_time * 1000))
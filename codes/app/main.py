@@ -1,4 +1,3 @@
-from comet_ml import Experiment, ExistingExperiment
 from codes.experiment.experiment import run_experiment
 from codes.utils.config import get_config
 from codes.utils.util import set_seed, flatten_dictionary
@@ -82,6 +81,8 @@ if __name__ == '__main__':
         )
         logger = logging.getLogger()
         logger.info("Running new experiment")
+        # comet_ml is slow to import, only import it once the run starts
+        from comet_ml import Experiment
         ex = Experiment(api_key=config.log.comet.api_key,
                         workspace=config.log.comet.workspace,
                         project_name=config.log.comet.project_name,
@@ -97,6 +98,7 @@ if __name__ == '__main__':
         logging.info("Resuming old experiment with id {}".format(exp_id))
         config = get_config(config_id=config_id)
         logger = logging.getLogger()
+        from comet_ml import ExistingExperiment
         ex = ExistingExperiment(
             api_key=config.log.comet.api_key,
             previous_experiment=exp_id,
@@ -0,0 +1,131 @@
+# Bulk scoring of a csv file with a trained model, streaming the predictions to csv or parquet shards
+# Run from `codes/app` : python score.py --config_id <config id> --checkpoint <path> --input <csv> --output_dir <dir>
+# Sharding : --num_workers 4 scores the file with 4 local processes, while --num_shards 8 --shard_index 3
+# scores a single shard, eg one per SLURM array task. Shard i scores the rows with index % num_shards == i
+# and writes <output_dir>/<input name>.part-<i>-of-<num_shards>.<format>, with the position of each row in the
+# input file (row) and its id
+import argparse
+import logging
+import multiprocessing
+import os
+import time
+
+import pandas as pd
+import torch
+
+from codes.app.server import InferenceModel
+from codes.utils.config import get_config
+
+
+class ShardWriter:
+    """
+    Appends the predictions of each chunk to the shard file, so that memory stays bounded by the chunk size
+    """
+    def __init__(self, path, fmt='csv'):
+        self.path = path
+        self.fmt = fmt
+        self.writer = None
+        self.num_rows = 0
+        if os.path.exists(path):
+            os.remove(path)
+
+    def write(self, df):
+        if self.fmt == 'parquet':
+            # optional dependency, only needed for parquet shards
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if self.writer is None:
+                self.writer = pq.ParquetWriter(self.path, table.schema)
+            self.writer.write_table(table)
+        else:
+            df.to_csv(self.path, mode='a', header=self.num_rows == 0, index=False)
+        self.num_rows += len(df)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+def score_shard(args, shard_index):
+    """
+    Score the rows of one shard of the input file
+    :return: number of scored rows
+    """
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    config = get_config(config_id=args.config_id)
+    config.log.logger = logging.getLogger()
+    config.general.device = args.device
+    model = InferenceModel(config, args.checkpoint)
+    data_util = model.data_util
+    classes = [data_util.target_id2word[i] for i in range(len(data_util.target_id2word))]
+    batch_size = args.batch_size if args.batch_size > 0 else config.model.batch_size
+
+    base_name = os.path.splitext(os.path.basename(args.input))[0]
+    path = os.path.join(args.output_dir, '{}.part-{}-of-{}.{}'.format(
+        base_name, shard_index, args.num_shards, args.format))
+    writer = ShardWriter(path, fmt=args.format)
+    start = time.perf_counter()
+    offset = 0
+    for chunk in pd.read_csv(args.input, comment='#', chunksize=args.chunk_size):
+        positions = range(offset, offset + len(chunk))
+        offset += len(chunk)
+        # the rows are keyed by their position in the file, as the ids of the file may repeat
+        chunk.index = positions
+        chunk = chunk[[p % args.num_shards == shard_index for p in positions]]
+        if len(chunk) == 0:
+            continue
+        has_target = 'target' in chunk.columns
+        records = [dict(record, id=position) for position, record in zip(chunk.index, chunk.to_dict('records'))]
+        dataRows = data_util.process_stories(records)
+        rows = []
+        for batch in data_util.precompute_batches(dataRows, batch_size=batch_size):
+            probs = model.predict_proba(batch).cpu()
+            confidences, predictions = probs.max(-1)
+            for b, position in enumerate(batch.row_ids):
+                row = {'row': position, 'id': chunk.at[position, 'id'], 'pred_outp': classes[int(predictions[b])],
+                       'conf': float(confidences[b])}
+                if has_target:
+                    row['true_outp'] = chunk.at[position, 'target']
+                row.update({'conf_{}'.format(c): float(p) for c, p in zip(classes, probs[b].tolist())})
+                rows.append(row)
+        df = pd.DataFrame(rows).sort_values('row')
+        writer.write(df)
+        logging.info("Shard {} : scored {} rows".format(shard_index, writer.num_rows))
+    writer.close()
+    elapsed = time.perf_counter() - start
+    logging.info("Shard {} : {} rows in {:.1f}s ({:.1f} rows/s) -> {}".format(
+        shard_index, writer.num_rows, elapsed, writer.num_rows / max(elapsed, 1e-9), path))
+    return writer.num_rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Score a csv file with a trained model")
+    parser.add_argument('--config_id', default='sample', help='config id of the trained model')
+    parser.add_argument('--checkpoint', default='', help='checkpoint saved by the experiment')
+    parser.add_argument('--input', required=True, help='csv file with the data file columns (id, story, query, ...)')
+    parser.add_argument('--output_dir', default=os.path.join(os.pardir, os.pardir, 'logs'), help='folder of the shards')
+    parser.add_argument('--format', default='csv', choices=['csv', 'parquet'], help='format of the shards')
+    parser.add_argument('--chunk_size', type=int, default=10000, help='number of input rows read at once')
+    parser.add_argument('--batch_size', type=int, default=0, help='inference batch size, 0 for model.batch_size')
+    parser.add_argument('--num_shards', type=int, default=1, help='total number of shards')
+    parser.add_argument('--shard_index', type=int, default=-1, help='score only this shard, -1 for all of them')
+    parser.add_argument('--num_workers', type=int, default=1, help='local processes scoring the shards')
+    parser.add_argument('--device', default='cpu', help='device of the model')
+    parser.add_argument('--num_threads', type=int, default=0, help='torch intra-op threads per process, 0 keeps the default')
+    args = parser.parse_args()
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    if args.shard_index >= 0:
+        score_shard(args, args.shard_index)
+    else:
+        if args.num_workers > args.num_shards:
+            args.num_shards = args.num_workers
+        if args.num_workers > 1:
+            with multiprocessing.get_context('spawn').Pool(args.num_workers) as pool:
+                counts = pool.starmap(score_shard, [(args, i) for i in range(args.num_shards)])
+        else:
+            counts = [score_shard(args, i) for i in range(args.num_shards)]
+        print("Scored {} rows in {} shards".format(sum(counts), args.num_shards))
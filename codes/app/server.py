@@ -0,0 +1,209 @@
+# Local inference server for trained models, which micro-batches the concurrent requests into one forward pass
+# Run from `codes/app` : python server.py --config_id <config id> --checkpoint <path to checkpoint> [--port 8000 | --unix <socket path>]
+# POST /predict with {"story": "[Ann] is the mother of [Bob]. ...", "query": ["Ann", "Bob"]}
+#   -> {"relation": <predicted relation>, "confidence": <softmax probability>}
+#   the graph models also need "story_edges", "edge_types" and "query_edge", as in the data files
+# GET /stats -> p50 / p99 latency (ms) and histogram of the batch sizes
+import argparse
+import asyncio
+import json
+import logging
+import time
+from collections import Counter, deque
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from codes.experiment.experiment import load_data_util
+from codes.net.micro_batcher import MicroBatcher
+from codes.net.net_registry import choose_model
+from codes.net.trainer import Trainer
+from codes.utils.config import get_config
+from codes.utils.util import set_seed
+
+HTTP_STATUS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+               500: 'Internal Server Error'}
+
+
+class InferenceModel:
+    """
+    Trained model with the data utility of its dataset, predicting the relation of raw stories
+    """
+    def __init__(self, config, checkpoint=''):
+        """
+        :param config: config of the experiment which saved the checkpoint
+        :param checkpoint: file saved by `Experiment.save_checkpoint`
+        """
+        self.config = config
+        self.device = torch.device(config.general.device)
+        set_seed(seed=config.general.seed)
+        self.data_util, _ = load_data_util(config)
+        encoder, decoder = choose_model(config)
+        encoder, decoder = encoder.to(self.device), decoder.to(self.device)
+        # the Trainer randomizes the entity embeddings, so the checkpoint is loaded after it, as in run_experiment
+        self.trainer = Trainer(config.model, encoder, decoder, max_entity_id=self.data_util.max_entity_id)
+        if checkpoint:
+            state = torch.load(checkpoint, map_location=self.device)
+            encoder.load_state_dict(state['model.encoder'])
+            decoder.load_state_dict(state['model.decoder'])
+        self.trainer.eval()
+
+    def predict_proba(self, batch):
+        """
+        :param batch: Batch of precomputed stories
+        :return: B x num_classes class probabilities, on the device of the model
+        """
+        batch.config = self.config
+        batch.to_device(self.device)
+        return F.softmax(self.trainer.predict(batch), dim=-1)
+
+    def predict_batch(self, batch):
+        """
+        :param batch: Batch collated by the micro-batcher
+        :return: list of (relation, confidence), in the order of the batch
+        """
+        confidences, predictions = self.predict_proba(batch).max(-1)
+        return [(self.data_util.target_id2word[p], c) for p, c in zip(predictions.tolist(), confidences.tolist())]
+
+
+class ServerStats:
+    """
+    Latency of the requests and size of the batches
+    """
+    def __init__(self, window=10000):
+        """
+        :param window: number of recent requests the latency percentiles are computed on
+        """
+        self.latencies = deque(maxlen=window)
+        self.batch_sizes = Counter()
+        self.num_requests = 0
+
+    def record_latency(self, seconds):
+        self.latencies.append(seconds * 1000)
+        self.num_requests += 1
+
+    def record_batch(self, batch_size):
+        self.batch_sizes[batch_size] += 1
+
+    def report(self):
+        latencies = np.array(self.latencies) if len(self.latencies) > 0 else np.zeros(1)
+        return {
+            'requests': self.num_requests,
+            'latency_p50_ms': float(np.percentile(latencies, 50)),
+            'latency_p99_ms': float(np.percentile(latencies, 99)),
+            'batch_sizes': {str(size): count for size, count in sorted(self.batch_sizes.items())},
+        }
+
+
+class InferenceServer:
+    """
+    asyncio server handing the requests to a MicroBatcher, which groups them into batches of up to
+    `max_batch_size` stories, waiting at most `max_wait_ms` after the first story of a batch
+    """
+    def __init__(self, model, max_batch_size=32, max_wait_ms=5.0):
+        self.model = model
+        self.stats = ServerStats()
+        # the forward passes run one at a time, off the event loop
+        self.batcher = MicroBatcher(model.data_util, model.predict_batch, max_batch_size=max_batch_size,
+                                    max_wait_ms=max_wait_ms, on_batch=self.stats.record_batch)
+
+    async def predict(self, record):
+        """
+        :param record: dict with `story` and `query`
+        :return: relation, confidence
+        """
+        return await asyncio.wrap_future(self.batcher.submit(record))
+
+    async def _handle_predict(self, body):
+        try:
+            request = json.loads(body.decode('utf-8'))
+            record = {'story': request['story'], 'query': str(tuple(request['query']))}
+            # the graph models also need the clean graph of the story
+            for key in ['story_edges', 'edge_types', 'query_edge']:
+                if key in request:
+                    record[key] = str(request[key])
+        except (ValueError, KeyError, TypeError) as e:
+            return 400, {'error': 'expected {{"story": ..., "query": [entity, entity]}} : {}'.format(e)}
+        start = time.perf_counter()
+        try:
+            relation, confidence = await self.predict(record)
+        except Exception as e:
+            return 500, {'error': str(e)}
+        self.stats.record_latency(time.perf_counter() - start)
+        return 200, {'relation': relation, 'confidence': confidence}
+
+    async def handle(self, reader, writer):
+        """
+        Minimal HTTP/1.1 handler, with keep-alive
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, value = line.decode('latin-1').split(':', 1)
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                if path == '/predict':
+                    if method == 'POST':
+                        status, response = await self._handle_predict(body)
+                    else:
+                        status, response = 405, {'error': 'use POST'}
+                elif path == '/stats':
+                    status, response = 200, self.stats.report()
+                else:
+                    status, response = 404, {'error': 'unknown path {}'.format(path)}
+                payload = json.dumps(response).encode('utf-8')
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n'
+                             'Connection: {}\r\n\r\n'.format(status, HTTP_STATUS[status], len(payload),
+                                                            'keep-alive' if keep_alive else 'close')
+                             .encode('latin-1') + payload)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ValueError, asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8000, unix_path=''):
+        if unix_path:
+            server = await asyncio.start_unix_server(self.handle, path=unix_path)
+            logging.info("Serving on {}".format(unix_path))
+        else:
+            server = await asyncio.start_server(self.handle, host=host, port=port)
+            logging.info("Serving on http://{}:{}".format(host, port))
+        async with server:
+            await server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Inference server for trained models")
+    parser.add_argument('--config_id', default='sample', help='config id of the trained model')
+    parser.add_argument('--checkpoint', default='', help='checkpoint saved by the experiment')
+    parser.add_argument('--host', default='127.0.0.1', help='host to listen on')
+    parser.add_argument('--port', type=int, default=8000, help='port to listen on')
+    parser.add_argument('--unix', default='', help='listen on this unix socket instead of host:port')
+    parser.add_argument('--device', default='cpu', help='device of the model')
+    parser.add_argument('--max_batch_size', type=int, default=32, help='max number of stories per forward pass')
+    parser.add_argument('--max_wait_ms', type=float, default=5.0, help='max wait for a batch to fill up')
+    parser.add_argument('--num_threads', type=int, default=0, help='torch intra-op threads, 0 keeps the default')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+
+    config = get_config(config_id=args.config_id)
+    config.log.logger = logging.getLogger()
+    config.general.device = args.device
+    model = InferenceModel(config, args.checkpoint)
+    server = InferenceServer(model, max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms)
+    asyncio.run(server.serve(host=args.host, port=args.port, unix_path=args.unix))
@@ -11,10 +11,12 @@ Encoder:
 
     Output Unit: an MLP that maps the last memory state to an output distribution
 """
+import time
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+from addict import Dict
 from codes.net.batch import Batch
 from codes.net.base_net import Net
 from codes.baselines.lstm.basic import SimpleEncoder
@@ -50,6 +52,11 @@ class MACNetworkEncoder(Net):
         # 2. MAC Cell
         self.MAC = MACCell(model_config, self.mac_size, self.iteration)
 
+        # optionally record the wall time spent in each reasoning iteration
+        self.report_timing = model_config.mac.report_timing
+        self.iteration_times = [0.0] * self.iteration
+        self.timed_batches = 0
+
 
     def calculate_query(self, batch):
         """
@@ -69,12 +76,8 @@ class MACNetworkEncoder(Net):
         query_mask = query_mask.transpose(1, 2)  # B x num_ents x seq_len
 
         query_rep_all = torch.bmm(query_mask.float(), encoder_outputs)  # B x num_ents x dim
-        ents = query_rep_all.size(1)
-        query_reps = []
-        for i in range(ents):
-            query_reps.append(query_rep_all[:, i, :].unsqueeze(1))
-
-        query_rep = torch.cat(query_reps, -1).squeeze(1)
+        # concatenation of the entities along the last dim
+        query_rep = query_rep_all.reshape(query_rep_all.size(0), -1)  # B x num_ents*dim
 
         return query_rep, query_rep_all
 
@@ -93,11 +96,37 @@ class MACNetworkEncoder(Net):
         # MAC Unit
         batch_size = knowledgeBase.size(0)
         memory, control = self.MAC.init_state(batch, batch_size)
+        # projections of the knowledge base and the query do not change across iterations
+        invariants = self.MAC.precompute(knowledgeBase, query_rep, query_rep_all)
         for i in range(self.iteration):
-            memory, control = self.MAC(knowledgeBase, query_rep, query_rep_all, memory, control, i)
+            if self.report_timing:
+                start = self._sync_time(knowledgeBase)
+            memory, control = self.MAC.step(invariants, memory, control, i)
+            if self.report_timing:
+                self.iteration_times[i] += self._sync_time(knowledgeBase) - start
+        if self.report_timing:
+            self.timed_batches += 1
         # encoder return: encoder_output, encoder_hidden
         return memory, None
 
+    def _sync_time(self, tensor):
+        if tensor.is_cuda:
+            torch.cuda.synchronize(tensor.device)
+        return time.time()
+
+    def timing_report(self, reset=True):
+        """
+        Mean wall time (ms) of each reasoning iteration since the last report
+        :return: list of floats, one per iteration. Empty if timing is off
+        """
+        if not self.report_timing or self.timed_batches == 0:
+            return []
+        report = [1000 * t / self.timed_batches for t in self.iteration_times]
+        if reset:
+            self.iteration_times = [0.0] * self.iteration
+            self.timed_batches = 0
+        return report
+
 
 class MACNetworkDecoder(Net):
     """
@@ -185,13 +214,62 @@ class MACCell(Net):
         initCtrl = torch.rand(batch_size, self.hidden_size).to(batch.inp.device)
         return initMemory, initCtrl
 
+    def precompute(self, knowledgeBase, query_rep, query_rep_all):
+        """
+        Compute everything that does not depend on the memory or control state once per batch
+        :param knowledgeBase: [B, T, dim]
+        :param query_rep:     [B, num_ents*dim] (or [B, dim] if projected)
+        :param query_rep_all: [B, entity_num, dim]
+        :return: Dict of the iteration invariant tensors
+        """
+        hidden_size = self.hidden_size
+        invariants = Dict()
+        invariants.knowledgeBase = knowledgeBase
+        invariants.query_rep_all = query_rep_all
+        # position aware question, one per iteration
+        transformedQuery = self.transformQuestion_1(query_rep).tanh()
+        if self.model_config.mac.shareQuestion:
+            transformedQuery = self.transformQuestion_2(transformedQuery).tanh()
+            invariants.transformedQuery = [transformedQuery] * self.iteration
+        else:
+            invariants.transformedQuery = [self.transformQuestion_2[i](transformedQuery).tanh()
+                                           for i in range(self.iteration)]
+        # read unit: knowledge base projection, and the knowledge base half of combineInfo
+        invariants.KB = self.transformKB(knowledgeBase)  # B x T x dim
+        invariants.combinedKB = F.linear(knowledgeBase, self.combineInfo.weight[:, hidden_size:],
+                                         self.combineInfo.bias)  # B x T x dim
+        # control unit: query entity half of controlProj
+        invariants.projQueryAll = None
+        if self.model_config.controlConcatWords and self.model_config.controlProj:
+            invariants.projQueryAll = F.linear(query_rep_all, self.controlProj.weight[:, hidden_size:],
+                                               self.controlProj.bias)
+        return invariants
+
+    def step(self, invariants, memory, control, i):
+        """
+        One reasoning iteration using the output of `precompute`
+        :return: new memory [B, dim], new control [B, dim]
+        """
+        # CONTROL unit
+        newCtrl, newContCtrl = self.control(invariants.transformedQuery[i], invariants.query_rep_all, control,
+                                            projQueryAll=invariants.projQueryAll)
+
+        # READ unit
+        newInfo = self.read(invariants.knowledgeBase, memory, newCtrl,
+                            KB=invariants.KB, combinedKB=invariants.combinedKB)
+
+        # WRITE unit
+        newMemory = self.write(memory, newInfo, newCtrl)
+
+        return newMemory, newCtrl
 
-    def control(self, query_rep, query_rep_all, ctrl, contCtrl=None):
+    def control(self, query_rep, query_rep_all, ctrl, contCtrl=None, projQueryAll=None):
         """
         :param query_rep:     [B, dim], concatenation of two query entities after a time-step specific linear transformation
         :param query_rep_all: [B, entity_num, dim] (typically entity_num = 2)
         :param ctrl:          [B, dim], previous control state
         :param contCtrl:      [B, dim], previous continuous control state (optional)
+        :param projQueryAll:  [B, entity_num, dim], precomputed query_rep_all half of controlProj (optional)
         :return ctrl:         [B, dim], new control state
         :return contCtrl:     [B, dim], new continuous control state
         """
@@ -205,13 +283,18 @@ class MACCell(Net):
         # 2.1: computer interactions between continuous control state and query entities.
         interactions = torch.unsqueeze(newContCtrl, 1) * query_rep_all     # B x entity_num x dim
 
-        # optionally concatenate query entities with interactions.
-        if self.model_config.controlConcatWords:
-            interactions = torch.cat([interactions, query_rep_all], -1)   # B x entity_num x 2*dim
+        # optionally concatenate query entities with interactions, and project
+        if projQueryAll is not None:
+            interactions = F.linear(interactions, self.controlProj.weight[:, :self.hidden_size]) \
+                           + projQueryAll                                 # B x entity_num x dim
+        else:
+            # optionally concatenate query entities with interactions.
+            if self.model_config.controlConcatWords:
+                interactions = torch.cat([interactions, query_rep_all], -1)   # B x entity_num x 2*dim
 
-        # optionally projections
-        if self.model_config.controlProj:
-            interactions = self.controlProj(interactions)                 # B x entity_num x dim
+            # optionally projections
+            if self.model_config.controlProj:
+                interactions = self.controlProj(interactions)                 # B x entity_num x dim
 
         # compute attn distribution
         attnLogit = self.controlAttn(interactions)                # B x entity_num x 1
@@ -221,18 +304,21 @@ class MACCell(Net):
         return newCtrl, newContCtrl
 
 
-    def read(self, knowledgeBase, prevMemory, curControl):
+    def read(self, knowledgeBase, prevMemory, curControl, KB=None, combinedKB=None):
         """
         :param knowledgeBase: [B, T, dim], output of LSTM given a paragraph
         :param prevMemory:    [B, dim]
         :param curControl:    [B, dim]
+        :param KB:            [B, T, dim], precomputed transformKB(knowledgeBase) (optional)
+        :param combinedKB:    [B, T, dim], precomputed knowledgeBase half of combineInfo (optional)
         :return: r_i, [B, dim], retrieved info from knowledgeBase
         """
         if True:
             prevMemory = self.memDrop(prevMemory)
 
         mem = self.transformMemory(prevMemory)  # B x dim
-        KB  = self.transformKB(knowledgeBase)   # B x T x dim
+        if KB is None:
+            KB = self.transformKB(knowledgeBase)   # B x T x dim
         if True:
             mem = self.readDrop(mem)
             KB  = self.readDrop(KB)
@@ -242,7 +328,10 @@ class MACCell(Net):
             mem_KB = mem_KB.relu()
 
         # 2. combine and linearly transform new and old knowledge
-        combinedInfo = self.combineInfo(torch.cat([mem_KB, knowledgeBase], dim=-1))  # B x T x dim
+        if combinedKB is None:
+            combinedInfo = self.combineInfo(torch.cat([mem_KB, knowledgeBase], dim=-1))  # B x T x dim
+        else:
+            combinedInfo = F.linear(mem_KB, self.combineInfo.weight[:, :self.hidden_size]) + combinedKB
         interactions = torch.unsqueeze(curControl, 1) * combinedInfo
 
         if True:
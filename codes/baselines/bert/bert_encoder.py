@@ -10,9 +10,70 @@ import pdb
 import numpy as np
 from pytorch_pretrained_bert import BertModel
 from codes.baselines.lstm.basic import SimpleEncoder
+from codes.utils.bert_utils import windowed_bert, get_window_stride
 
 
-class BERTEncoder(Net):
+def quantize_bert(bert_model):
+    """
+    Dynamic int8 quantization of the linear layers of a frozen BertModel.
+    The quantized model only runs on CPU.
+    """
+    return torch.quantization.quantize_dynamic(bert_model, {nn.Linear}, dtype=torch.qint8)
+
+
+class QuantizableBert:
+    """
+    Mixin for the encoders holding a frozen BertModel in `self.model`
+    """
+    quantized = False
+
+    def load_bert(self, model_config):
+        """
+        Load the pretrained BERT, unless its outputs are read from a BertFeatureStore (`bert.stored_features`,
+        set by choose_model), in which case `self.model` is None
+        """
+        self.model = None
+        if not model_config.bert.stored_features:
+            self.model = BertModel.from_pretrained('bert-base-uncased')
+            self.model.eval()
+
+    def bert_outputs(self, batch):
+        """
+        Outputs of the frozen BERT, read from the feature store if any. The stories which are not in the
+        store are run through BERT
+        :return: B x s x hidden_size
+        """
+        if self.feature_store is None:
+            with torch.no_grad():
+                return windowed_bert(self.model, batch.inp, batch.bert_segment_ids, batch.bert_input_mask,
+                                     stride=self.window_stride)
+        out, missing = self.feature_store.lookup(batch, batch.inp.device)
+        if len(missing) > 0:
+            if self.model is None:
+                raise KeyError("{} stories of the batch are not in the BERT feature store, and the BERT "
+                               "weights were not loaded".format(len(missing)))
+            missing = torch.LongTensor(missing).to(batch.inp.device)
+            with torch.no_grad():
+                out[missing] = windowed_bert(self.model, batch.inp[missing], batch.bert_segment_ids[missing],
+                                             batch.bert_input_mask[missing], stride=self.window_stride).float()
+        return out
+
+    def quantize(self):
+        if self.model is None:
+            return
+        self.model = quantize_bert(self.model)
+        self.quantized = True
+
+    def load_state_dict(self, state_dict, strict=True):
+        if self.quantized or self.model is None or not any(k.startswith('model.') for k in state_dict):
+            # BERT is frozen, so keep the pretrained weights of this encoder (quantized, or not loaded
+            # with a feature store) instead of the ones of the checkpoint, which may not have them
+            state_dict = {k: v for k, v in state_dict.items() if not k.startswith('model.')}
+            state_dict.update({k: v for k, v in self.state_dict().items() if k.startswith('model.')})
+        return super().load_state_dict(state_dict, strict)
+
+
+class BERTEncoder(QuantizableBert, Net):
     """
     Bert with fixed encoding scheme
     """
@@ -24,16 +85,16 @@ class BERTEncoder(Net):
         else:
             self.embedding = shared_embeddings
 
-        self.model = BertModel.from_pretrained('bert-base-uncased')
-        self.model.eval()
+        self.load_bert(model_config)
+        # stories longer than BERT_MAX_LENGTH are encoded in overlapping windows
+        self.window_stride = get_window_stride(model_config)
+        # BertFeatureStore, set by choose_model when `bert.feature_store` is provided
+        self.feature_store = None
 
     def forward(self, batch):
-        out = batch.inp
-        with torch.no_grad():
-            out, _ = self.model(out, batch.bert_segment_ids, batch.bert_input_mask, output_all_encoded_layers=False)
-        return out, None
+        return self.bert_outputs(batch), None
 
-class BERTLSTMEncoder(Net):
+class BERTLSTMEncoder(QuantizableBert, Net):
     """
     BERT with LSTM on top of it.
     Get the output from BERT, replace the embedding with our embedding value, and run lstm on top of it.
@@ -48,15 +109,16 @@ class BERTLSTMEncoder(Net):
         else:
             self.embedding = shared_embeddings
 
-        self.model = BertModel.from_pretrained('bert-base-uncased')
-        self.model.eval()
+        self.load_bert(model_config)
+        # stories longer than BERT_MAX_LENGTH are encoded in overlapping windows
+        self.window_stride = get_window_stride(model_config)
         self.lstm_encoder = SimpleEncoder(model_config, use_embedding=False, shared_embeddings=self.embedding)
+        # BertFeatureStore, set by choose_model when `bert.feature_store` is provided
+        self.feature_store = None
 
     def forward(self, batch):
-        out = batch.inp
         # pdb.set_trace()
-        with torch.no_grad():
-            out, _ = self.model(out, batch.bert_segment_ids, batch.bert_input_mask, output_all_encoded_layers=False)
+        out = self.bert_outputs(batch)
         entity_mask = batch.inp_ent_mask.byte()
         entity_emb = self.embedding(batch.bert_inp)
         # replace entity_emb with out in entity mask positions
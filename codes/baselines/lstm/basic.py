@@ -2,7 +2,9 @@
 import torch
 import torch.nn as nn
 from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+from addict import Dict
 from codes.net.base_net import Net
+from codes.net.batch import LengthPermutation
 from codes.utils.util import check_id_emb
 from codes.net.attention import Attn
 from torch.nn import functional as F
@@ -34,31 +36,26 @@ class SimpleEncoder(Net):
 
     def forward(self, batch):
         data = batch.inp
-        inp_len = np.array(batch.inp_lengths)
         if self.use_embedding:
             data = self.embedding(data)
-        # sort
-        inp_len_sorted, idx_sort = np.sort(inp_len)[::-1], np.argsort(-inp_len)
-        inp_len_sorted = inp_len_sorted.copy()
-        idx_unsort = np.argsort(idx_sort)
-
-        idx_sort = torch.from_numpy(idx_sort).to(data.device)
-        data = data.index_select(0, idx_sort)
-        inp_len_sorted_nonzero_idx = np.nonzero(inp_len_sorted)[0]
-        inp_len_sorted_nonzero_idx = torch.from_numpy(inp_len_sorted_nonzero_idx).to(data.device)
-        inp_len_sorted = torch.from_numpy(inp_len_sorted).to(data.device)
-        non_zero_data = data.index_select(0, inp_len_sorted_nonzero_idx)
-        data_pack = pack_padded_sequence(non_zero_data, inp_len_sorted[inp_len_sorted_nonzero_idx], batch_first=True)
+        # sort permutation, cached on the batch
+        perm = batch.inp_perm
+        if perm is None:
+            perm = LengthPermutation(batch.inp_lengths)
+        perm.to_device(data.device)
+        batch_size, seq_len = data.size(0), data.size(1)
+        num_nonzero = perm.num_nonzero
+        # sort, and leave out the empty sequences which come last after sorting
+        data = data.index_select(0, perm.idx_sort[:num_nonzero])
+        data_pack = pack_padded_sequence(data, perm.sorted_lengths[:num_nonzero], batch_first=True)
         outp, hidden_rep = self.lstm(data_pack)
-        outp, _ = pad_packed_sequence(outp, batch_first=True)
-        outp = outp.contiguous()
-        outp_l = torch.zeros((data.size(0), data.size(1), outp.size(2))).to(outp.device)
-        outp_l[inp_len_sorted_nonzero_idx] = outp
+        outp, _ = pad_packed_sequence(outp, batch_first=True, total_length=seq_len)
+        if num_nonzero < batch_size:
+            outp = F.pad(outp, (0, 0, 0, 0, 0, batch_size - num_nonzero))
         # unsort
-        idx_unsort = torch.from_numpy(idx_unsort).to(outp_l.device)
-        outp_l = outp_l.index_select(0, idx_unsort)
+        outp = outp.index_select(0, perm.idx_unsort)
 
-        return outp_l.contiguous(), hidden_rep
+        return outp.contiguous(), hidden_rep
 
 class SimpleDecoder(Net):
     """
@@ -78,6 +75,8 @@ class SimpleDecoder(Net):
         if model_config.encoder.bidirectional:
             base_enc_dim *=2
         query_rep = base_enc_dim * model_config.decoder.query_ents
+        # size of the encoder outputs, which the seq2seq decoder attends over
+        enc_dim = base_enc_dim
 
         if self.pool_type == 'concat':
             base_enc_dim = base_enc_dim*2
@@ -89,14 +88,101 @@ class SimpleDecoder(Net):
         if self.pool_type == 'attn':
             self.attn_module = LSTMAttn(base_enc_dim, input_dim)
 
+        if model_config.loss_type == 'seq2seq':
+            # LSTM over the previous word and the query, with dot attention over the encoder outputs,
+            # so its hidden state has the size of the encoder outputs
+            self.lstm = nn.LSTM(
+                model_config.embedding.dim + query_rep,
+                enc_dim,
+                model_config.decoder.nlayers,
+                batch_first=True
+            )
+            self.decoder2vocab = self.get_mlp(enc_dim * 2, model_config.vocab_size)
+
     def init_hidden(self, encoder_states, batch_size):
         # initial hidden state of the decoder will be an average of encoder states
         avg_state = torch.mean(encoder_states, 1, keepdim=True)  # B x 1 x dim
-        avg_state = avg_state.transpose(0, 1).expand(self.model_config.decoder.nlayers, -1, -1)  # nlayers x B x dim
+        avg_state = avg_state.transpose(0, 1).expand(self.model_config.decoder.nlayers, -1, -1).contiguous()  # nlayers x B x dim
         encoder_hidden = []
         encoder_hidden.append(avg_state)
         encoder_hidden.append(torch.zeros_like(avg_state).to(avg_state.device))
-        return encoder_hidden
+        return tuple(encoder_hidden)
+
+    def decode(self, decoder_inp, hidden_rep, query_rep, encoder_outputs, encoder_mask):
+        """
+        Run the seq2seq decoder over the given words
+        :param decoder_inp: B x t word ids
+        :param hidden_rep: (h, c), each nlayers x B x dim
+        :param query_rep: B x 1 x query dim
+        :param encoder_outputs: B x seq_len x dim
+        :param encoder_mask: B x seq_len, 1 over the words of the story
+        :return: logits B x t x vocab, hidden_rep, attention B x t x seq_len
+        """
+        check_id_emb(decoder_inp, self.model_config.vocab_size)
+        decoder_inp = self.embedding(decoder_inp)
+        lstm_inp = torch.cat([decoder_inp, query_rep.expand(-1, decoder_inp.size(1), -1)], -1)
+        outp, hidden_rep = self.lstm(lstm_inp, hidden_rep)  # B x t x dim
+        scores = torch.bmm(outp, encoder_outputs.transpose(1, 2))  # B x t x seq_len
+        scores = scores.masked_fill(encoder_mask.unsqueeze(1) == 0, -1e9)
+        attn = F.softmax(scores, dim=-1)
+        context = torch.bmm(attn, encoder_outputs)  # B x t x dim
+        logits = self.decoder2vocab(torch.cat([outp, context], -1))
+        return logits, hidden_rep, attn
+
+    def decode_step(self, decoder_inp, hidden_rep, query_rep, encoder_outputs, encoder_mask):
+        """
+        One step of the seq2seq decoder, as used by the beam search of Generator
+        :param decoder_inp: B x 1 word ids
+        :return: log probabilities B x vocab, hidden_rep, attention B x seq_len
+        """
+        logits, hidden_rep, attn = self.decode(decoder_inp, hidden_rep, query_rep, encoder_outputs, encoder_mask)
+        return F.log_softmax(logits.squeeze(1), dim=-1), hidden_rep, attn.squeeze(1)
+
+    def init_decode_state(self, encoder_outputs, encoder_mask, query_rep):
+        """
+        Decoder state kept across the steps of the greedy decoding: LSTM state, attention keys
+        and mask bias computed once from the encoder outputs
+        :return: Dict
+        """
+        state = Dict()
+        state.hidden = self.init_hidden(encoder_outputs, encoder_outputs.size(0))
+        state.keys = encoder_outputs.transpose(1, 2).contiguous()  # B x dim x seq_len
+        state.values = encoder_outputs
+        state.bias = ((1 - encoder_mask).float() * -1e9).unsqueeze(1)  # B x 1 x seq_len
+        state.query_rep = query_rep
+        return state
+
+    def decode_cached(self, decoder_inp, state):
+        """
+        One step of the seq2seq decoder over the cached state, which is updated in place
+        :param decoder_inp: B x 1 word ids
+        :param state: Dict from `init_decode_state`
+        :return: logits B x vocab
+        """
+        decoder_inp = self.embedding(decoder_inp)
+        lstm_inp = torch.cat([decoder_inp, state.query_rep], -1)
+        outp, state.hidden = self.lstm(lstm_inp, state.hidden)  # B x 1 x dim
+        attn = F.softmax(torch.baddbmm(state.bias, outp, state.keys), dim=-1)  # B x 1 x seq_len
+        context = torch.bmm(attn, state.values)
+        return self.decoder2vocab(torch.cat([outp, context], -1)).squeeze(1)
+
+    def select_decode_state(self, state, index):
+        """
+        Keep the rows of the cached state given by index
+        """
+        selected = Dict()
+        selected.hidden = tuple(h.index_select(1, index) for h in state.hidden)
+        for key in ['keys', 'values', 'bias', 'query_rep']:
+            selected[key] = state[key].index_select(0, index)
+        return selected
+
+    def encoder_mask(self, batch, encoder_outputs):
+        """
+        :return: B x seq_len mask, 1 over the words of the story
+        """
+        lengths = batch.lengths_tensor(encoder_outputs.device)
+        positions = torch.arange(encoder_outputs.size(1), device=encoder_outputs.device).unsqueeze(0)
+        return (positions < lengths.unsqueeze(1)).long()
 
     def calculate_query(self, batch):
         """
@@ -135,14 +221,14 @@ class SimpleDecoder(Net):
                 # encoder_outputs[encoder_outputs == 0] = -1e9
                 emb = torch.max(encoder_outputs, 1)[0]
             elif self.pool_type == 'mean':
-                sent_len = torch.FloatTensor(batch.inp_lengths.copy()).unsqueeze(1).to(encoder_outputs.device)
+                sent_len = batch.lengths_tensor(encoder_outputs.device).float().unsqueeze(1)
                 emb = torch.sum(encoder_outputs, 1)
                 # BUG FIX: fails if batchsize is 1
                 if emb.dim() > 2:
                     emb = emb.squeeze(0)
                 emb = emb / sent_len.expand_as(emb)
             elif self.pool_type == 'concat':
-                sent_len = torch.FloatTensor(batch.inp_lengths.copy()).unsqueeze(1).to(encoder_outputs.device)
+                sent_len = batch.lengths_tensor(encoder_outputs.device).float().unsqueeze(1)
                 emb_mean = torch.sum(encoder_outputs, 1).squeeze(0)
                 emb_mean = emb_mean / sent_len.expand_as(emb_mean)
                 encoder_outputs[encoder_outputs == 0] = -1e9
@@ -156,10 +242,14 @@ class SimpleDecoder(Net):
             mlp_inp = torch.cat([query_rep.squeeze(1), emb], -1)
         else:
             decoder_inp = step_batch.decoder_inp
-            check_id_emb(decoder_inp, self.model_config.vocab_size)
-            decoder_inp = self.embedding(decoder_inp)
-            lstm_inp = torch.cat([decoder_inp, query_rep], -1)
-            mlp_inp, hidden_rep = self.lstm(lstm_inp, hidden_rep)
+            if not torch.is_tensor(decoder_inp):
+                # teacher forcing over the target text, without its end token
+                decoder_inp = batch.text_target[:, :-1]
+            if not isinstance(hidden_rep, tuple):
+                hidden_rep = self.init_hidden(encoder_outputs, encoder_outputs.size(0))
+            outp, hidden_rep, attn = self.decode(decoder_inp, hidden_rep, query_rep, encoder_outputs,
+                                                 self.encoder_mask(batch, encoder_outputs))
+            return outp, attn, hidden_rep
 
         outp = self.decoder2vocab(mlp_inp)
         return outp, None, hidden_rep
@@ -9,7 +9,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 from codes.baselines.lstm.basic import SimpleEncoder
-from codes.net.batch import Batch
+from codes.net.batch import Batch, LengthPermutation
 from codes.net.base_net import Net
 from addict import Dict
 import numpy as np
@@ -61,19 +61,52 @@ class RNSentReader(Net):
         if self.pooling not in ['max', 'mean']:
             raise NotImplementedError("RNSentReader {} pooling not implemented".format(self.pooling))
 
+        # if True, do not read the whole story again for the query representation,
+        # gather the story tokens from the sentence level outputs instead
+        self.single_pass = model_config.encoder.rn.single_pass
+
+    def gather_story(self, outp, sent_perm, B, num_sents, story_len):
+        """
+        Map the sentence level reader outputs back to story token positions, using the
+        token to sentence offsets derived from the sentence lengths
+        :param outp: (B x s) x w x dim
+        :param sent_perm: LengthPermutation of the flattened sentence lengths
+        :return: B x story_len x dim, zero over the padding
+        """
+        word_len = outp.size(1)
+        device = outp.device
+        sent_lengths = sent_perm.to_device(device).lengths.view(B, num_sents)  # B x s
+        ends = sent_lengths.cumsum(1)  # B x s
+        starts = ends - sent_lengths
+        positions = torch.arange(story_len, device=device).unsqueeze(0)  # 1 x len
+        # sentence holding each story token: number of sentences ending at or before it
+        sent_idx = (positions.unsqueeze(2) >= ends.unsqueeze(1)).long().sum(2)  # B x len
+        sent_idx = sent_idx.clamp(max=num_sents - 1)
+        word_idx = (positions - starts.gather(1, sent_idx)).clamp(0, word_len - 1)  # B x len
+        row_idx = torch.arange(B, device=device).unsqueeze(1) * num_sents + sent_idx
+        flat_idx = (row_idx * word_len + word_idx).view(-1)
+        story = outp.reshape(B * num_sents * word_len, -1).index_select(0, flat_idx)
+        story = story.view(B, story_len, -1)
+        valid = positions < ends[:, -1:]  # B x len
+        return story * valid.unsqueeze(2).float()
+
     def forward(self, batch):
         inp = batch.s_inp # B x s x w
         B, sent_len, word_len = inp.size()
         inp = inp.view(-1, word_len) # (B x sent_len) x w
         inp_len = [s for sl in batch.sent_lengths for s in sl] # flatten
-        reader_batch = Batch(inp=inp, inp_lengths=inp_len)
+        sent_perm = batch.sent_perm
+        if sent_perm is None:
+            sent_perm = LengthPermutation(inp_len)
+        reader_batch = Batch(inp=inp, inp_lengths=inp_len, inp_perm=sent_perm)
         outp,_ =  self.reader(reader_batch) # (B x s) x w x dim
-        question_batch = Batch(inp=batch.inp, inp_lengths=batch.inp_lengths)
-        q_outp,_ = self.reader(question_batch) # B x len x dim
+        if self.single_pass:
+            q_outp = self.gather_story(outp, sent_perm, B, sent_len, batch.inp.size(1)) # B x len x dim
+        else:
+            question_batch = Batch(inp=batch.inp, inp_lengths=batch.inp_lengths, inp_perm=batch.inp_perm)
+            q_outp,_ = self.reader(question_batch) # B x len x dim
         if self.pooling == 'mean':
-            inp_len = np.array(inp_len)
-            inp_len[inp_len == 0] = 1
-            sent_len_a = torch.from_numpy(np.array(inp_len)).unsqueeze(1).to(outp.device).float()
+            sent_len_a = sent_perm.to_device(outp.device).lengths.clamp(min=1).unsqueeze(1).float()
             emb = torch.sum(outp, 1).squeeze(0)
             emb = emb / sent_len_a.expand_as(emb) # (B x s) x dim
         else:
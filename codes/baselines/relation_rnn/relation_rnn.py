@@ -2,10 +2,11 @@
 # The implementation is based on `https://github.com/L0SG/relational-rnn-pytorch`
 
 import math
+from collections import OrderedDict
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from codes.net.batch import Batch
+from codes.net.batch import Batch, LengthPermutation
 from codes.net.base_net import Net
 
 
@@ -92,6 +93,18 @@ class RelationRNNEncoder(Net):
         ######### dropout #####
         self.dropout = nn.Dropout(model_config.RMC.dropout)
 
+        ######### fused step #####
+        # if True, trace the memory update once per batch size and re-use it for every step. The finished
+        # rows are then masked rather than dropped, so that the batch size stays the same over the steps
+        self.fused_step = model_config.RMC.fused_step
+        # (batch size, device, grad mode) -> traced memory update, the most recently used ones
+        self.step_cache = OrderedDict()
+        self.max_cached_steps = 8
+
+        # initial memory: identity over the memory slots, zero padded (or truncated) to mem_size.
+        # kept out of the state dict, and broadcasted over the batch in `initial_state`
+        self.register_buffer('init_state_template', torch.eye(self.mem_slots, self.mem_size), persistent=False)
+
 
     def initial_state(self, batch, batch_size):
         """
@@ -99,19 +112,7 @@ class RelationRNNEncoder(Net):
         :param batch_size:
         :return: (batch_size, self.mem_slots, self.mem_size)
         """
-        init_state = torch.stack([torch.eye(self.mem_slots) for _ in range(batch_size)])
-
-        # pad the matrix with zeros
-        if self.mem_size > self.mem_slots:
-            difference = self.mem_size - self.mem_slots
-            pad = torch.zeros((batch_size, self.mem_slots, difference))
-            init_state = torch.cat([init_state, pad], -1)
-
-        # truncation. take the first 'self.mem_size' components
-        elif self.mem_size < self.mem_slots:
-            init_state = init_state[:, :, :self.mem_size]
-
-        return init_state.to(batch.inp.device)
+        return self.init_state_template.to(batch.inp.device).unsqueeze(0).expand(batch_size, -1, -1)
 
 
     def repackage_hidden(self, h):
@@ -305,38 +306,150 @@ class RelationRNNEncoder(Net):
         return output, next_memory
 
 
-    def forward(self, batch):
-        import time
-        # Starting each batch, we detach the hidden state from how it was previously produced.
-        # If we didn't, the model would try backpropagating all the way to start of the dataset.
-        # memory = self.repackage_hidden(memory)
+    def projected_step(self, inputs_reshape, gate_inputs, memory):
+        """
+        Memory update of `forward_step` for inputs which are already projected.
+        The input projections do not depend on the memory, so `forward` computes them
+        for all the time steps at once.
+        Args:
+          inputs_reshape: [B x 1 x mem_size], output of `input_projector`
+          gate_inputs:    [B x 1 x num_gates], output of `input_gate_projector`
+          memory:         [B x mem_slots x mem_size]
+        Returns:
+          next_memory:    [B x mem_slots x mem_size]
+        """
+        memory_plus_input = torch.cat([memory, inputs_reshape], dim=1)  # B x (mem_slots+1) x mem_size
+        next_memory = self.attend_over_memory(memory_plus_input)
+        next_memory = next_memory[:, :-1, :]
 
-        # for loop implementation of (entire) recurrent forward pass of the model
-        # inputs is batch first [batch, seq], and output logit per step is [batch, vocab]
-        # so the concatenated logits are [seq * batch, vocab]
+        if self.gate_style == 'unit' or self.gate_style == 'memory':
+            # equation 4 and 5, with the input half precomputed
+            gates = self.memory_gate_projector(torch.tanh(memory)) + gate_inputs
+            input_gate, forget_gate = torch.split(gates, self.num_gates // 2, dim=2)
+            input_gate = torch.sigmoid(input_gate + self.input_bias)
+            forget_gate = torch.sigmoid(forget_gate + self.forget_bias)
+            # equation 7
+            next_memory = input_gate * torch.tanh(next_memory) + forget_gate * memory
+
+        return next_memory
+
+
+    def get_step_fn(self, inputs_reshape, gate_inputs, memory):
+        """
+        Return the function computing one memory update.
+        In `fused_step` mode, the update is traced into a single graph once per batch size, device and
+        grad mode. The update has no dropout, so the same graph serves the train and eval modes
+        :return: callable(inputs_reshape, gate_inputs, memory) -> next_memory
+        """
+        if not self.fused_step:
+            return self.projected_step
+        key = (memory.shape[0], str(memory.device), torch.is_grad_enabled())
+        if key in self.step_cache:
+            self.step_cache.move_to_end(key)
+        else:
+            traced = torch.jit.trace_module(
+                self, {'projected_step': (inputs_reshape, gate_inputs, memory.contiguous())},
+                check_trace=False)
+            self.step_cache[key] = traced.projected_step
+            if len(self.step_cache) > self.max_cached_steps:
+                self.step_cache.popitem(last=False)
+        return self.step_cache[key]
+
+
+    def fused_forward(self, inputs_proj, gate_inputs, memory, sorted_lengths, max_steps):
+        """
+        Step loop of `fused_step` mode, over the whole (sorted) batch: the rows past their length keep
+        their memory through a mask, so that every step runs the same traced graph
+        :param sorted_lengths: (B) long tensor, on the device of the inputs
+        :return: memory B x mem_slots x mem_size, list of the per step outputs B x 1 x (mem_slots * mem_size)
+        """
+        batch_size = memory.shape[0]
+        logits = []
+        for idx_step in range(max_steps):
+            step_inputs = inputs_proj[:, idx_step:idx_step + 1]
+            step_gates = gate_inputs[:, idx_step:idx_step + 1]
+            step_fn = self.get_step_fn(step_inputs, step_gates, memory)
+            active = (sorted_lengths > idx_step).view(-1, 1, 1)
+            memory = torch.where(active, step_fn(step_inputs, step_gates, memory), memory)
+            if self.return_all_outputs:
+                logits.append((memory * active.to(memory.dtype)).view(batch_size, 1, -1))
+        return memory, logits
 
-        # targets are flattened [seq, batch] => [seq * batch], so the dimension is correct
+
+    def forward(self, batch):
+        # for loop implementation of (entire) recurrent forward pass of the model
+        # inputs is batch first [batch, seq], and output per step is [batch, mem_slots * mem_size]
         inputs = batch.inp
-        inputs_lengths = batch.inp_lengths
         inputs = self.embedding(inputs)
         inputs = self.dropout(inputs)
 
         batch_size = inputs.shape[0]
         time_steps = inputs.shape[1]
         memory = self.initial_state(batch, batch_size)
+
+        # the input projections do not depend on the memory, so run them once over all steps
+        inputs_proj = self.input_projector(inputs)  # B x T x mem_size
+        gate_inputs = self.input_gate_projector(inputs_proj)  # B x T x num_gates
+
+        # process the rows sorted by length, and shrink the active batch as they finish
+        # (as pack_padded_sequence does), so the compute is proportional to the real tokens.
+        # finished rows keep their memory from their last real step
+        perm = batch.inp_perm
+        if perm is None:
+            perm = LengthPermutation(batch.inp_lengths)
+        perm.to_device(inputs.device)
+        sorted_lengths = perm.sorted_lengths.tolist()
+        inputs_proj = inputs_proj.index_select(0, perm.idx_sort)
+        gate_inputs = gate_inputs.index_select(0, perm.idx_sort)
+
+        max_steps = min(sorted_lengths[0], time_steps)
+        if self.fused_step:
+            memory, logits = self.fused_forward(inputs_proj, gate_inputs, memory,
+                                                perm.sorted_lengths.to(inputs.device), max_steps)
+            return self.unsort_outputs(memory, logits, perm, time_steps, max_steps)
+        finished = []
         logits = []
-        # shape[1] is seq_lenth T
-        for idx_step in range(time_steps):
-            # input: B x embed_dim
-            # memory: B x mem_slots x mem_size
-            logit, memory = self.forward_step(inputs[:, idx_step], memory)
+        num_active = batch_size
+        for idx_step in range(max_steps):
+            while num_active > 0 and sorted_lengths[num_active - 1] <= idx_step:
+                num_active -= 1
+            if num_active == 0:
+                break
+            if num_active < memory.shape[0]:
+                # the tail rows are done, set their memory aside
+                finished.append(memory[num_active:])
+                memory = memory[:num_active]
+            # input: B_t x 1 x mem_size
+            # memory: B_t x mem_slots x mem_size
+            step_inputs = inputs_proj[:num_active, idx_step:idx_step + 1]
+            step_gates = gate_inputs[:num_active, idx_step:idx_step + 1]
+            step_fn = self.get_step_fn(step_inputs, step_gates, memory)
+            memory = step_fn(step_inputs, step_gates, memory)
             if self.return_all_outputs:
-                logits.append(logit.unsqueeze(1))
+                logit = memory.view(num_active, 1, -1)
+                logits.append(F.pad(logit, (0, 0, 0, 0, 0, batch_size - num_active)))
+        finished.append(memory)
+        memory = torch.cat(finished[::-1], dim=0)
+        return self.unsort_outputs(memory, logits, perm, time_steps, max_steps)
+
+
+    def unsort_outputs(self, memory, logits, perm, time_steps, max_steps):
+        """
+        Restore the order of the batch, and pad the per step outputs to the story length
+        :param memory: B x mem_slots x mem_size, in the sorted order
+        :param logits: list of the per step outputs, in the sorted order
+        :return: outputs, memory B x (mem_slots * mem_size)
+        """
+        batch_size = memory.shape[0]
+        memory = memory.index_select(0, perm.idx_unsort)
+        memory = memory.view(batch_size, -1)
         if self.return_all_outputs:
-            logits = torch.cat(logits, dim=1)
-            return logits, memory.view(memory.shape[0], -1)
+            logits = torch.cat(logits, dim=1).index_select(0, perm.idx_unsort)
+            if max_steps < time_steps:
+                logits = F.pad(logits, (0, 0, 0, time_steps - max_steps))
+            return logits, memory
         else:
-            return logit, memory.view(memory.shape[0], -1)
+            return memory, memory
 
 
 class RelationRNNDecoder(Net):
@@ -0,0 +1,113 @@
+# Background evaluation of the test files, so that training does not wait for it
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+from addict import Dict
+
+# state of the evaluation worker process, set by _init_worker
+_worker = Dict()
+
+
+def _init_worker(config, test_files, batches, max_entity_id):
+    """
+    Build the models and the merged test dataloader once per worker process, on CPU
+    :param config: experiment config, with the data dependent model config, without the logger
+    :param test_files: list of test files, in the order of the file ids
+    :param batches: precomputed batches of the merged test stream of the training process
+    :param max_entity_id: DataUtility.max_entity_id of the training process
+    """
+    # imported here as codes.experiment.experiment imports this module
+    from torch.utils import data
+    from codes.net.net_registry import choose_model
+    from codes.net.trainer import Trainer
+    from codes.utils.data import PreComputedDataLoader, pre_collate_fn
+    from codes.utils.experiment_utils import Experiment
+    from codes.utils.log import FakeExperiment
+    from codes.utils.util import set_seed
+
+    config = Dict(config)
+    config.log.logger = logging.getLogger()
+    config.general.device = 'cpu'
+    torch.set_num_threads(config.log.async_test_threads if config.log.async_test_threads else 1)
+    set_seed(seed=config.general.seed)
+    experiment = Experiment(config)
+    experiment.device = torch.device('cpu')
+    experiment.comet_ml = FakeExperiment()
+    experiment.iteration_index.test = 0
+    experiment.model.encoder, experiment.model.decoder = choose_model(config)
+    experiment.trainer = Trainer(config.model, experiment.model.encoder, experiment.model.decoder,
+                                 max_entity_id=max_entity_id)
+    # the stories are anonymized by the training process, so the workers score the same batches
+    experiment.dataloaders.test_merged = data.DataLoader(PreComputedDataLoader(batches), batch_size=1,
+                                                         collate_fn=pre_collate_fn)
+    _worker.experiment = experiment
+    _worker.test_files = test_files
+
+
+def _evaluate(epoch, encoder_state, decoder_state):
+    """
+    Score the snapshot of the models taken at the end of `epoch`
+    :return: epoch, dict of test file -> accuracy, dict of test file -> loss
+    """
+    from codes.experiment.experiment import _run_merged_test
+    experiment = _worker.experiment
+    experiment.model.encoder.load_state_dict(encoder_state)
+    experiment.model.decoder.load_state_dict(decoder_state)
+    experiment.epoch_index = epoch
+    accs, losses = _run_merged_test(experiment.dataloaders.test_merged, experiment, _worker.test_files)
+    return epoch, accs, losses
+
+
+def _snapshot(model):
+    return {k: v.detach().cpu().clone() for k, v in model.state_dict().items()}
+
+
+class AsyncEvaluator:
+    """
+    Pool of CPU processes scoring the test files on snapshots of the models, while training goes on
+    """
+    def __init__(self, config, test_files, dataloader, max_entity_id):
+        """
+        The workers evaluate the merged test stream, so only the classification models without saved
+        predictions are supported, as for `DataUtility.get_merged_test_dataloader` in run_experiment
+        :param config: experiment config
+        :param test_files: list of test files
+        :param dataloader: merged test dataloader, whose precomputed batches are sent to the workers
+        :param max_entity_id: DataUtility.max_entity_id
+        """
+        if config.log.predictions or config.model.loss_type != 'classify':
+            raise NotImplementedError("async_test only supports the classify models, without log.predictions")
+        worker_config = Dict(config.to_dict())
+        # the logger is not shared with the workers
+        del worker_config.log['logger']
+        num_workers = config.log.async_test_workers if config.log.async_test_workers else 1
+        self.executor = ProcessPoolExecutor(max_workers=num_workers,
+                                            mp_context=multiprocessing.get_context('spawn'),
+                                            initializer=_init_worker,
+                                            initargs=(worker_config, test_files, dataloader.dataset.batches,
+                                                      max_entity_id))
+        self.pending = []
+
+    def submit(self, epoch, encoder, decoder):
+        """
+        Snapshot the models and queue their evaluation
+        :param epoch: epoch the snapshot belongs to
+        """
+        self.pending.append(self.executor.submit(_evaluate, epoch, _snapshot(encoder), _snapshot(decoder)))
+
+    def collect(self, wait=False):
+        """
+        :param wait: if True, wait for all the queued evaluations
+        :return: list of (epoch, dict of test file -> accuracy, dict of test file -> loss) of the finished
+            evaluations, by epoch
+        """
+        done = [f for f in self.pending if wait or f.done()]
+        self.pending = [f for f in self.pending if f not in done]
+        return sorted([f.result() for f in done], key=lambda r: r[0])
+
+    def close(self):
+        results = self.collect(wait=True)
+        self.executor.shutdown()
+        return results
@@ -7,18 +7,21 @@ import numpy as np
 
 from codes.utils.util import get_device_name
 from codes.net.net_registry import choose_model
-from codes.net.trainer import Trainer
+from codes.net.trainer import Trainer, inference_mode
 from codes.utils.data import DataUtility, generate_dictionary
 from codes.utils.log import write_metric_logs, write_config_log, write_metadata_logs, write_sequences
 from codes.metric.metric_registry import get_metric_dict
 from codes.metric.quality_metric import QualityMetric
+from codes.metric.device_metric import DeviceMetric
 from codes.net.generator import Generator
 from codes.utils.experiment_utils import Experiment
+from codes.utils.profiling import StartupProfiler
+from codes.experiment.async_eval import AsyncEvaluator
 import glob
 from io import BytesIO
 from zipfile import ZipFile
 from urllib.request import urlopen
-from codes.utils.bert_utils import BertLocalCache
+from codes.utils.bert_utils import get_bert_cache, BertFeatureStore
 import pdb
 import json
 import logging
@@ -45,33 +48,21 @@ def get_data(config):
         config.log.logger.info("Data present at {}".format(data_path))
 
 
-def run_experiment(config, exp, resume=False):
+def load_data_util(config, resume=False, profiler=None):
     """
-    Start or Resume an experiment
+    Download (if needed), process or load the data, and set the data dependent model config
     :param config:
-    :param exp:
     :param resume:
-    :return:
+    :param profiler: optional StartupProfiler timing the phases
+    :return: DataUtility, path of the data folder
     """
-    write_config_log(config)
-    log_base = config.general.base_path
-    logPath = os.path.join(log_base, 'logs')
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(levelname)s - %(message)s',
-        handlers=[
-            logging.FileHandler("{0}/{1}.log".format(logPath, config.general.id)),
-            logging.StreamHandler()
-        ]
-    )
-    logger = logging.getLogger()
-    config.log.logger = logger
-    experiment = Experiment(config)
+    if profiler is None:
+        profiler = StartupProfiler()
     parent_dir = os.path.abspath(os.pardir).split('/codes')[0]
     # get data
-    get_data(config)
+    with profiler.phase('get_data'):
+        get_data(config)
     base_path = os.path.join(parent_dir, 'data', config.dataset.data_path)
-    exp.log_dataset_info(config.dataset.data_path)
     data_config = json.load(open(os.path.join(base_path, 'config.json')))
     # get the list of files in base path
     train_files = glob.glob(os.path.join(base_path, "*_train.csv"))
@@ -83,16 +74,18 @@ def run_experiment(config, exp, resume=False):
     assert len(test_files) == len(data_config['test_tasks'])
     config.dataset.test_files = test_files
     # generate dictionary
-    generate_dictionary(config)
+    with profiler.phase('generate_dictionary'):
+        generate_dictionary(config)
     data_util = DataUtility(config)
     data_base_path = os.path.join(parent_dir, 'data', config.dataset.data_path)
     data_pkl_path = os.path.join(data_base_path, config.dataset.save_path)
-    if config.dataset.load_save_path or config.general.mode == 'infer' or resume:
-        data_util.load(data_pkl_path)
-    else:
-        data_util.process_data(base_path,
-                               config.dataset.train_file, load_dictionary=True)
-        data_util.save(data_pkl_path)
+    with profiler.phase('process_data'):
+        if config.dataset.load_save_path or config.general.mode == 'infer' or resume:
+            data_util.load(data_pkl_path)
+        else:
+            data_util.process_data(base_path,
+                                   config.dataset.train_file, load_dictionary=True)
+            data_util.save(data_pkl_path)
 
     vocab_size = len(data_util.word2id)
     config.log.logger.info("Vocab Size : {}".format(vocab_size))
@@ -105,7 +98,8 @@ def run_experiment(config, exp, resume=False):
     config.model.classes = data_util.target_id2word
 
     config.log.logger.info("Loading testing data")
-    data_util.process_test_data(base_path, config.dataset.test_files)
+    with profiler.phase('process_test_data'):
+        data_util.process_test_data(base_path, config.dataset.test_files)
     config.model.max_word_length = data_util.max_word_length
     config.model.edge_types = len(data_util.unique_edge_dict)
     config.model.unique_nodes = len(data_util.unique_nodes)
@@ -113,39 +107,97 @@ def run_experiment(config, exp, resume=False):
     ## set the edge dimension w.r.t the edge encoder
     if config.model.encoder.bidirectional and config.model.graph.edge_embedding == 'lstm':
         config.model.graph.edge_dim = config.model.encoder.hidden_dim * 2
+    return data_util, data_base_path
+
+
+def run_experiment(config, exp, resume=False):
+    """
+    Start or Resume an experiment
+    :param config:
+    :param exp:
+    :param resume:
+    :return:
+    """
+    # time and memory of each phase until the first training step
+    profiler = StartupProfiler()
+    write_config_log(config)
+    log_base = config.general.base_path
+    logPath = os.path.join(log_base, 'logs')
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.FileHandler("{0}/{1}.log".format(logPath, config.general.id)),
+            logging.StreamHandler()
+        ]
+    )
+    logger = logging.getLogger()
+    config.log.logger = logger
+    experiment = Experiment(config)
+    exp.log_dataset_info(config.dataset.data_path)
+    data_util, data_base_path = load_data_util(config, resume=resume, profiler=profiler)
     device = torch.device(get_device_name(device_type=config.general.device))
+    if config.model.bert.quantize and device.type != 'cpu':
+        raise NotImplementedError("quantized BERT only runs on CPU, set general.device to cpu")
     experiment.config = config
     # precompute bert
-    # bert_cache = BertLocalCache(config)
+    # bert_cache = get_bert_cache(config, device)
     # if bert_cache.is_cache_present(data_base_path):
     #     bert_cache.load_cache(data_base_path)
     # else:
-    #     data_util.update_bert_cache(bert_cache)
+    #     data_util.update_bert_cache(bert_cache, data_base_path)
     #     bert_cache.save_cache(data_base_path)
 
     experiment.data_util = data_util
-    experiment.dataloaders.train = data_util.get_dataloader(mode='train')
-    experiment.dataloaders.val = data_util.get_dataloader(mode='val')
+    with profiler.phase('dataloader_train'):
+        experiment.dataloaders.train = data_util.get_dataloader(mode='train')
+    with profiler.phase('dataloader_val'):
+        experiment.dataloaders.val = data_util.get_dataloader(mode='val')
     experiment.dataloaders.test = {}
+    # all the test files in one stream, evaluated in a single pass
+    merged_test = not config.log.predictions and config.model.loss_type == 'classify'
     for test_file in sorted(config.dataset.test_files):
         test_rel = int(test_file.split('_test.csv')[0].split('.')[-1])
-        experiment.dataloaders.test[test_file] = { 'dl': data_util.get_dataloader(mode='test',
-            test_file=test_file), 'test_rel': test_rel}
+        if merged_test:
+            # only the merged dataloader is evaluated, so the rows are prepared once, in it
+            experiment.dataloaders.test[test_file] = {'dl': None, 'test_rel': test_rel}
+            continue
+        with profiler.phase('dataloader_test_{}'.format(test_file.split('/')[-1])):
+            experiment.dataloaders.test[test_file] = { 'dl': data_util.get_dataloader(mode='test',
+                test_file=test_file), 'test_rel': test_rel}
         print("created dataloader for file {}".format(test_file))
-    experiment.model.encoder, experiment.model.decoder = choose_model(config)
-    experiment.model.encoder = experiment.model.encoder.to(device)
-    experiment.model.decoder = experiment.model.decoder.to(device)
+    if merged_test:
+        eval_batch_size = config.model.eval_batch_size
+        if not eval_batch_size:
+            eval_batch_size = config.model.batch_size * 4
+        with profiler.phase('dataloader_test_merged'):
+            experiment.dataloaders.test_merged = data_util.get_merged_test_dataloader(
+                list(experiment.dataloaders.test.keys()), batch_size=eval_batch_size)
+    feature_store = None
+    if config.model.bert.feature_store:
+        # run the frozen BERT once over all the stories, and let the encoder read its outputs,
+        # so that it does not load the BERT weights
+        with profiler.phase('bert_feature_store'):
+            feature_store = BertFeatureStore(config)
+            data_util.update_bert_feature_store(feature_store, data_base_path, device)
+    experiment.model.encoder, experiment.model.decoder = choose_model(config, profiler=profiler,
+                                                                      feature_store=feature_store)
+    with profiler.phase('model_to_device'):
+        experiment.model.encoder = experiment.model.encoder.to(device)
+        experiment.model.decoder = experiment.model.decoder.to(device)
     print(experiment.model)
-    experiment.trainer = Trainer(
-        config.model, experiment.model.encoder,
-        experiment.model.decoder,
-        max_entity_id=data_util.max_entity_id)
+    with profiler.phase('trainer'):
+        experiment.trainer = Trainer(
+            config.model, experiment.model.encoder,
+            experiment.model.decoder,
+            max_entity_id=data_util.max_entity_id)
 
     experiment.optimizers, experiment.schedulers = experiment.trainer.get_optimizers()
     if resume or config.general.mode == 'infer':
         # resume an old experiment
         config.log.logger.info("Loading model parameters")
-        experiment.load_checkpoint(exp.id)
+        with profiler.phase('load_checkpoint'):
+            experiment.load_checkpoint(exp.id)
     # set device
     experiment.device = device
     experiment.validation_metrics = get_metric_dict(time_span=20)
@@ -160,6 +212,12 @@ def run_experiment(config, exp, resume=False):
         experiment.iteration_index.val = 0
         experiment.iteration_index.test = 0
     experiment.comet_ml = exp
+    if config.general.mode == 'train' and config.log.test_each_epoch and config.log.async_test:
+        # score the test files of each epoch in background processes
+        experiment.async_evaluator = AsyncEvaluator(config, list(experiment.dataloaders.test.keys()),
+                                                    experiment.dataloaders.test_merged,
+                                                    max_entity_id=data_util.max_entity_id)
+    write_startup_report(experiment, profiler)
 
     if config.general.mode == 'train':
         _run_epochs(experiment)
@@ -190,9 +248,18 @@ def _run_epochs(experiment):
         if config.model.persist_per_epoch > 0 and experiment.epoch_index % config.model.persist_per_epoch == 0:
             experiment.model.save_model(epochs=experiment.epoch_index, optimizers=experiment.optimizers)
         if experiment.config.log.test_each_epoch:
-            _run_one_epoch_test(experiment)
+            if experiment.async_evaluator is not None:
+                experiment.async_evaluator.submit(experiment.epoch_index, experiment.model.encoder,
+                                                  experiment.model.decoder)
+                _log_async_test(experiment, experiment.async_evaluator.collect())
+            else:
+                _run_one_epoch_test(experiment)
     else:
+        if experiment.async_evaluator is not None:
+            _log_async_test(experiment, experiment.async_evaluator.close())
         test_accs = _run_one_epoch_test(experiment)
+        if config.log.precision_report:
+            write_precision_report(experiment, test_accs)
         best_epoch_index = experiment.epoch_index - validation_metrics_dict[metric_to_perform_early_stopping].counter
         write_metadata_logs(best_epoch_index=best_epoch_index)
         experiment.config.log.logger.info("Best performing model corresponds to epoch id {}".format(best_epoch_index))
@@ -205,6 +272,61 @@ def _run_epochs(experiment):
 
 
 
+def write_startup_report(experiment, profiler):
+    """
+    Save the time and memory of the startup phases of the run, to compare the runs of a sweep
+    with `codes/startup_report.py`
+    :param experiment:
+    :param profiler: StartupProfiler
+    :return:
+    """
+    config = experiment.config
+    # the runs of a sweep share the config id, so the dataset and the mode are part of the file name
+    data_key = os.path.basename(os.path.normpath(config.dataset.data_path))
+    path = os.path.join(config.general.base_path, 'logs', '{}_{}_{}_startup.json'.format(
+        config.general.id, data_key, config.general.mode))
+    report = profiler.save(path,
+                           config_id=config.general.id,
+                           data=config.dataset.data_path,
+                           encoder=config.model.encoder.name,
+                           decoder=config.model.decoder.name,
+                           mode=config.general.mode,
+                           device=str(experiment.device),
+                           num_test_files=len(config.dataset.test_files))
+    config.log.logger.info("Startup took {:.1f}s, peak memory {:.0f} MB. Saved startup report at {}".format(
+        report['total_time'], report['peak_rss_mb'], path))
+
+
+def write_precision_report(experiment, test_accs):
+    """
+    Save the training throughput and the accuracies of the run, to compare the precisions of
+    the same config with `codes/precision_report.py`
+    :param experiment:
+    :param test_accs: list of (test file, accuracy)
+    :return:
+    """
+    config = experiment.config
+    precision = config.model.precision if config.model.precision else 'fp32'
+    report = {
+        'config_id': config.general.id,
+        'precision': precision,
+        'data': config.dataset.data_path,
+        'device': str(experiment.device),
+        'train_examples': experiment.train_examples,
+        'train_time': experiment.train_time,
+        'train_stories_per_sec': experiment.train_examples / max(experiment.train_time, 1e-9),
+        'best_val_acc': float(experiment.validation_metrics['val_acc'].get_best_so_far()),
+        'test_acc': {t[0]: float(t[1]) for t in test_accs},
+        'mean_test_acc': float(np.mean([t[1] for t in test_accs])) if len(test_accs) > 0 else 0.0,
+    }
+    # the runs of a sweep share the config id, so the dataset is part of the file name
+    data_key = os.path.basename(os.path.normpath(config.dataset.data_path))
+    path = os.path.join(config.general.base_path, 'logs',
+                        '{}_{}_{}_precision.json'.format(config.general.id, data_key, precision))
+    json.dump(report, open(path, 'w'), indent=2)
+    config.log.logger.info("Saved precision report at {}".format(path))
+
+
 def _run_one_epoch_train_val(experiment):
     train_loss, train_acc, val_acc, val_loss = 0,0,0,0
     if (experiment.dataloaders.train):
@@ -224,12 +346,22 @@ def _run_one_epoch_test(experiment):
     print(experiment.dataloaders.test)
     if len(experiment.dataloaders.test) > 0:
         with experiment.comet_ml.test():
+            merged_accs = None
+            if experiment.dataloaders.test_merged:
+                merged_accs, _ = _run_merged_test(experiment.dataloaders.test_merged, experiment,
+                                                  list(experiment.dataloaders.test.keys()))
             for test_file, dlo in experiment.dataloaders.test.items():
                 dataloader = dlo['dl']
                 test_rel = dlo['test_rel']
                 test_fl_name = test_file.split('/')[-1]
-                _, acc = _run_one_epoch(dataloader, experiment, mode="test",
-                                        filename=test_file)
+                if merged_accs is not None:
+                    acc = merged_accs[test_file]
+                elif experiment.config.model.loss_type == 'seq2seq':
+                    # decode with the beam search (greedy for a beam of 1) and score the hypotheses
+                    acc = _run_one_epoch_decode(dataloader, experiment, mode="test", filename=test_file)
+                else:
+                    acc = _run_one_epoch_eval(dataloader, experiment, mode="test",
+                                              filename=test_file)
                 epoch = experiment.epoch_index
                 # last epoch
                 if epoch == (experiment.config.model.num_epochs + 1):
@@ -246,6 +378,173 @@ def _run_one_epoch_test(experiment):
 
 
 
+def _log_eval(experiment, mode, filename, loss, accuracy, epoch=None):
+    if epoch is None:
+        epoch = experiment.epoch_index
+    base_file = filename.split('/')[-1]
+    experiment.config.log.logger.info(" -------------------------- ")
+    experiment.config.log.logger.info("togrep_{} ; {} ; Epoch : {} ; Data : {} ; File : {} ; Loss : {} ; Accuracy : {}".format(
+        mode, experiment.config.general.id, epoch, experiment.config.dataset.data_path, filename,
+        loss, accuracy))
+    experiment.comet_ml.log_metric("{}_loss".format(base_file), loss, step=epoch)
+    experiment.comet_ml.log_metric("{}_accuracy".format(base_file), accuracy, step=epoch)
+
+
+def _log_async_test(experiment, results):
+    """
+    Log the accuracies computed by the AsyncEvaluator, at the epoch of their snapshot
+    :param results: list of (epoch, dict of test file -> accuracy, dict of test file -> loss)
+    """
+    if len(results) == 0:
+        return
+    with experiment.comet_ml.test():
+        for epoch, accs, losses in results:
+            for test_file, acc in accs.items():
+                _log_eval(experiment, 'test', test_file, losses[test_file], acc, epoch=epoch)
+                experiment.comet_ml.log_metric("test_acc_{}".format(test_file.split('/')[-1]), acc, step=epoch)
+
+
+def _run_merged_test(dataloader, experiment, test_files, mode='test'):
+    """
+    Evaluate all the test files in one pass over their merged stream, and split the accuracy and
+    the loss per file with the `file_ids` of the batches
+    :param dataloader: merged test dataloader
+    :param test_files: list of test files, in the order of the file ids
+    :return: dict of test file -> accuracy, dict of test file -> loss
+    """
+    trainer = experiment.trainer
+    trainer.eval()
+    num_files = len(test_files)
+    correct = torch.zeros(num_files, dtype=torch.long, device=experiment.device)
+    totals = torch.zeros(num_files, dtype=torch.long, device=experiment.device)
+    loss_sums = torch.zeros(num_files, dtype=torch.double, device=experiment.device)
+
+    for batch_idx, batch in enumerate(dataloader):
+        experiment.iteration_index[mode] += 1
+        batch.config = experiment.config
+        batch.to_device(experiment.device)
+
+        logits = trainer.predict(batch)
+        hits = (logits.argmax(dim=1) == batch.target.squeeze(1)).long()
+        correct.index_add_(0, batch.file_ids, hits)
+        totals.index_add_(0, batch.file_ids, torch.ones_like(hits))
+        loss_sums.index_add_(0, batch.file_ids, trainer.example_losses(logits, batch).double())
+
+    accuracies, losses = torch.stack([correct.double(), loss_sums]).div(totals.clamp(min=1).double()).tolist()
+    merged_accs, merged_losses = {}, {}
+    for test_file, acc, loss in zip(test_files, accuracies, losses):
+        _log_eval(experiment, mode, test_file, loss, acc)
+        merged_accs[test_file] = acc
+        merged_losses[test_file] = loss
+    return merged_accs, merged_losses
+
+
+def _run_one_epoch_eval(dataloader, experiment, mode='test', filename=''):
+    """
+    Inference only epoch: the accuracy and the loss are accumulated on the device from the logits,
+    with a single host sync at the end. The inputs are converted back to text only when the predictions
+    are saved (log.predictions).
+    :return: accuracy
+    """
+    trainer = experiment.trainer
+    trainer.eval()
+    save_predictions = mode == 'test' and experiment.config.log.predictions
+    correct = torch.zeros((), dtype=torch.long, device=experiment.device)
+    loss_sum = torch.zeros((), dtype=torch.double, device=experiment.device)
+    num_examples = 0
+    batches = []
+    predictions = []
+    confidences = []
+
+    for batch_idx, batch in enumerate(dataloader):
+        experiment.iteration_index[mode] += 1
+        batch.config = experiment.config
+        batch.to_device(experiment.device)
+
+        logits = trainer.predict(batch)
+        pred = logits.argmax(dim=1)
+        correct += (pred == batch.target.squeeze(1)).sum()
+        loss_sum += trainer.example_losses(logits, batch).double().sum()
+        num_examples += batch.batch_size
+        if save_predictions:
+            batches.append(batch)
+            predictions.append(pred)
+            confidences.append(torch.softmax(logits, dim=1))
+
+    correct, loss_sum = torch.stack([correct.double(), loss_sum]).tolist()
+    epoch_rel = correct / max(num_examples, 1)
+    _log_eval(experiment, mode, filename, loss_sum / max(num_examples, 1), epoch_rel)
+
+    if save_predictions:
+        # save predicted examples
+        true_inp, true_outp, pred_outp = [], [], []
+        for batch, pred in zip(batches, predictions):
+            batch = experiment.generator.process_batch(batch, pred, beam=False)
+            true_inp.extend([' '.join(sent) for sent in batch.true_inp])
+            true_outp.extend([' '.join(sent) for sent in batch.true_outp])
+            pred_outp.extend([' '.join(sent) for sent in batch.pred_outp])
+        confidences = torch.cat(confidences, dim=0).cpu().numpy()
+        write_sequences(true_inp, true_outp, pred_outp, mode, experiment.epoch_index,
+                        exp_name=experiment.config.general.id, test_fl=filename, conf=confidences,
+                        classes=experiment.config.model.classes)
+
+    return epoch_rel
+
+
+def _run_one_epoch_decode(dataloader, experiment, mode='test', filename=''):
+    """
+    Inference only epoch of the seq2seq models: the stories are decoded with
+    `Generator.beam_process_batch`, which decodes greedily when `model.beam.beam_size` is 1, and the
+    top hypotheses are scored against the target text. The relation overlap is reported as accuracy, and
+    the loss is the one of the teacher forced decoder, as in training.
+    :return: accuracy
+    """
+    trainer = experiment.trainer
+    trainer.eval()
+    generator = experiment.generator
+    save_predictions = mode == 'test' and experiment.config.log.predictions
+    sequence_scores = None
+    loss_sum = torch.zeros((), dtype=torch.double, device=experiment.device)
+    num_examples = 0
+    true_inp, true_outp, pred_outp, confidences = [], [], [], []
+
+    for batch_idx, batch in enumerate(dataloader):
+        experiment.iteration_index[mode] += 1
+        batch.config = experiment.config
+        batch.to_device(experiment.device)
+        # outside inference mode, as the embedding weights are written
+        trainer.update_entity_embeddings()
+        with inference_mode():
+            results = generator.beam_process_batch(batch, max_length=experiment.config.model.beam.max_length,
+                                                   n_best=1)
+            with trainer.autocast():
+                logits = trainer.forward(batch)
+            loss_sum += trainer.example_losses(logits.float(), batch).double().sum()
+        hypotheses = results.predictions[:, 0]
+        target = batch.text_target[:, 1:]
+        scores = experiment.quality_metrics.sequence_scores(hypotheses, target) * batch.batch_size
+        sequence_scores = scores if sequence_scores is None else sequence_scores + scores
+        num_examples += batch.batch_size
+        if save_predictions:
+            inp = batch.inp.view(batch.batch_size, -1)
+            true_inp.extend([' '.join(sent) for sent in generator._convert_mat_to_text(inp)])
+            true_outp.extend([' '.join(sent) for sent in generator._convert_mat_to_text(target)])
+            pred_outp.extend([' '.join(sent) for sent in generator._convert_mat_to_text(hypotheses)])
+            confidences.extend(results.scores.exp().tolist())
+
+    entity_overlap, epoch_rel, bleu, loss = (torch.cat([sequence_scores.double(), loss_sum.view(1)])
+                                             / max(num_examples, 1)).tolist()
+    experiment.comet_ml.log_metric("{}_entity_overlap".format(mode), entity_overlap, step=experiment.epoch_index)
+    experiment.comet_ml.log_metric("{}_bleu".format(mode), bleu, step=experiment.epoch_index)
+    _log_eval(experiment, mode, filename, loss, epoch_rel)
+
+    if save_predictions:
+        write_sequences(true_inp, true_outp, pred_outp, mode, experiment.epoch_index,
+                        exp_name=experiment.config.general.id, test_fl=filename, conf=confidences,
+                        classes=experiment.config.model.classes)
+    return epoch_rel
+
+
 def _run_one_epoch(dataloader, experiment, mode, filename=''):
     trainer = experiment.trainer
     optimizers = experiment.optimizers
@@ -258,18 +557,19 @@ def _run_one_epoch(dataloader, experiment, mode, filename=''):
     else:
         trainer.eval()
 
-    aggregated_batch_loss = 0
-    num_examples = 0
-
-    true_inp = []
-    true_outp = []
-    pred_outp = []
-    epoch_rel = []
-    confidences = []
+    # loss, accuracy and confusion matrix stay on the device until the end of the epoch
+    metrics = DeviceMetric(experiment.config.model.target_size, experiment.device)
+    # text of the inputs and predictions, only decoded when they are written
+    save_predictions = mode == 'test' and experiment.config.log.predictions
+    prediction_batches = []
+    # entity overlap, relation overlap and BLEU sums of the teacher forced predictions (seq2seq)
+    sequence_scores = None
 
-    log_batch_losses = []
-    log_batch_rel = []
     batch_size = len(dataloader)
+    # sync for the batch loss only `log.logs_per_epoch` times per epoch
+    logs_per_epoch = experiment.config.log.logs_per_epoch
+    log_every = max(1, batch_size // logs_per_epoch) if logs_per_epoch else 1
+    start_time = time()
 
     for batch_idx, batch in enumerate(dataloader):
         experiment.iteration_index[mode] += 1
@@ -283,36 +583,35 @@ def _run_one_epoch(dataloader, experiment, mode, filename=''):
 
         outputs, loss, conf = trainer.batchLoss(batch)
 
-        batch_loss = loss.item()
         if (should_train):
-            loss.backward()
-            clip = experiment.config.model.optimiser.clip
-            if clip > 0:
-                torch.nn.utils.clip_grad_norm_(experiment.model.encoder.parameters(), clip)
-                torch.nn.utils.clip_grad_norm_(experiment.model.decoder.parameters(), clip)
-            for optimizer in optimizers:
-                optimizer.step()
-        aggregated_batch_loss += (batch_loss * batch.batch_size)
-
-        num_examples += batch.batch_size
-        log_batch_losses.append(batch_loss)
-        step = (experiment.epoch_index-1)*batch_size + batch_idx
-        experiment.comet_ml.log_metric("loss", batch_loss, step=step)
-
-        batch = experiment.generator.process_batch(batch, outputs, beam=False)
-        true_inp.extend(batch.true_inp)
-        true_outp.extend(batch.true_outp)
-        pred_outp.extend(batch.pred_outp)
-        confidences.extend(conf.detach().cpu().numpy())
-
-        accuracy = experiment.quality_metrics.relation_overlap(batch.pred_outp, batch.true_outp)
-        log_batch_rel.append(accuracy)
-        epoch_rel.append(accuracy)
+            trainer.backward(loss, optimizers, clip=experiment.config.model.optimiser.clip)
+        if outputs.dim() > 1:
+            # teacher forced predictions of the seq2seq decoder, scored against the target text
+            # without its start token
+            scores = experiment.quality_metrics.sequence_scores(outputs, batch.text_target[:, 1:]) * batch.batch_size
+            sequence_scores = scores if sequence_scores is None else sequence_scores + scores
+            metrics.update_loss(loss, batch.batch_size)
+        else:
+            metrics.update(loss, outputs, batch.target)
+
+        if batch_idx % log_every == 0:
+            step = (experiment.epoch_index-1)*batch_size + batch_idx
+            experiment.comet_ml.log_metric("loss", loss.item(), step=step)
+
+        if save_predictions:
+            prediction_batches.append((batch, outputs, conf.detach()))
 
         del batch
 
-    loss = aggregated_batch_loss / num_examples
-    epoch_rel = np.mean(epoch_rel)
+    if should_train:
+        experiment.train_time += time() - start_time
+        experiment.train_examples += metrics.num_examples
+    loss, epoch_rel, confusion = metrics.result()
+    experiment.confusion_matrices[mode] = confusion
+    if sequence_scores is not None:
+        entity_overlap, epoch_rel, bleu = (sequence_scores / metrics.num_examples).tolist()
+        experiment.comet_ml.log_metric("{}_entity_overlap".format(mode), entity_overlap, step=experiment.epoch_index)
+        experiment.comet_ml.log_metric("{}_bleu".format(mode), bleu, step=experiment.epoch_index)
     base_file = filename.split('/')[-1]
     # if mode == 'val':
     #     experiment.validation_metrics['val_acc'].update(epoch_rel)
@@ -325,11 +624,21 @@ def _run_one_epoch(dataloader, experiment, mode, filename=''):
     experiment.comet_ml.log_metric("{}_loss".format(base_file), loss, step=experiment.epoch_index)
     experiment.comet_ml.log_metric("{}_accuracy".format(base_file), epoch_rel, step=experiment.epoch_index)
 
-    if mode == 'test' and experiment.config.log.predictions:
+    if hasattr(trainer.encoder_model, 'timing_report'):
+        iteration_times = trainer.encoder_model.timing_report()
+        if len(iteration_times) > 0:
+            experiment.config.log.logger.info("Mode : {} ; Mean time per iteration (ms) : {}".format(
+                mode, ', '.join(['{:.3f}'.format(t) for t in iteration_times])))
+
+    if save_predictions:
         # save predicted examples
-        true_inp = [' '.join(sent) for sent in true_inp]
-        true_outp = [' '.join(sent) for sent in true_outp]
-        pred_outp = [' '.join(sent) for sent in pred_outp]
+        true_inp, true_outp, pred_outp = [], [], []
+        for batch, outputs, conf in prediction_batches:
+            batch = experiment.generator.process_batch(batch, outputs, beam=False)
+            true_inp.extend([' '.join(sent) for sent in batch.true_inp])
+            true_outp.extend([' '.join(sent) for sent in batch.true_outp])
+            pred_outp.extend([' '.join(sent) for sent in batch.pred_outp])
+        confidences = torch.cat([conf for _, _, conf in prediction_batches], dim=0).cpu().numpy()
         assert len(true_inp) == len(true_outp) == len(pred_outp)
         write_sequences(true_inp, true_outp, pred_outp, mode, experiment.epoch_index,
                         exp_name=experiment.config.general.id, test_fl=filename, conf=confidences, classes=experiment.config.model.classes)
@@ -0,0 +1,66 @@
+# Check the batched QualityMetric implementations against the original ones on random sequences
+import argparse
+import random
+
+import numpy as np
+import torch
+from addict import Dict
+
+from codes.metric.quality_metric import QualityMetric
+
+
+def random_rows(num_rows, max_len, vocab_size):
+    return [[random.randint(1, vocab_size - 1) for _ in range(random.randint(1, max_len))] for _ in range(num_rows)]
+
+
+def pad(rows, max_len):
+    out = torch.zeros(len(rows), max_len).long()
+    for idx, row in enumerate(rows):
+        out[idx, :len(row)] = torch.LongTensor(row)
+    return out
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_rows", default=256, type=int, help='number of random sequences')
+    parser.add_argument("--max_len", default=12, type=int, help='max sequence length')
+    parser.add_argument("--vocab_size", default=30, type=int, help='vocabulary size, small to get n-gram matches')
+    parser.add_argument("--seed", default=0, type=int)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    random.seed(args.seed)
+    data = Dict()
+    data.entity_ids = list(range(1, 11))
+    data.id2word = {i: 'w{}'.format(i) for i in range(args.vocab_size)}
+    data.target_id2word = dict(data.id2word)
+    metric = QualityMetric(data)
+    to_words = lambda rows: [[data.id2word[w] for w in row] for row in rows]
+
+    prediction = random_rows(args.num_rows, args.max_len, args.vocab_size)
+    # hypotheses sharing part of the predictions, so that all n-gram orders have matches
+    hypothesis = [p[:random.randint(1, len(p))] + r for p, r in
+                  zip(prediction, random_rows(args.num_rows, args.max_len // 2, args.vocab_size))]
+    pred_ids = pad(prediction, args.max_len)
+    hyp_ids = pad(hypothesis, max(len(h) for h in hypothesis))
+
+    checks = [
+        ('entity_overlap', metric.entity_overlap(to_words(prediction), to_words(hypothesis)),
+         metric.entity_overlap_ids(pred_ids, hyp_ids).item()),
+        ('relation_overlap', metric.relation_overlap(to_words(prediction), to_words(hypothesis)),
+         metric.relation_overlap_ids(pred_ids, hyp_ids, pad_id=0).item()),
+        ('relation_overlap (classes)', metric.relation_overlap([[p[0]] for p in prediction], [[h[0]] for h in hypothesis]),
+         metric.relation_overlap_ids(pred_ids[:, 0], hyp_ids[:, :1]).item()),
+        ('batch_bleu', metric.batch_bleu(to_words(prediction), to_words(hypothesis)),
+         metric.bleu_ids(pred_ids, hyp_ids).item()),
+    ]
+    failed = False
+    for name, expected, value in checks:
+        ok = np.isclose(expected, value, atol=1e-5)
+        failed = failed or not ok
+        print("{:<28} original : {:.6f} ; batched : {:.6f} ; {}".format(name, expected, value, 'ok' if ok else 'MISMATCH'))
+    if failed:
+        raise AssertionError("Batched QualityMetric differs from the original one")
+    print("Check done")
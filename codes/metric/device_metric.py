@@ -0,0 +1,58 @@
+import torch
+
+
+class DeviceMetric():
+    """Accumulates the metrics of an epoch as tensors on the device, with a single host sync at the end.
+    The loss and the accuracy are averaged over the examples of the epoch. Before, the epoch metrics were
+    the mean of the batch means, which weighs the examples of the smaller batches more (the last batch of
+    each file, or the batches of `bert.max_tokens`), so the values of older logs can differ slightly."""
+
+    def __init__(self, num_classes, device):
+        """
+        Args:
+            num_classes: int, number of target classes, size of the confusion matrix
+            device: device of the model outputs
+        """
+        self.num_classes = num_classes
+        self.device = device
+        self.reset()
+
+    def reset(self):
+        """Method to reset the accumulated values"""
+        self.loss_sum = torch.zeros((), device=self.device)
+        self.correct = torch.zeros((), dtype=torch.long, device=self.device)
+        # rows are the targets, columns the predictions
+        self.confusion = torch.zeros(self.num_classes * self.num_classes, dtype=torch.long, device=self.device)
+        self.num_examples = 0
+
+    def update(self, loss, predictions, targets):
+        """Add a batch, without syncing with the host
+        Args:
+            loss: scalar tensor, mean loss of the batch
+            predictions: (B) predicted classes
+            targets: (B) or (B x 1) true classes
+        """
+        targets = targets.view(-1)
+        self.update_loss(loss, targets.size(0))
+        self.correct += (predictions == targets).sum()
+        self.confusion += torch.bincount(targets * self.num_classes + predictions,
+                                         minlength=self.num_classes * self.num_classes)
+
+    def update_loss(self, loss, batch_size):
+        """Add the loss of a batch only, when the predictions are not classes
+        Args:
+            loss: scalar tensor, mean loss of the batch
+            batch_size: int
+        """
+        self.loss_sum += loss.detach().float() * batch_size
+        self.num_examples += batch_size
+
+    def result(self):
+        """Sync once with the host
+        Returns:
+            mean loss, accuracy, both per example, confusion matrix (num_classes x num_classes numpy array)
+        """
+        num_examples = max(self.num_examples, 1)
+        loss_sum, correct = torch.stack([self.loss_sum.double(), self.correct.double()]).tolist()
+        confusion = self.confusion.view(self.num_classes, self.num_classes).cpu().numpy()
+        return loss_sum / num_examples, correct / num_examples, confusion
@@ -1,5 +1,5 @@
-from nltk.translate.bleu_score import sentence_bleu
 import numpy as np
+import torch
 import os
 import json
 
@@ -10,6 +10,12 @@ class QualityMetric:
         self.data = data
         self.entity_ids = data.entity_ids
         self.entity_words = [data.id2word[e] for e in self.entity_ids]
+        # size of the word vocabulary, also the base of the n-gram hashes in bleu_ids
+        self.vocab_size = max(data.id2word.keys()) + 1
+        self.target_vocab_size = max(data.target_id2word.keys()) + 1
+        # the sequences can hold words of both vocabularies
+        self.is_entity = torch.zeros(self.vocab_size, dtype=torch.uint8)
+        self.is_entity[torch.LongTensor(list(self.entity_ids))] = 1
 
     def entity_overlap(self, prediction, hypothesis):
         """
@@ -51,9 +57,118 @@ class QualityMetric:
         :param hypothesis:
         :return:
         """
+        from nltk.translate.bleu_score import sentence_bleu
         b_n = []
         for idx, pred in enumerate(prediction):
             b_n.append(sentence_bleu([hypothesis[idx]], pred))
         return np.mean(b_n)
 
+    # Batched versions, on padded id tensors (B x t), which keep the results on the device
 
+    def _presence(self, ids, vocab_size, pad_id=None):
+        """
+        Set of ids of each row as a one-hot mask
+        :return: B x vocab_size uint8 mask
+        """
+        presence = torch.zeros(ids.size(0), vocab_size, device=ids.device).scatter_(1, ids, 1.0).byte()
+        if pad_id is not None:
+            presence[:, pad_id] = 0
+        return presence
+
+    def entity_overlap_ids(self, prediction, hypothesis):
+        """
+        Batched entity_overlap
+        :param prediction: B x t word ids
+        :param hypothesis: B x t word ids
+        :return: mean score, 0-dim tensor
+        """
+        is_entity = self.is_entity.to(prediction.device).unsqueeze(0)
+        pred_ents = self._presence(prediction, self.vocab_size) * is_entity
+        hyp_ents = self._presence(hypothesis, self.vocab_size) * is_entity
+        num_hyp = hyp_ents.sum(1).float()
+        com_ent = (pred_ents * hyp_ents).sum(1).float()
+        score = torch.where(num_hyp > 0, com_ent / num_hyp.clamp(min=1), torch.zeros_like(num_hyp))
+        return score.mean()
+
+    def relation_overlap_ids(self, prediction, hypothesis, pad_id=None):
+        """
+        Batched relation_overlap
+        :param prediction: B predicted classes, or B x t target word ids
+        :param hypothesis: B / B x 1 true classes, or B x t target word ids
+        :param pad_id: id to leave out of the sets of the sequences
+        :return: mean score, 0-dim tensor
+        """
+        if prediction.dim() == 1:
+            return (prediction == hypothesis.view(-1)).float().mean()
+        vocab_size = max(self.vocab_size, self.target_vocab_size)
+        pred_rel = self._presence(prediction, vocab_size, pad_id)
+        hyp_rel = self._presence(hypothesis, vocab_size, pad_id)
+        corr_rel = (pred_rel * hyp_rel).sum(1).float()
+        return (corr_rel / hyp_rel.sum(1).clamp(min=1).float()).mean()
+
+    def _ngrams(self, ids, lengths, n):
+        """
+        The n-grams are kept as n columns and compared column-wise, as packing them in one integer
+        overflows for the large vocabularies
+        :return: B x (t - n + 1) x n word ids of the n-grams, and the mask of the ones inside the lengths
+        """
+        num_grams = max(ids.size(1) - n + 1, 0)
+        grams = torch.stack([ids[:, k:k + num_grams].long() for k in range(n)], dim=2)
+        positions = torch.arange(num_grams, device=ids.device).unsqueeze(0)
+        valid = (positions + n) <= lengths.unsqueeze(1)
+        return grams, valid
+
+    def _same_ngrams(self, grams_a, grams_b):
+        """
+        :return: B x G_a x G_b mask of the equal n-grams
+        """
+        return (grams_a.unsqueeze(2) == grams_b.unsqueeze(1)).all(-1)
+
+    def bleu_ids(self, prediction, hypothesis, max_order=4, pad_id=0, corpus=False):
+        """
+        Batched BLEU over n-gram counts, with the hypothesis as the single reference, as in batch_bleu.
+        As with NLTK without smoothing, a sentence with no match for some order scores 0.
+        :param prediction: B x t word ids, padded with pad_id
+        :param hypothesis: B x t word ids, padded with pad_id
+        :param corpus: if True, corpus BLEU over the batch, else the mean sentence BLEU
+        :return: 0-dim tensor
+        """
+        pred_len = (prediction != pad_id).sum(1)
+        hyp_len = (hypothesis != pad_id).sum(1)
+        matches = []
+        totals = []
+        for n in range(1, max_order + 1):
+            pred_grams, pred_valid = self._ngrams(prediction, pred_len, n)
+            hyp_grams, hyp_valid = self._ngrams(hypothesis, hyp_len, n)
+            # occurrences of each n-gram of the prediction, in the prediction and in the hypothesis
+            pred_count = (self._same_ngrams(pred_grams, pred_grams) & pred_valid.unsqueeze(1)).sum(2)
+            hyp_count = (self._same_ngrams(pred_grams, hyp_grams) & hyp_valid.unsqueeze(1)).sum(2)
+            # each of the c occurrences of an n-gram adds min(c, r) / c, so the n-gram adds its clipped count
+            clipped = torch.min(pred_count, hyp_count).float() / pred_count.clamp(min=1).float()
+            matches.append((clipped * pred_valid.float()).sum(1))
+            totals.append(pred_valid.float().sum(1))
+        matches = torch.stack(matches, dim=1)
+        totals = torch.stack(totals, dim=1)
+        pred_len = pred_len.float()
+        hyp_len = hyp_len.float()
+        if corpus:
+            matches = matches.sum(0, keepdim=True)
+            totals = totals.sum(0, keepdim=True)
+            pred_len = pred_len.sum(0, keepdim=True)
+            hyp_len = hyp_len.sum(0, keepdim=True)
+        precision = matches / totals.clamp(min=1)
+        log_precision = torch.log(precision.clamp(min=1e-30)).mean(1)
+        brevity_penalty = torch.where(pred_len > hyp_len, torch.ones_like(pred_len),
+                                      torch.exp(1 - hyp_len / pred_len.clamp(min=1)))
+        score = brevity_penalty * torch.exp(log_precision)
+        score = torch.where((matches > 0).all(1) & (pred_len > 0), score, torch.zeros_like(score))
+        return score.mean()
+
+    def sequence_scores(self, prediction, hypothesis, pad_id=0):
+        """
+        Entity overlap, relation overlap and BLEU of a batch of generated sequences
+        :return: tensor of the 3 scores, on the device
+        """
+        return torch.stack([self.entity_overlap_ids(prediction, hypothesis),
+                            self.relation_overlap_ids(prediction, hypothesis, pad_id=pad_id),
+                            self.bleu_ids(prediction, hypothesis, pad_id=pad_id)])
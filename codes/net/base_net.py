@@ -1,3 +1,4 @@
+import math
 import os
 import random
 from time import time
@@ -33,6 +34,8 @@ class Net(nn.Module):
         ## to be set by trainer
         self.max_entity_id = 0
         self.random_weights = None
+        self.entity_rows = None
+        self.entity_grad_hook = None
 
         # flag for graph mode
         self.graph_mode = False
@@ -220,12 +223,52 @@ class Net(nn.Module):
         """
         Randomize the entity embeddings.
         At each epoch, randomize the entity embeddings
-        :param fixed: if True, then re-use the old random weights
+        Outside graph mode only the entity rows (1 .. max_entity_id, or 0 .. max_entity_id without padding)
+        are drawn again, the rest of the vocabulary is never touched.
+        :param fixed: if True, then re-use the old random weights. The entity rows are then written
+            only once, their gradients are zeroed and they are restored after each optimizer step
+            (`restore_fixed_entity_embeddings`), so that they stay fixed
         :return:
         """
         if self.one_hot:
             if not self.graph_mode:
                 raise NotImplementedError("one hot mode only for graph")
+        if self.graph_mode:
+            self._randomize_graph_embeddings(fixed=fixed)
+            return
+        assert self.max_entity_id > 0
+        if not fixed or self.random_weights is None:
+            vocab_size, dim = self.embedding.weight.size()
+            # same distribution as xavier_uniform_ over the whole vocabulary
+            bound = math.sqrt(6.0 / (vocab_size + dim))
+            self.entity_rows = slice(0 if not padding else 1, self.max_entity_id + 1)
+            with torch.no_grad():
+                entity_weights = self.embedding.weight[self.entity_rows]
+                entity_weights.uniform_(-bound, bound)
+            self.random_weights = entity_weights.clone().detach()
+        if fixed and self.entity_grad_hook is None:
+            self.entity_grad_hook = self.embedding.weight.register_hook(self._zero_entity_grad)
+
+    def restore_fixed_entity_embeddings(self):
+        """
+        Write the fixed entity rows back after an optimizer step, as the weight decay and the momentum
+        still move them with a zero gradient
+        """
+        if self.graph_mode or self.entity_grad_hook is None:
+            return
+        with torch.no_grad():
+            self.embedding.weight[self.entity_rows] = self.random_weights
+
+    def _zero_entity_grad(self, grad):
+        grad = grad.clone()
+        grad[self.entity_rows] = 0
+        return grad
+
+    def _randomize_graph_embeddings(self, fixed=False):
+        """
+        In graph mode, all the rows are nodes, randomize the full matrix
+        :param fixed: if True, then re-use the old random weights
+        """
         with torch.no_grad():
             vocab_size = self.embedding.weight.size(0)
             if self.one_hot:
@@ -235,24 +278,7 @@ class Net(nn.Module):
             else:
                 random_weights = torch.nn.init.xavier_uniform_(torch.zeros(
                     self.embedding.weight.size()).to(self.embedding.weight.device))
-            if not self.graph_mode:
-                ids = torch.arange(0, vocab_size)
-                assert self.max_entity_id > 0
-                mask = self.get_entity_mask(ids, self.max_entity_id)
-                mask = mask.unsqueeze(1)
-                entity_mask = (1 - mask)
-                # check for padding
-                if padding:
-                    entity_mask[0].fill_(0.0)
-                # randomly assign the weights
-                idx = torch.randperm(random_weights.nelement()).to(random_weights.device)
-                random_weights = random_weights.view(-1)[idx].view(random_weights.size())
-                self.embedding.weight.mul_(mask)
-                self.embedding.weight.add_(random_weights.mul_(entity_mask))
-            else:
-                idx = torch.randperm(random_weights.nelement()).to(random_weights.device)
-                random_weights = random_weights.view(-1)[idx].view(random_weights.size())
-                self.embedding.weight = nn.Parameter(random_weights)
+            idx = torch.randperm(random_weights.nelement()).to(random_weights.device)
+            random_weights = random_weights.view(-1)[idx].view(random_weights.size())
+            self.embedding.weight = nn.Parameter(random_weights)
             self.random_weights = random_weights.clone().detach()
-
-
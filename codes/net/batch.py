@@ -33,6 +33,10 @@ class Batch:
             bert_inp = None,            # tensor B x s, right now this contains the entity ids to be used with bert lstm
             bert_input_mask=None,       # input mask, 1 for words and 0 for padding
             bert_segment_ids=None,      # segment id, unique for each sentence
+            row_ids=None,               # ids of the stories in the batch, (B)
+            inp_perm=None,              # LengthPermutation of inp_lengths, computed once per batch
+            sent_perm=None,             # LengthPermutation of the flattened sent_lengths, (B x s)
+            file_ids=None,              # index of the test file of each story in a merged test stream, (B)
             ):
 
         """
@@ -54,6 +58,10 @@ class Batch:
         :param config:                  main config file
         :param orig_inp:                Unmodified input
         :param inp_row_pos:             position over input text (B x s x w)
+        :param row_ids:                 ids of the stories in the batch
+        :param inp_perm:                LengthPermutation of inp_lengths
+        :param sent_perm:               LengthPermutation of the flattened sent_lengths
+        :param file_ids:                index of the test file of each story in a merged test stream
         """
 
         self.inp = inp
@@ -87,6 +95,12 @@ class Batch:
         self.bert_inp = bert_inp
         self.bert_input_mask = bert_input_mask
         self.bert_segment_ids = bert_segment_ids
+        self.row_ids = row_ids
+        self.inp_perm = inp_perm
+        self.sent_perm = sent_perm
+        self.file_ids = file_ids
+        # keys of the stories in the BertFeatureStore, set by its first lookup
+        self.feature_keys = None
 
     def to_device(self, device):
         self.inp = self.inp.to(device)
@@ -113,6 +127,20 @@ class Batch:
             self.bert_input_mask = self.bert_input_mask.to(device)
         if self.bert_segment_ids is not None:
             self.bert_segment_ids = self.bert_segment_ids.to(device)
+        if self.inp_perm is not None:
+            self.inp_perm.to_device(device)
+        if self.sent_perm is not None:
+            self.sent_perm.to_device(device)
+        if self.file_ids is not None:
+            self.file_ids = self.file_ids.to(device)
+
+    def lengths_tensor(self, device):
+        """
+        inp_lengths as a (B,) long tensor on device
+        """
+        if self.inp_perm is None:
+            self.inp_perm = LengthPermutation(self.inp_lengths)
+        return self.inp_perm.to_device(device).lengths
 
     def _process_adj_mat(self):
         """
@@ -151,9 +179,40 @@ class Batch:
                      query_edge=self.query_edge.clone().detach(),
                      bert_inp=self.bert_inp.clone().detach(), # right now this contains the entity ids to be used with bert lstm
                      bert_input_mask=self.bert_input_mask.clone().detach(),
-                     bert_segment_ids=self.bert_segment_ids.clone().detach()
+                     bert_segment_ids=self.bert_segment_ids.clone().detach(),
+                     row_ids=self.row_ids,
+                     inp_perm=self.inp_perm,
+                     sent_perm=self.sent_perm,
+                     file_ids=self.file_ids
                      )
 
 
+class LengthPermutation:
+    """
+    Descending sort permutation of the lengths of a batch of sequences, as needed by
+    pack_padded_sequence. Computed once per batch, and moved to the device with it, so the
+    encoders do not sort on the host at every forward pass
+    """
+    def __init__(self, lengths):
+        """
+        :param lengths: list of sequence lengths, or (B,) long tensor
+        """
+        if not torch.is_tensor(lengths):
+            lengths = torch.LongTensor([int(l) for l in lengths])
+        # sorted_lengths always stays on cpu, as pack_padded_sequence expects
+        self.sorted_lengths, self.idx_sort = lengths.sort(descending=True)
+        self.idx_unsort = torch.empty_like(self.idx_sort)
+        self.idx_unsort[self.idx_sort] = torch.arange(lengths.size(0))
+        # empty sequences are at the end after sorting
+        self.num_nonzero = int((lengths > 0).sum())
+        self.lengths = lengths
+
+    def to_device(self, device):
+        self.idx_sort = self.idx_sort.to(device)
+        self.idx_unsort = self.idx_unsort.to(device)
+        self.lengths = self.lengths.to(device)
+        return self
+
+
 
 
@@ -0,0 +1,96 @@
+# Compiled execution of an encoder-decoder pair
+import logging
+import torch
+import torch.nn as nn
+from addict import Dict
+
+# tensor fields of Batch which the encoders and decoders read, in the order of TensorForward.forward
+TENSOR_FIELDS = ['inp', 's_inp', 'query', 'query_mask', 'inp_ent_mask', 'query_edge',
+                 'bert_inp', 'bert_input_mask', 'bert_segment_ids']
+
+
+def batch_tensors(batch):
+    return tuple(getattr(batch, field) for field in TENSOR_FIELDS)
+
+
+class TensorForward(nn.Module):
+    """
+    Encoder-decoder pair behind a tensor-only forward signature, returning the logits.
+    The tensor fields of the batch are positional arguments, while the remaining fields are read from
+    `self.context`, set by `run`:
+        - inp_lengths, inp_perm: the LSTM encoders and the masks of the decoders
+        - sent_lengths, sent_perm: the sentence level encoders (relation networks)
+        - geo_batch: the graph models, which are never compiled (see Trainer)
+        - config
+    torch.compile guards on the Python values of the context, eg the number of non empty stories of a
+    LengthPermutation, so a batch changing them is recompiled rather than run with stale values.
+    Used as is in eager mode, or through `compile_forward`.
+    """
+    def __init__(self, encoder_model, decoder_model):
+        super().__init__()
+        self.encoder_model = encoder_model
+        self.decoder_model = decoder_model
+        self.context = None
+
+    def forward(self, inp, s_inp, query, query_mask, inp_ent_mask, query_edge,
+                bert_inp, bert_input_mask, bert_segment_ids):
+        batch = self.context
+        batch.inp = inp
+        batch.s_inp = s_inp
+        batch.query = query
+        batch.query_mask = query_mask
+        batch.inp_ent_mask = inp_ent_mask
+        batch.query_edge = query_edge
+        batch.bert_inp = bert_inp
+        batch.bert_input_mask = bert_input_mask
+        batch.bert_segment_ids = bert_segment_ids
+        # run the encoder
+        encoder_outputs, encoder_hidden = self.encoder_model(batch)
+        batch.encoder_outputs = encoder_outputs
+        batch.encoder_hidden = encoder_hidden
+        batch.encoder_model = self.encoder_model
+
+        query_rep = self.decoder_model.calculate_query(batch)  # query representation or question representation
+
+        # batch.outp should be B x 1
+        step_batch = Dict()
+        step_batch.query_rep = query_rep
+        logits, attn, hidden_rep = self.decoder_model(batch, step_batch)
+        return logits
+
+    def run(self, batch, forward_fn=None):
+        """
+        :param batch: Batch
+        :param forward_fn: compiled version of this module, if any
+        :return: logits
+        """
+        self.context = batch
+        try:
+            if forward_fn is None:
+                return self(*batch_tensors(batch))
+            return forward_fn(*batch_tensors(batch))
+        finally:
+            self.context = None
+
+
+def compile_errors():
+    """
+    :return: tuple of the exceptions raised when torch.compile cannot capture or compile a model
+    """
+    try:
+        from torch._dynamo.exc import TorchDynamoException
+    except ImportError:
+        return ()
+    return (TorchDynamoException,)
+
+
+def compile_forward(tensor_forward):
+    """
+    Capture the tensor-only forward with torch.compile
+    :param tensor_forward: TensorForward
+    :return: compiled callable, or None if this version of torch cannot compile
+    """
+    if not hasattr(torch, 'compile'):
+        logging.warning("torch.compile is not available in torch {}, running in eager mode".format(torch.__version__))
+        return None
+    return torch.compile(tensor_forward, dynamic=True)
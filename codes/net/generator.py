@@ -1,5 +1,6 @@
 # Beam Generator class
 import torch
+import torch.nn.functional as F
 from addict import Dict
 
 from codes.utils.data import START_TOKEN, END_TOKEN
@@ -29,159 +30,176 @@ class Generator:
                                        config.model.beam.coverage_penalty,
                                        config.model.beam.length_penalty)
 
-    def beam_process_batch(self, batch, max_length, min_length=0, n_best=1,
-                           return_attention=False):
+    def beam_process_batch(self, batch, max_length, min_length=0, n_best=1):
         """
-        Wrapper around Beam Search
-        heavily borrowed from https://github.com/OpenNMT/OpenNMT-py/blob/master/onmt/translate/translator.py#L316
-        :return:
+        Vectorized beam search with the step API of the seq2seq decoder (`decode_step`).
+        The beams of all the stories run as one (B * beam_size) batch, the finished hypotheses are kept
+        in preallocated tensors, and the stories whose search is over are dropped from the active batch,
+        which is then trimmed to its longest story. The active tensors are only reordered when that happens.
+        With a beam of 1 and a single hypothesis, the greedy decoding of `greedy_process_batch` is used instead.
+        :param batch: Batch
+        :param max_length: max number of generated words
+        :param min_length: min number of generated words before the end token is allowed
+        :param n_best: number of hypotheses kept per story
+        :return: Dict with
+            - predictions: B x n_best x max_length word ids, without the start token, padded with 0
+            - scores: B x n_best length normalized log probabilities
         """
-
+        if self.beam_size == 1 and n_best == 1:
+            return self.greedy_process_batch(batch, max_length, min_length=min_length)
         beam_size = self.beam_size
         batch_size = batch.batch_size
         vocab = self.data.word2id
         start_token = vocab[START_TOKEN]
         end_token = vocab[END_TOKEN]
+        alpha = self.scorer.alpha
 
         # Encoder forward
-        inp, inp_lengths = batch.inp, batch.inp_lengths
-        inp_lengths = torch.LongTensor(inp_lengths).to(batch.inp.device)
-        encoder_outputs, encoder_hidden = self.encoder_model(inp, inp_lengths)
-        decoder_states = self.decoder_model.calculate_hidden(
-            batch.batch_size, encoder_outputs, encoder_hidden, batch.outp_ents)
+        encoder_outputs, encoder_hidden = self.encoder_model(batch)
+        batch.encoder_outputs = encoder_outputs
+        batch.encoder_hidden = encoder_hidden
+        batch.encoder_model = self.encoder_model
+        query_rep = self.decoder_model.calculate_query(batch)
+        encoder_mask = self.decoder_model.encoder_mask(batch, encoder_outputs)
+        hidden_rep = self.decoder_model.init_hidden(encoder_outputs, batch_size)
+        device = encoder_outputs.device
 
         # Tile states and memory beam_size times
-        # multiply the batches
-        dec_h, dec_c = decoder_states
-        dec_h = tile(dec_h, beam_size, dim=1)
-        dec_c = tile(dec_c, beam_size, dim=1)
-        decoder_states = (dec_h, dec_c)
         encoder_outputs = tile(encoder_outputs, beam_size, dim=0)
-        inp_lengths = tile(inp_lengths, beam_size, dim=0)
-
-        batch_offset = torch.arange(
-            batch_size, dtype=torch.long, device=encoder_outputs.device)
-        beam_offset = torch.arange(
-            0,
-            batch_size * beam_size,
-            step = beam_size,
-            dtype = torch.long,
-            device = encoder_outputs.device)
-
-        alive_seq = torch.full(
-            [batch_size * beam_size, 1],
-            start_token,
-            dtype=torch.long,
-            device=encoder_outputs.device)
-
-        alive_attn = None
-
+        encoder_mask = tile(encoder_mask, beam_size, dim=0)
+        query_rep = tile(query_rep, beam_size, dim=0)
+        hidden_rep = tuple(tile(h, beam_size, dim=1) for h in hidden_rep)
+
+        # stories still searched, as indices in the batch
+        active = torch.arange(batch_size, dtype=torch.long, device=device)
+        alive_seq = torch.zeros(batch_size * beam_size, max_length + 1, dtype=torch.long, device=device)
+        alive_seq[:, 0] = start_token
         # Give full probability to the first beam on the first step.
-        topk_log_probs = (
-            torch.tensor([0.0] + [float("-inf")] * (beam_size - 1),
-                         device=encoder_outputs.device).repeat(batch_size))
-
-        results = Dict()
-        results.predictions = [[] for _ in range(batch_size)]  # noqa: F812
-        results.scores = [[] for _ in range(batch_size)]  # noqa: F812
-        results.attention = [[] for _ in range(batch_size)]  # noqa: F812
-        results.gold_score = [0] * batch_size
-        results.batch = batch
-
-        max_length += 1
+        beam_scores = torch.tensor([0.0] + [float("-inf")] * (beam_size - 1), device=device).repeat(batch_size, 1)
+        finished_seq = torch.zeros(batch_size, n_best, max_length + 1, dtype=torch.long, device=device)
+        finished_scores = torch.full((batch_size, n_best), float("-inf"), device=device)
+        num_finished = torch.zeros(batch_size, dtype=torch.long, device=device)
 
         for step in range(max_length):
-            decoder_input = alive_seq[:, -1].view(-1, 1) # Batch x Seq
-
-            # Decoder forward
-            log_probs, attn, dec_states = self.decoder_model(
-                decoder_input,
-                decoder_states,
-                encoder_outputs=encoder_outputs,
-                encoder_lengths=inp_lengths)
+            num_active = active.size(0)
+            log_probs, hidden_rep, _ = self.decoder_model.decode_step(
+                alive_seq[:, step:step + 1], hidden_rep, query_rep, encoder_outputs, encoder_mask)
             vocab_size = log_probs.size(-1)
-            log_probs = log_probs.squeeze(1) # B x vocab
-
             if step < min_length:
                 log_probs[:, end_token] = -1e20
 
-            # Multiply probs by the beam probability.
-            log_probs += topk_log_probs.view(-1).unsqueeze(1)
-
-            alpha = self.scorer.alpha
+            # Multiply probs by the beam probability, and flatten the beams of each story.
+            log_probs = log_probs + beam_scores.view(-1, 1)
             length_penalty = ((5.0 + (step + 1)) / 6.0) ** alpha
-
-            # Flatten probs into a list of possibilities.
-            curr_scores = log_probs / length_penalty
-            curr_scores = curr_scores.reshape(-1, beam_size * vocab_size)
+            curr_scores = (log_probs / length_penalty).view(num_active, beam_size * vocab_size)
             topk_scores, topk_ids = curr_scores.topk(beam_size, dim=-1)
 
-            # Recover log probs.
-            topk_log_probs = topk_scores * length_penalty
+            # Resolve beam origin and true word ids, and move the beams to their origin
+            topk_beam_index = topk_ids // vocab_size
+            topk_words = topk_ids % vocab_size
+            select = (topk_beam_index + torch.arange(num_active, device=device).unsqueeze(1) * beam_size).view(-1)
+            alive_seq = alive_seq.index_select(0, select)
+            alive_seq[:, step + 1] = topk_words.view(-1)
+            hidden_rep = tuple(h.index_select(1, select) for h in hidden_rep)
+
+            # Keep the n_best ended hypotheses of each story among the old and the new ones
+            is_end = topk_words.eq(end_token)
+            if step + 1 == max_length:
+                is_end.fill_(1)
+            ended_scores = topk_scores.masked_fill(~is_end, float("-inf"))
+            pool_scores = torch.cat([finished_scores[active], ended_scores], 1)
+            pool_seq = torch.cat([finished_seq[active], alive_seq.view(num_active, beam_size, -1)], 1)
+            best_scores, best_idx = pool_scores.topk(n_best, dim=1)
+            finished_scores[active] = best_scores
+            finished_seq[active] = pool_seq.gather(1, best_idx.unsqueeze(2).expand(-1, -1, pool_seq.size(2)))
+            num_finished[active] += is_end.sum(1)
+
+            # the ended beams do not continue
+            beam_scores = (topk_scores * length_penalty).masked_fill(is_end, float("-inf"))
+
+            # a story is done when its top beam ended (or no beam is left) and it has n_best hypotheses
+            done = (is_end[:, 0] | torch.isinf(beam_scores[:, 0])) & (num_finished[active] >= n_best)
+            num_done = int(done.sum())
+            if num_done == num_active:
+                break
+            if num_done > 0:
+                keep = (~done).nonzero().view(-1)
+                active = active.index_select(0, keep)
+                beam_keep = (keep.unsqueeze(1) * beam_size + torch.arange(beam_size, device=device)).view(-1)
+                # trim the memory to the longest remaining story
+                max_len = int(encoder_mask.index_select(0, beam_keep).sum(1).max())
+                encoder_outputs = encoder_outputs.index_select(0, beam_keep)[:, :max_len]
+                encoder_mask = encoder_mask.index_select(0, beam_keep)[:, :max_len]
+                query_rep = query_rep.index_select(0, beam_keep)
+                alive_seq = alive_seq.index_select(0, beam_keep)
+                hidden_rep = tuple(h.index_select(1, beam_keep) for h in hidden_rep)
+                beam_scores = beam_scores.index_select(0, keep)
+
+        results = Dict()
+        # clear the words after the end token
+        predictions = finished_seq[:, :, 1:]
+        after_end = predictions.eq(end_token).long().cumsum(-1) - predictions.eq(end_token).long()
+        results.predictions = predictions.masked_fill(after_end > 0, 0)
+        results.scores = finished_scores
+        results.batch = batch
+        return results
 
-            # Resolve beam origin and true word ids.
-            topk_beam_index = topk_ids.div(vocab_size)
-            topk_ids = topk_ids.fmod(vocab_size)
+    def greedy_process_batch(self, batch, max_length, min_length=0):
+        """
+        Greedy decoding over the cached decoder state (`init_decode_state` / `decode_cached` of the
+        seq2seq decoder). The rows which emitted the end token are dropped from the active batch.
+        Returns the same predictions and scores as `beam_process_batch` with a beam of 1, which dispatches here.
+        :param batch: Batch
+        :param max_length: max number of generated words
+        :param min_length: min number of generated words before the end token is allowed
+        :return: Dict with
+            - predictions: B x 1 x max_length word ids, padded with 0
+            - scores: B x 1 length normalized log probabilities, with the length penalty of the beam search
+            - lengths: B, number of generated words including the end token
+        """
+        batch_size = batch.batch_size
+        vocab = self.data.word2id
+        end_token = vocab[END_TOKEN]
 
-            # Map beam_index to batch_index in the flat representation.
-            batch_index = (
-                    topk_beam_index
-                    + beam_offset[:topk_beam_index.size(0)].unsqueeze(1))
+        # Encoder forward
+        encoder_outputs, encoder_hidden = self.encoder_model(batch)
+        batch.encoder_outputs = encoder_outputs
+        batch.encoder_hidden = encoder_hidden
+        batch.encoder_model = self.encoder_model
+        query_rep = self.decoder_model.calculate_query(batch)
+        encoder_mask = self.decoder_model.encoder_mask(batch, encoder_outputs)
+        state = self.decoder_model.init_decode_state(encoder_outputs, encoder_mask, query_rep)
+        device = encoder_outputs.device
+
+        active = torch.arange(batch_size, dtype=torch.long, device=device)
+        predictions = torch.zeros(batch_size, max_length, dtype=torch.long, device=device)
+        lengths = torch.full((batch_size,), max_length, dtype=torch.long, device=device)
+        words = torch.full((batch_size,), vocab[START_TOKEN], dtype=torch.long, device=device)
+        log_probs = torch.zeros(batch_size, device=device)
 
-            # End condition is the top beam reached end_token.
-            end_condition = topk_ids[:, 0].eq(end_token)
-            if step + 1 == max_length:
-                end_condition.fill_(1)
-            finished = end_condition.nonzero().view(-1)
-
-            # Save result of finished sentences.
-            if len(finished) > 0:
-                predictions = alive_seq.view(beam_size, -1,  alive_seq.size(-1))
-                scores = topk_scores.view(-1, beam_size)
-                attention = None
-                if alive_attn is not None:
-                    attention = alive_attn.view(
-                        alive_attn.size(0), -1, beam_size, alive_attn.size(-1))
-                for i in finished:
-                    b = batch_offset[i]
-                    for n in range(n_best):
-                        results.predictions[b].append(predictions[n, i, 1:])
-                        results.scores[b].append(scores[i, n])
-                        if attention is None:
-                            results.attention[b].append([])
-                        else:
-                            results.attention[b].append(
-                                attention[:, i, n, :inp_lengths[i]])
-                non_finished = end_condition.eq(0).nonzero().view(-1)
-                # If all sentences are translated, no need to go further.
-                if len(non_finished) == 0:
+        for step in range(max_length):
+            logits = self.decoder_model.decode_cached(words.unsqueeze(1), state)
+            if step < min_length:
+                logits[:, end_token] = -1e20
+            word_log_probs, words = F.log_softmax(logits, dim=-1).max(-1)
+            log_probs[active] += word_log_probs
+            predictions[active, step] = words
+            ended = words.eq(end_token)
+            if ended.any():
+                lengths[active[ended]] = step + 1
+                keep = (~ended).nonzero().view(-1)
+                if keep.numel() == 0:
                     break
-                # Remove finished batches for the next step.
-                topk_log_probs = topk_log_probs.index_select(
-                    0, non_finished.to(topk_log_probs.device))
-                topk_ids = topk_ids.index_select(0, non_finished)
-                batch_index = batch_index.index_select(0, non_finished)
-                batch_offset = batch_offset.index_select(0, non_finished)
-
-            # Select and reorder alive batches.
-            select_indices = batch_index.view(-1)
-            alive_seq = alive_seq.index_select(0, select_indices)
-            encoder_outputs = encoder_outputs.index_select(0, select_indices)
-            inp_lengths = inp_lengths.index_select(0, select_indices)
-            decoder_states = map_batch_fn(decoder_states,
-                lambda state, dim: state.index_select(dim, select_indices))
-
-            # Append last prediction.
-            alive_seq = torch.cat([alive_seq, topk_ids.view(-1, 1)], -1)
-
-            if return_attention:
-                current_attn = attn["std"].index_select(1, select_indices)
-                if alive_attn is None:
-                    alive_attn = current_attn
-                else:
-                    alive_attn = alive_attn.index_select(1, select_indices)
-                    alive_attn = torch.cat([alive_attn, current_attn], 0)
+                active = active.index_select(0, keep)
+                words = words.index_select(0, keep)
+                state = self.decoder_model.select_decode_state(state, keep)
 
+        results = Dict()
+        results.predictions = predictions.unsqueeze(1)
+        length_penalty = ((5.0 + lengths.float()) / 6.0) ** self.scorer.alpha
+        results.scores = (log_probs / length_penalty).unsqueeze(1)
+        results.lengths = lengths
+        results.batch = batch
         return results
 
     def process_batch(self, batch, predictions=None, mode='train', beam=False):
@@ -191,13 +209,15 @@ class Generator:
         :param beam: if True, use beam search, else use the trainer
         :return:
         """
+        target = True
         if beam:
             beam_results = self.beam_process_batch(batch,
                         max_length=self.config.model.beam.max_length,
                         n_best=self.config.model.beam.n_best)
-            predictions = beam_results.predictions
             # select the top prediction only for now
-            predictions = [row[0] for row in predictions]
+            predictions = beam_results.predictions[:, 0]
+            # generated text is in the word vocabulary
+            target = False
         else:
             assert predictions is not None
         predictions = predictions.tolist()
@@ -209,7 +229,7 @@ class Generator:
         inp = inp.view(batch.batch_size, -1)
         batch.true_inp = self._convert_mat_to_text(inp)
         batch.true_outp = self._convert_mat_to_text(batch.target, target=True)
-        batch.pred_outp = self._convert_mat_to_text(predictions, target=True)
+        batch.pred_outp = self._convert_mat_to_text(predictions, target=target)
         return batch
 
     def _convert_mat_to_text(self, tensor, target=False):
@@ -230,10 +250,3 @@ class Generator:
         if target:
             id2word = self.data.target_id2word
         return [[id2word[int(w)]] if int(w) in id2word else "<s>" for w in tlist]
-
-
-
-
-def map_batch_fn(hidden, fn):
-    hidden = tuple(map(lambda x: fn(x, 1), hidden))
-    return hidden
\ No newline at end of file
@@ -0,0 +1,133 @@
+# Micro-batching of single stories for inference
+import logging
+import queue
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+
+from codes.utils.data import DataRow
+
+# put in the queue to stop the batching thread
+_STOP = object()
+
+
+class MicroBatcher:
+    """
+    Collects single stories from many producers and runs them in batches, on a background thread.
+    A batch is flushed when it holds `max_batch_size` stories, or `max_wait_ms` after its first story.
+    The stories are collated with `DataUtility.precompute_batches`, as in the dataloaders.
+    """
+    def __init__(self, data_util, predict_fn, max_batch_size=32, max_wait_ms=5.0, on_batch=None):
+        """
+        :param data_util: DataUtility of the dataset of the model
+        :param predict_fn: function of a Batch, returning one output per story, in the order of the batch
+        :param max_batch_size: max number of stories per batch
+        :param max_wait_ms: max wait for a batch to fill up, after its first story
+        :param on_batch: optional function called with the size of each flushed batch
+        """
+        self.data_util = data_util
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.on_batch = on_batch
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, item):
+        """
+        :param item: DataRow processed by `DataUtility.prepare_for_dataloader`, or a dict with
+        `story` and `query` as in the data files, see `DataUtility.process_stories`
+        :return: Future of the output of the story
+        """
+        future = Future()
+        self.queue.put((item, future))
+        return future
+
+    def submit_many(self, items):
+        return [self.submit(item) for item in items]
+
+    def close(self):
+        """
+        Flush the queued stories and stop the batching thread
+        """
+        self.queue.put(_STOP)
+        self.thread.join()
+
+    def _loop(self):
+        stop = False
+        while not stop:
+            item = self.queue.get()
+            if item is _STOP:
+                break
+            pending = [item]
+            deadline = time.perf_counter() + self.max_wait
+            while len(pending) < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stop = True
+                    break
+                pending.append(item)
+            self._flush(pending)
+
+    def _flush(self, pending):
+        # skip the cancelled requests
+        pending = [(item, future) for item, future in pending if future.set_running_or_notify_cancel()]
+        if len(pending) == 0:
+            return
+        # a story which cannot be processed only fails its own request
+        rows, futures = [], []
+        for item, future in pending:
+            try:
+                rows.append(self._prepare(item))
+            except Exception as e:
+                logging.exception("Story could not be processed")
+                future.set_exception(e)
+                continue
+            futures.append(future)
+        if len(rows) == 0:
+            return
+        if self.on_batch is not None:
+            self.on_batch(len(rows))
+        try:
+            for batch in self._collate(rows):
+                outputs = self.predict_fn(batch)
+                # the row ids of the collated batch are the positions of the stories
+                for position, output in zip(batch.row_ids, outputs):
+                    futures[position].set_result(output)
+        except Exception as e:
+            logging.exception("Micro-batch of {} stories failed".format(len(rows)))
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+
+    def _prepare(self, item):
+        """
+        :param item: DataRow or dict
+        :return: DataRow processed by `DataUtility.prepare_for_dataloader`
+        """
+        if not isinstance(item, dict):
+            return item
+        # a story the model cannot run fails here, rather than the forward pass of the whole batch
+        self.data_util.check_story(item)
+        # unique id, as the rows are indexed by id while processing
+        return self.data_util.process_stories([dict(item, id=uuid.uuid4().hex)])[0]
+
+    def _collate(self, rows):
+        """
+        :param rows: processed DataRows
+        :return: list of Batch, with the position of each story as its row id
+        """
+        batch_rows = []
+        for position, dataRow in enumerate(rows):
+            row = DataRow()
+            row.pattrs = dataRow.pattrs[:-1] + [position]
+            batch_rows.append(row)
+        return self.data_util.precompute_batches(batch_rows, batch_size=len(batch_rows))
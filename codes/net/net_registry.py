@@ -2,6 +2,7 @@ import importlib
 from copy import deepcopy
 
 from codes.utils.config import get_config
+from codes.utils.profiling import StartupProfiler
 
 
 def prepare_config_for_model(config, num_nodes=0):
@@ -10,18 +11,36 @@ def prepare_config_for_model(config, num_nodes=0):
     return model_config
 
 
-def choose_model(config):
+def choose_model(config, profiler=None, feature_store=None):
     """
     Dynamically load both encoder and decoder
     :param config:
+    :param profiler: optional StartupProfiler, timing the import of the model modules and the
+    construction of the encoder (which loads the BERT weights) and of the decoder
+    :param feature_store: optional loaded BertFeatureStore, read by the BERT encoder instead of
+    running BERT, whose weights are then not loaded
     :return:
     """
+    if profiler is None:
+        profiler = StartupProfiler()
     model_config = prepare_config_for_model(config)
-    encoder_model_name = model_config.encoder.name
-    encoder_module = _import_module(encoder_model_name)
-    decoder_model_name = model_config.decoder.name
-    decoder_module = _import_module(decoder_model_name)
-    return encoder_module(model_config), decoder_module(model_config)
+    model_config.bert.stored_features = feature_store is not None
+    with profiler.phase('import_models'):
+        encoder_model_name = model_config.encoder.name
+        encoder_module = _import_module(encoder_model_name)
+        decoder_model_name = model_config.decoder.name
+        decoder_module = _import_module(decoder_model_name)
+    with profiler.phase('build_encoder'):
+        encoder = encoder_module(model_config)
+    with profiler.phase('build_decoder'):
+        decoder = decoder_module(model_config)
+    if model_config.bert.quantize:
+        if not hasattr(encoder, 'quantize'):
+            raise NotImplementedError("bert.quantize is only available for the BERT encoders")
+        encoder.quantize()
+    if feature_store is not None:
+        encoder.feature_store = feature_store
+    return encoder, decoder
 
 def _import_module(full_module_name):
     """
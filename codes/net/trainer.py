@@ -1,4 +1,5 @@
 # Trainer class to get the loss and predictions
+import contextlib
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -6,8 +7,16 @@ import torch.optim as optim
 import numpy as np
 from addict import Dict
 from codes.net.batch import Batch
+from codes.net.compiled import TensorForward, compile_errors, compile_forward
+import logging
 import pdb
 
+# torch.no_grad for the versions of torch without inference mode
+inference_mode = getattr(torch, 'inference_mode', torch.no_grad)
+
+# autocast dtype of each `model.precision`
+PRECISIONS = {'fp32': torch.float32, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
 class Trainer:
     def __init__(self, model_config, encoder_model, decoder_model,
                  max_entity_id=0):
@@ -38,11 +47,30 @@ class Trainer:
         loss_criteria = model_config.loss_criteria
         if loss_criteria == 'CE':
             self.criteria = nn.CrossEntropyLoss()
+            self.example_criteria = nn.CrossEntropyLoss(reduction='none')
         elif loss_criteria == 'NLL':
             self.criteria = nn.NLLLoss()
+            self.example_criteria = nn.NLLLoss(reduction='none')
         else:
             raise NotImplementedError("Provided loss criteria not implemented")
         self.tf_ratio = model_config.tf_ratio
+        # mixed precision: bf16 autocast (for CPU), or fp16 autocast with loss scaling (for GPU)
+        self.precision = model_config.precision if model_config.precision else 'fp32'
+        if self.precision not in PRECISIONS:
+            raise NotImplementedError("Provided precision not implemented")
+        self.scaler = None
+        if self.precision == 'fp16':
+            self.scaler = torch.cuda.amp.GradScaler()
+        # tensor-only forward of the encoder-decoder pair, compiled with `model.compile`
+        self.tensor_forward = TensorForward(encoder_model, decoder_model)
+        self.compiled_forward = None
+        self.compile_errors = ()
+        if model_config.compile and model_config.name == 'graph':
+            # the torch_geometric batch of the graph models cannot be captured
+            logging.warning("model.compile is not supported for the graph models, running in eager mode")
+        elif model_config.compile:
+            self.compiled_forward = compile_forward(self.tensor_forward)
+            self.compile_errors = compile_errors()
 
     def get_optimizers(self):
         '''Method to return the list of optimizers for the trainer'''
@@ -82,27 +110,19 @@ class Trainer:
         :param mode:
         :return:
         """
-        # choose a policy of invalidating entity embeddings here
-        if self.model_config.embedding.entity_embedding_policy == 'random':
-            # randomize the entity embeddings at each epoch
-            self.encoder_model.randomize_entity_embeddings(padding=self.padding)
-        if self.model_config.embedding.entity_embedding_policy == 'fixed':
-            # fix the random entity embeddings which were used before
-            self.encoder_model.randomize_entity_embeddings(fixed=True, padding=self.padding)
-
-        # run the encoder
-        encoder_outputs, encoder_hidden = self.encoder_model(batch)
-        batch.encoder_outputs = encoder_outputs
-        batch.encoder_hidden = encoder_hidden
-        batch.encoder_model = self.encoder_model
-
-        query_rep = self.decoder_model.calculate_query(batch)  # query representation or question representation
-        decoder_inp = None
+        self.update_entity_embeddings()
 
-        # batch.outp should be B x 1
-        step_batch = Dict()
-        step_batch.query_rep = query_rep
-        logits, attn, hidden_rep = self.decoder_model(batch, step_batch)
+        with self.autocast():
+            logits = self.forward(batch)
+        # loss and confidences in float32
+        logits = logits.float()
+        if self.model_config.loss_type == 'seq2seq' and logits.dim() > 2:
+            # B x steps x vocab against the target text without its start token
+            target = batch.text_target[:, 1:]
+            loss = F.cross_entropy(logits.reshape(-1, logits.size(-1)), target.reshape(-1), ignore_index=0)
+            probs = torch.exp(F.log_softmax(logits, dim=-1))
+            conf, decoder_outp = probs.max(-1)
+            return decoder_outp, loss, conf
         if logits.dim() > 2:
             logits = logits.squeeze(1)
         loss = self.criteria(logits, batch.target.squeeze(1))
@@ -116,6 +136,98 @@ class Trainer:
 
         return decoder_outp, loss, conf
 
+    def update_entity_embeddings(self):
+        # choose a policy of invalidating entity embeddings here
+        if self.model_config.embedding.entity_embedding_policy == 'random':
+            # randomize the entity embeddings at each epoch
+            self.encoder_model.randomize_entity_embeddings(padding=self.padding)
+        if self.model_config.embedding.entity_embedding_policy == 'fixed':
+            # fix the random entity embeddings which were used before
+            self.encoder_model.randomize_entity_embeddings(fixed=True, padding=self.padding)
+
+    def predict(self, batch: Batch):
+        """
+        Inference only forward pass: no loss, no confidences
+        :param batch:
+        :return: logits, B x num_classes
+        """
+        # outside inference mode, as the embedding weights are written
+        self.update_entity_embeddings()
+        with inference_mode(), self.autocast():
+            logits = self.forward(batch)
+        logits = logits.float()
+        if logits.dim() > 2:
+            logits = logits.squeeze(1)
+        return logits
+
+    def example_losses(self, logits, batch: Batch):
+        """
+        Loss of each example, for the inference only evaluations which do not go through batchLoss
+        :param logits: float logits of `predict`, B x num_classes, or B x steps x vocab for seq2seq
+        :return: (B) losses, the mean over the target words for seq2seq
+        """
+        if self.model_config.loss_type == 'seq2seq' and logits.dim() > 2:
+            target = batch.text_target[:, 1:]
+            losses = F.cross_entropy(logits.reshape(-1, logits.size(-1)), target.reshape(-1), ignore_index=0,
+                                     reduction='none').view(target.size())
+            return losses.sum(1) / target.ne(0).sum(1).clamp(min=1).float()
+        if logits.dim() > 2:
+            logits = logits.squeeze(1)
+        return self.example_criteria(logits, batch.target.squeeze(1))
+
+    def forward(self, batch: Batch):
+        """
+        Run the encoder and the decoder, compiled if possible
+        :param batch:
+        :return: logits
+        """
+        if self.compiled_forward is not None:
+            try:
+                return self.tensor_forward.run(batch, self.compiled_forward)
+            except self.compile_errors as e:
+                # this model cannot be captured, stay in eager mode from now on
+                logging.warning("Compiled forward of {} failed, falling back to eager mode : {}".format(
+                    type(self.encoder_model).__name__, e))
+                self.compiled_forward = None
+        return self.tensor_forward.run(batch)
+
+    def autocast(self):
+        """
+        Autocast context of the forward pass, on the device of the encoder
+        """
+        if self.precision == 'fp32':
+            return contextlib.nullcontext()
+        device_type = next(self.encoder_model.parameters()).device.type
+        return torch.autocast(device_type=device_type, dtype=PRECISIONS[self.precision])
+
+    def backward(self, loss, optimizers, clip=0):
+        """
+        Backward pass, gradient clipping and optimizer step, scaling the loss for fp16
+        :param loss:
+        :param optimizers:
+        :param clip: max gradient norm, 0 to disable
+        :return:
+        """
+        if self.scaler is not None:
+            self.scaler.scale(loss).backward()
+            if clip > 0:
+                for optimizer in optimizers:
+                    self.scaler.unscale_(optimizer)
+        else:
+            loss.backward()
+        if clip > 0:
+            torch.nn.utils.clip_grad_norm_(self.encoder_model.parameters(), clip)
+            torch.nn.utils.clip_grad_norm_(self.decoder_model.parameters(), clip)
+        for optimizer in optimizers:
+            if self.scaler is not None:
+                self.scaler.step(optimizer)
+            else:
+                optimizer.step()
+        if self.scaler is not None:
+            self.scaler.update()
+        if self.model_config.embedding.entity_embedding_policy == 'fixed':
+            self.encoder_model.restore_fixed_entity_embeddings()
+
     def train(self):
         self.encoder_model.train()
         self.decoder_model.train()
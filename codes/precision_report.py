@@ -0,0 +1,42 @@
+## Aggregate the precision reports of the runs (log.precision_report)
+## For each config and dataset, compare the throughput and accuracies of the mixed precision runs with the fp32 one
+
+import os
+import glob
+import json
+import argparse
+import pandas as pd
+
+base_path = os.path.dirname(os.path.realpath(__file__)).split('codes')[0]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Throughput vs accuracy delta of the mixed precision runs")
+    parser.add_argument('--log_dir', default=os.path.join(base_path, 'logs'), help='folder of the precision reports')
+    parser.add_argument('--output', default='', help='optional csv to save the comparison')
+    args = parser.parse_args()
+
+    reports = [json.load(open(fl)) for fl in glob.glob(os.path.join(args.log_dir, '*_precision.json'))]
+    print("Found {} reports".format(len(reports)))
+    # the runs of a sweep share the config id, so the baseline is the fp32 run on the same dataset
+    data_key = lambda r: os.path.basename(os.path.normpath(r['data']))
+    baselines = {(r['config_id'], data_key(r)): r for r in reports if r['precision'] == 'fp32'}
+    rows = []
+    for report in sorted(reports, key=lambda r: (r['config_id'], data_key(r), r['precision'])):
+        row = {
+            'config_id': report['config_id'],
+            'data': data_key(report),
+            'precision': report['precision'],
+            'stories_per_sec': report['train_stories_per_sec'],
+            'best_val_acc': report['best_val_acc'],
+            'mean_test_acc': report['mean_test_acc'],
+        }
+        baseline = baselines.get((report['config_id'], data_key(report)))
+        if baseline is not None:
+            row['speedup'] = report['train_stories_per_sec'] / baseline['train_stories_per_sec']
+            row['val_acc_delta'] = report['best_val_acc'] - baseline['best_val_acc']
+            row['test_acc_delta'] = report['mean_test_acc'] - baseline['mean_test_acc']
+        rows.append(row)
+    df = pd.DataFrame(rows)
+    print(df.to_string(index=False))
+    if len(args.output) > 0:
+        df.to_csv(args.output, index=False)
@@ -0,0 +1,58 @@
+## Aggregate the startup reports of the runs (logs/<id>_<data>_<mode>_startup.json, written by run_experiment)
+## One row per run with the total startup time, the peak memory of the process and the time of each phase,
+## and the runs whose startup is much slower than the median of the sweep
+
+import os
+import glob
+import json
+import argparse
+import pandas as pd
+
+base_path = os.path.dirname(os.path.realpath(__file__)).split('codes')[0]
+
+
+def phase_group(phase):
+    # one column for all the test dataloaders
+    return 'dataloader_test' if phase.startswith('dataloader_test_') and phase != 'dataloader_test_merged' else phase
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Startup time and memory of the runs of a sweep")
+    parser.add_argument('--log_dir', default=os.path.join(base_path, 'logs'), help='folder of the startup reports')
+    parser.add_argument('--group_by', default='', help='optional column to average on, eg data or config_id')
+    parser.add_argument('--outlier_factor', type=float, default=2.0, help='flag the runs slower than this times the median')
+    parser.add_argument('--output', default='', help='optional csv to save the table')
+    args = parser.parse_args()
+
+    reports = [json.load(open(fl)) for fl in glob.glob(os.path.join(args.log_dir, '*_startup.json'))]
+    print("Found {} reports".format(len(reports)))
+    if len(reports) == 0:
+        exit(0)
+    rows = []
+    for report in reports:
+        row = {
+            'config_id': report['config_id'],
+            'data': os.path.basename(os.path.normpath(report['data'])),
+            'mode': report.get('mode', ''),
+            'encoder': report['encoder'].split('.')[-1],
+            'total_time': report['total_time'],
+            'peak_rss_mb': report['peak_rss_mb'],
+        }
+        for phase in report['phases']:
+            column = phase_group(phase['phase'])
+            row[column] = row.get(column, 0.0) + phase['time']
+        slowest = max(report['phases'], key=lambda p: p['time'])
+        row['slowest_phase'] = slowest['phase']
+        rows.append(row)
+    df = pd.DataFrame(rows).sort_values('total_time', ascending=False)
+    median = df['total_time'].median()
+    df['outlier'] = df['total_time'] > args.outlier_factor * median
+    outliers = (df[df['outlier']]['config_id'].astype(str) + ' (' + df[df['outlier']]['data'] + ')').tolist()
+    if len(args.group_by) > 0:
+        df = df.groupby(args.group_by).mean(numeric_only=True).reset_index().sort_values('total_time', ascending=False)
+    print(df.to_string(index=False, float_format='{:.2f}'.format))
+    if len(outliers) > 0:
+        print("Runs slower than {}x the median startup ({:.1f}s) : {}".format(
+            args.outlier_factor, median, ', '.join(outliers)))
+    if len(args.output) > 0:
+        df.to_csv(args.output, index=False)
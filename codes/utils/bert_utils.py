@@ -1,16 +1,77 @@
 # Run BERT-as-a-service on all data, and store them for later processing
 
 import hashlib
+import json
+import numpy as np
 import torch
-from bert_serving.client import BertClient
+import torch.nn.functional as F
 import os
+import glob
 import logging
-from sacremoses import MosesDetokenizer
 import pdb
 
+# separator used to hash token tuples, not present in any token
+TOKEN_SEP = '\x1f'
+# number of position embeddings of bert-base-uncased
+BERT_MAX_LENGTH = 512
+
+
+def get_window_stride(model_config):
+    '''Stride of the windows over the stories longer than BERT_MAX_LENGTH, 0 to truncate them'''
+    if model_config.bert.truncate_long_stories:
+        return 0
+    stride = model_config.bert.window_stride
+    if not stride:
+        stride = BERT_MAX_LENGTH // 2
+    return stride
+
+
+def windowed_bert(model, inp, segment_ids, input_mask, stride=256, max_length=BERT_MAX_LENGTH):
+    '''
+    Run BERT on sequences which may be longer than its position embeddings.
+    With stride > 0, the sequence is cut in overlapping windows of `max_length` tokens, `stride` apart,
+    which are encoded together, and the outputs of the positions covered by several windows are averaged.
+    With stride <= 0, the sequence is truncated and the outputs past `max_length` are zero.
+    :param model: BertModel
+    :param inp: B x L
+    :return: B x L x hidden
+    '''
+    B, seq_len = inp.size()
+    if seq_len <= max_length:
+        out, _ = model(inp, segment_ids, input_mask, output_all_encoded_layers=False)
+        return out
+    if stride <= 0:
+        out, _ = model(inp[:, :max_length], segment_ids[:, :max_length], input_mask[:, :max_length],
+                       output_all_encoded_layers=False)
+        return F.pad(out, (0, 0, 0, seq_len - max_length))
+    stride = min(stride, max_length)
+    starts = list(range(0, seq_len - max_length, stride)) + [seq_len - max_length]
+    windows = lambda x: torch.cat([x[:, start:start + max_length] for start in starts], dim=0)
+    w_out, _ = model(windows(inp), windows(segment_ids), windows(input_mask), output_all_encoded_layers=False)
+    w_out = w_out.view(len(starts), B, max_length, -1)
+    out = w_out.new_zeros(B, seq_len, w_out.size(-1))
+    counts = w_out.new_zeros(1, seq_len, 1)
+    for w, start in enumerate(starts):
+        out[:, start:start + max_length] += w_out[w]
+        counts[:, start:start + max_length] += 1
+    return out / counts
+
+
+def get_bert_cache(config, device='cpu'):
+    '''
+    Return the sentence cache backend set in `config.model.bert.cache_backend`:
+        - local (default): run the in-process pytorch_pretrained_bert model
+        - service: query a running bert-as-a-service server
+    '''
+    if config.model.bert.cache_backend == 'service':
+        return BertLocalCache(config)
+    return BertInProcessCache(config, device=device)
+
+
 class BertLocalCache():
     '''Class to provide a local client for interfacing with BERT'''
     def __init__(self, config):
+        from bert_serving.client import BertClient
         self.hash_to_idx_map = {}
         self.embeddings = []
         self.model_config = config.model
@@ -22,6 +83,7 @@ class BertLocalCache():
 
     def hash_fn(self, string_to_hash):
         '''Simple hash function'''
+        from sacremoses import MosesDetokenizer
         md = MosesDetokenizer()
         if type(string_to_hash) == list:
             string_to_hash = md.detokenize(string_to_hash)
@@ -33,8 +95,7 @@ class BertLocalCache():
             self.hash_to_idx_map[sentence_hash] = len(self.sentences)
             self.sentences.append(sentence)
 
-    def run_bert(self):
-        pdb.set_trace()
+    def run_bert(self, path=None):
         embedding = self.query_bert(self.sentences)
         self.embeddings = embedding
 
@@ -66,3 +127,297 @@ class BertLocalCache():
                 embedding_idx = self.hash_to_idx_map[sentence_hash]
                 embeddings[idx] = self.embeddings[embedding_idx].unsqueeze(0)
             return torch.cat(embeddings, dim=0)
+
+
+class BertInProcessCache():
+    '''
+    Drop-in replacement of BertLocalCache which runs the pytorch_pretrained_bert model in process,
+    so no bert-as-a-service server (or network, once the weights are downloaded) is needed.
+    Sentences are hashed on their token tuples, embedded in length sorted micro-batches, and the
+    results are persisted incrementally so that an interrupted run resumes where it stopped.
+    '''
+    def __init__(self, config, device='cpu'):
+        self.hash_to_idx_map = {}
+        self.embeddings = []
+        self.model_config = config.model
+        self.sentences = []
+        self.device = device
+        self.batch_size = self.model_config.bert.cache_batch_size
+        if not self.batch_size:
+            self.batch_size = 64
+        # persist a shard every `checkpoint_every` micro-batches
+        self.checkpoint_every = self.model_config.bert.cache_checkpoint_every
+        if not self.checkpoint_every:
+            self.checkpoint_every = 50
+        self.tokenizer = None
+        self.model = None
+
+    # part of the hashes, so that the embeddings of an older tokenization are not reused
+    version = 'wordpiece-mean'
+
+    def hash_fn(self, tokens):
+        '''Hash the token tuple directly, no detokenization'''
+        if type(tokens) != str:
+            tokens = TOKEN_SEP.join(tokens)
+        return hashlib.sha224((self.version + TOKEN_SEP + tokens).encode('utf-8')).hexdigest()
+
+    def update_cache(self, list_of_sentences):
+        for idx, sentence in enumerate(list_of_sentences):
+            sentence_hash = self.hash_fn(sentence)
+            if sentence_hash in self.hash_to_idx_map:
+                continue
+            self.hash_to_idx_map[sentence_hash] = len(self.sentences)
+            self.sentences.append(sentence)
+
+    def _load_model(self):
+        if self.model is None:
+            from pytorch_pretrained_bert import BertModel
+            from pytorch_pretrained_bert.tokenization import BertTokenizer
+            self.tokenizer = BertTokenizer.from_pretrained('bert-base-uncased', do_lower_case=True)
+            self.model = BertModel.from_pretrained('bert-base-uncased').to(self.device)
+            self.model.eval()
+
+    def _token_ids(self, sentence):
+        '''
+        WordPiece tokenize each token of the sentence, as bert-as-a-service does, and wrap the pieces
+        in [CLS] ... [SEP]
+        :return: list of piece ids, list of (start, end) piece positions of each token of the sentence
+        '''
+        tokens = list(sentence)
+        # a sentence already wrapped has no output for [CLS] and [SEP]
+        if len(tokens) > 0 and tokens[0] == '[CLS]':
+            tokens = tokens[1:]
+        if len(tokens) > 0 and tokens[-1] == '[SEP]':
+            tokens = tokens[:-1]
+        pieces = ['[CLS]']
+        spans = []
+        for token in tokens:
+            token_pieces = self.tokenizer.tokenize(token)
+            if len(token_pieces) == 0:
+                token_pieces = ['[UNK]']
+            spans.append((len(pieces), len(pieces) + len(token_pieces)))
+            pieces.extend(token_pieces)
+        pieces.append('[SEP]')
+        return self.tokenizer.convert_tokens_to_ids(pieces), spans
+
+    def _pool_pieces(self, piece_outputs, spans):
+        '''
+        Mean of the outputs of the pieces of each token, so that there is exactly one output per input token
+        :param piece_outputs: num_pieces x 768
+        :return: num_tokens x 768
+        '''
+        if len(spans) == 0:
+            return piece_outputs.new_zeros(0, piece_outputs.size(-1))
+        return torch.stack([piece_outputs[start:end].mean(0) for start, end in spans])
+
+    def _partial_dir(self, path):
+        return os.path.join(path, '{}.partial'.format(self.model_config.bert.embedding_file))
+
+    def _load_partial(self, path):
+        '''Load the shards persisted by an earlier, interrupted run'''
+        done = {}
+        for shard_file in sorted(glob.glob(os.path.join(self._partial_dir(path), 'shard_*.pt'))):
+            shard = torch.load(shard_file)
+            for sentence_hash, embedding in zip(shard['hashes'], shard['embeddings']):
+                done[sentence_hash] = embedding
+        return done
+
+    def _save_shard(self, path, hashes, embeddings):
+        partial_dir = self._partial_dir(path)
+        if not os.path.exists(partial_dir):
+            os.makedirs(partial_dir)
+        shard_id = len(glob.glob(os.path.join(partial_dir, 'shard_*.pt')))
+        shard_file = os.path.join(partial_dir, 'shard_{:06d}.pt'.format(shard_id))
+        # write then rename, so a crash never leaves a half written shard behind
+        torch.save({'hashes': hashes, 'embeddings': embeddings}, shard_file + '.tmp')
+        os.rename(shard_file + '.tmp', shard_file)
+
+    def run_bert(self, path=None):
+        '''
+        Embed all the sentences added with `update_cache`
+        :param path: if given, persist the progress in this folder and resume from it
+        '''
+        done = self._load_partial(path) if path else {}
+        hashes = [self.hash_fn(sentence) for sentence in self.sentences]
+        pending = [i for i, h in enumerate(hashes) if h not in done]
+        logging.info("BERT cache: {} sentences, {} already embedded".format(len(self.sentences),
+                                                                           len(self.sentences) - len(pending)))
+        if len(pending) > 0:
+            self._load_model()
+        pending.sort(key=lambda i: len(self.sentences[i]))
+        shard_hashes, shard_embeddings = [], []
+        with torch.no_grad():
+            for num_batch, start in enumerate(range(0, len(pending), self.batch_size)):
+                micro_batch = pending[start:start + self.batch_size]
+                token_ids, spans = zip(*[self._token_ids(self.sentences[i]) for i in micro_batch])
+                lengths = [len(t) for t in token_ids]
+                inp = torch.zeros(len(micro_batch), max(lengths)).long()
+                input_mask = torch.zeros(len(micro_batch), max(lengths)).long()
+                for j, ids in enumerate(token_ids):
+                    inp[j, :lengths[j]] = torch.LongTensor(ids)
+                    input_mask[j, :lengths[j]] = 1
+                out, _ = self.model(inp.to(self.device), torch.zeros_like(inp).to(self.device),
+                                    input_mask.to(self.device), output_all_encoded_layers=False)
+                out = out.cpu()
+                for j, i in enumerate(micro_batch):
+                    # CLS in the beginning and SEP at the end are not part of any token
+                    embedding = self._pool_pieces(out[j], spans[j])
+                    done[hashes[i]] = embedding
+                    shard_hashes.append(hashes[i])
+                    shard_embeddings.append(embedding)
+                if path and (num_batch + 1) % self.checkpoint_every == 0:
+                    self._save_shard(path, shard_hashes, shard_embeddings)
+                    shard_hashes, shard_embeddings = [], []
+        if path and len(shard_hashes) > 0:
+            self._save_shard(path, shard_hashes, shard_embeddings)
+        self.embeddings = [done[h] for h in hashes]
+
+    def save_cache(self, path):
+        torch.save({'embeddings': self.embeddings, 'hashmap': self.hash_to_idx_map},
+                   os.path.join(path, self.model_config.bert.embedding_file))
+        # the full cache is saved, the partial shards are no longer needed
+        for shard_file in glob.glob(os.path.join(self._partial_dir(path), 'shard_*.pt')):
+            os.remove(shard_file)
+
+    def is_cache_present(self, path):
+        return os.path.exists(os.path.join(path, self.model_config.bert.embedding_file))
+
+    def load_cache(self, path):
+        cache = torch.load(os.path.join(path, self.model_config.bert.embedding_file))
+        self.embeddings = cache['embeddings']
+        self.hash_to_idx_map = cache['hashmap']
+
+    def query(self, list_of_sentences):
+        '''
+        :return: num_sentences x max_length x 768, zero padded
+        '''
+        embeddings = [self.embeddings[self.hash_to_idx_map[self.hash_fn(sentence)]]
+                      for sentence in list_of_sentences]
+        max_length = max([e.size(0) for e in embeddings])
+        out = torch.zeros(len(embeddings), max_length, embeddings[0].size(-1))
+        for idx, embedding in enumerate(embeddings):
+            out[idx, :embedding.size(0)] = embedding
+        return out
+
+
+class BertFeatureStore():
+    '''
+    Memory-mapped float16 store of the last layer outputs of the frozen BERT, keyed by story id and
+    digest of the story tokens.
+    The BERT encoders are kept in eval mode under no_grad, so their outputs are a pure function of
+    the story tokens and can be computed once for all the epochs.
+    '''
+    def __init__(self, config):
+        self.model_config = config.model
+        self.store_name = self.model_config.bert.feature_store
+        self.hidden_size = 768
+        self.batch_size = self.model_config.bert.feature_batch_size
+        if not self.batch_size:
+            self.batch_size = 32
+        self.window_stride = get_window_stride(self.model_config)
+        # key of the story -> [offset, length]
+        self.index = {}
+        self.features = None
+
+    def _paths(self, path):
+        return os.path.join(path, '{}.npy'.format(self.store_name)), \
+               os.path.join(path, '{}.json'.format(self.store_name))
+
+    def digest(self, token_ids):
+        '''The entity placeholders are assigned per run, so check the tokens and not just the id'''
+        return hashlib.sha224(','.join([str(t) for t in token_ids]).encode('utf-8')).hexdigest()
+
+    def key(self, row_id, token_ids):
+        '''The same id can be used in two files with different stories, so the key holds both'''
+        return '{}:{}'.format(row_id, self.digest(token_ids))
+
+    def is_store_present(self, path):
+        feature_file, index_file = self._paths(path)
+        return os.path.exists(feature_file) and os.path.exists(index_file)
+
+    def is_valid_for(self, dataRows):
+        return all(self.key(dataRow.id, dataRow.pattrs[0]) in self.index for dataRow in dataRows)
+
+    def build_store(self, path, dataRows, device='cpu'):
+        '''
+        Run the frozen BERT once over all the unique stories
+        :param path: folder to save the store in
+        :param dataRows: list of DataRow, with pattrs prepared
+        :param device:
+        '''
+        from pytorch_pretrained_bert import BertModel
+        unique_rows = {}
+        for dataRow in dataRows:
+            key = self.key(dataRow.id, dataRow.pattrs[0])
+            if key not in unique_rows:
+                unique_rows[key] = dataRow
+        # sort by length so that micro-batches have little padding
+        keys = sorted(unique_rows.keys(), key=lambda k: len(unique_rows[k].pattrs[0]))
+        index = {}
+        offset = 0
+        for key in keys:
+            length = len(unique_rows[key].pattrs[0])
+            index[key] = [offset, length]
+            offset += length
+        logging.info("Extracting BERT features for {} stories, {} tokens".format(len(keys), offset))
+        feature_file, index_file = self._paths(path)
+        features = np.lib.format.open_memmap(feature_file, mode='w+', dtype=np.float16,
+                                             shape=(offset, self.hidden_size))
+        model = BertModel.from_pretrained('bert-base-uncased').to(device)
+        model.eval()
+        with torch.no_grad():
+            for i in range(0, len(keys), self.batch_size):
+                micro_keys = keys[i:i + self.batch_size]
+                micro_batch = [unique_rows[key] for key in micro_keys]
+                lengths = [len(r.pattrs[0]) for r in micro_batch]
+                inp = torch.zeros(len(micro_batch), max(lengths)).long()
+                input_mask = torch.zeros(len(micro_batch), max(lengths)).long()
+                segment_ids = torch.zeros(len(micro_batch), max(lengths)).long()
+                for j, dataRow in enumerate(micro_batch):
+                    inp[j, :lengths[j]] = torch.LongTensor(dataRow.pattrs[0])
+                    input_mask[j, :lengths[j]] = torch.LongTensor(dataRow.bert_input_mask)
+                    segment_ids[j, :lengths[j]] = torch.LongTensor(dataRow.bert_segment_ids)
+                out = windowed_bert(model, inp.to(device), segment_ids.to(device), input_mask.to(device),
+                                    stride=self.window_stride).cpu().numpy().astype(np.float16)
+                for j, key in enumerate(micro_keys):
+                    start = index[key][0]
+                    features[start:start + lengths[j]] = out[j, :lengths[j]]
+        features.flush()
+        del features
+        with open(index_file, 'w') as fp:
+            json.dump(index, fp)
+        logging.info("Saved BERT features at {}".format(feature_file))
+
+    def load_store(self, path):
+        feature_file, index_file = self._paths(path)
+        self.features = np.load(feature_file, mmap_mode='r')
+        with open(index_file) as fp:
+            self.index = json.load(fp)
+
+    def batch_keys(self, batch):
+        '''
+        Keys of the stories of the batch, computed once as the batches are reused over the epochs
+        '''
+        if batch.feature_keys is None:
+            inp = batch.inp.cpu().tolist()
+            batch.feature_keys = [self.key(row_id, inp[i][:batch.inp_lengths[i]])
+                                  for i, row_id in enumerate(batch.row_ids)]
+        return batch.feature_keys
+
+    def lookup(self, batch, device):
+        '''
+        :param batch: Batch, whose stories are found by row id and tokens
+        :return: B x max_len x hidden_size float tensor, zero over the padding and for the stories which
+            are not in the store (eg the requests of the inference server), list of the positions of these
+        '''
+        max_len = batch.inp.size(1)
+        keys = self.batch_keys(batch)
+        out = np.zeros((len(keys), max_len, self.hidden_size), dtype=np.float16)
+        missing = []
+        for i, key in enumerate(keys):
+            if key not in self.index:
+                missing.append(i)
+                continue
+            offset, length = self.index[key]
+            out[i, :length] = self.features[offset:offset + length]
+        return torch.from_numpy(out).to(device).float(), missing
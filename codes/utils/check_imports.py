@@ -0,0 +1,53 @@
+# Import time check of the experiment modules : each module is imported in a fresh interpreter, which must not
+# load the heavy dependencies and must stay within the time budget.
+# Run from the repository root : python -m codes.utils.check_imports [--budget 5.0]
+import argparse
+import json
+import subprocess
+import sys
+
+# modules imported by the CLIs, and the dependencies they must not load at import time
+MODULES = ['codes.experiment.experiment', 'codes.utils.data', 'codes.net.trainer', 'codes.metric.quality_metric',
+           'codes.utils.log']
+HEAVY_MODULES = ['comet_ml', 'torch_geometric', 'pytorch_pretrained_bert', 'nltk', 'pandas', 'bert_serving',
+                 'sacremoses', 'matplotlib']
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{'time': elapsed, 'modules': sorted(sys.modules)}}))
+"""
+
+
+def import_report(module):
+    """
+    Import the module in a new interpreter
+    :return: import time (s), list of the heavy modules it loaded
+    """
+    outp = subprocess.run([sys.executable, '-c', PROBE.format(module=module)], stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE, universal_newlines=True)
+    if outp.returncode != 0:
+        raise RuntimeError("Cannot import {} : {}".format(module, outp.stderr.strip().split('\n')[-1]))
+    report = json.loads(outp.stdout.strip().split('\n')[-1])
+    loaded = [heavy for heavy in HEAVY_MODULES if heavy in report['modules']]
+    return report['time'], loaded
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Check the import time of the experiment modules")
+    parser.add_argument('--budget', type=float, default=5.0, help='max import time of a module, in seconds')
+    args = parser.parse_args()
+    failures = []
+    for module in MODULES:
+        elapsed, loaded = import_report(module)
+        print("{:<35} {:>8.3f}s  heavy imports : {}".format(module, elapsed, ', '.join(loaded) if loaded else '-'))
+        if loaded:
+            failures.append("{} imports {}".format(module, ', '.join(loaded)))
+        if elapsed > args.budget:
+            failures.append("{} takes {:.3f}s to import, over the budget of {}s".format(module, elapsed, args.budget))
+    if failures:
+        print('\n'.join(failures))
+        sys.exit(1)
+    print("All imports are lazy and within budget")
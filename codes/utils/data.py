@@ -2,27 +2,22 @@
 import torch
 import torch.utils.data as data
 import re
-import pandas as pd
 import json
 import numpy as np
-from nltk.tokenize import word_tokenize, sent_tokenize
 from collections import Counter
+from contextlib import contextmanager
 import pickle as pkl
 import itertools as it
 from addict import Dict
-from codes.net.batch import Batch
+from codes.net.batch import Batch, LengthPermutation
 from codes.utils.config import get_config
 import os
 import json
 from ast import literal_eval as make_tuple
-from torch_geometric.data import Data as GeometricData
-from torch_geometric.data import Batch as GeometricBatch
 import random
 from itertools import repeat, product
 from typing import List
-from codes.utils.bert_utils import BertLocalCache
-from pytorch_pretrained_bert.tokenization import BertTokenizer
-from tqdm import tqdm
+from codes.utils.bert_utils import BertLocalCache, BertFeatureStore
 import pdb
 import logging
 logging.basicConfig(
@@ -39,6 +34,16 @@ END_TOKEN = '</s>'
 CLS_TOKEN = "[CLS]"
 SEP_TOKEN = "[SEP]"
 
+
+# The heavy dependencies are imported when first used: pandas and nltk when processing data files,
+# pytorch_pretrained_bert with `dataset.process_bert`, torch_geometric for the graph models only.
+def _geometric():
+    """
+    :return: torch_geometric Data and Batch classes
+    """
+    from torch_geometric.data import Data, Batch
+    return Data, Batch
+
 class DataRow():
     """
     Defines a single instance of data row
@@ -58,6 +63,9 @@ class DataRow():
         self.query_edge = None
         # processed attributes
         self.pattrs = []
+        # BERT inputs of the story, also in pattrs, read by the BertFeatureStore
+        self.bert_input_mask = None
+        self.bert_segment_ids = None
 
 
 class DataUtility():
@@ -90,7 +98,12 @@ class DataUtility():
         self.single_abs_line = config.dataset.single_abs_line
         self.num_entity_block = config.model.num_entity_block  # number of entity vectors we want to block off
         self.process_bert = config.dataset.process_bert
+        # order of the token budget batches of the training split
+        self.batch_rng = random.Random(config.general.seed)
+        # the batches of the graph models carry the torch_geometric graphs
+        self.graph_mode = config.model.name == 'graph'
         if self.process_bert:
+            from pytorch_pretrained_bert.tokenization import BertTokenizer
             self.bert_tokenizer = BertTokenizer.from_pretrained('bert-base-uncased', do_lower_case=True)
 
         self.word2id = {}
@@ -140,6 +153,7 @@ class DataUtility():
         :param main_file .csv file of the data
         :return:
         """
+        import pandas as pd
         self.train_file = train_file
         train_data = pd.read_csv(self.train_file, comment='#')
         train_data = self._check_data(train_data)
@@ -167,6 +181,7 @@ class DataUtility():
         :param test_files: array of file names
         :return:
         """
+        import pandas as pd
         self.test_files = test_files #[os.path.join(base_path, t) + '_test.csv' for t in test_files]
         test_datas = [pd.read_csv(tf, comment='#') for tf in self.test_files]
         for test_data in test_datas:
@@ -182,6 +197,66 @@ class DataUtility():
         logging.info("Done preprocessing test data")
 
 
+    def process_stories(self, records, key='stories'):
+        """
+        Preprocess stories which are not in a data file, eg the requests of the inference server,
+        with the tokenization and entity anonymization of the test files. The flags, dictionaries and
+        max lengths of the training data are left as they are
+        :param records: list of dicts with at least `id`, `story` and `query`, the query as a
+        string tuple of entities, eg "('Ann', 'Bob')". The other columns default to empty values.
+        :param key: name under which the rows are kept in `dataRows['test']` while processing
+        :return: list of DataRow, ready for `precompute_batches`
+        """
+        import pandas as pd
+        data = pd.DataFrame(records)
+        # placeholder target, only used to build the batch
+        placeholder = next(iter(self.target_word2id))
+        defaults = {'target': placeholder, 'text_target': '', 'text_query': '',
+                    'story_edges': '[]', 'edge_types': '[]', 'query_edge': '()'}
+        for column, value in defaults.items():
+            if column not in data.columns:
+                data[column] = value
+            else:
+                data[column] = data[column].fillna(value)
+        # the targets unseen in training are not added to the classes
+        data['target'] = data['target'].where(data['target'].isin(list(self.target_word2id)), placeholder)
+        # no _check_data: the columns are read with the flags of the training data
+        with self._training_state():
+            data, _ = self.process_entities(data)
+            self.preprocess(data, mode='test', test_file=key)
+            dataRows = list(self.dataRows['test'].pop(key).values())
+            # these rows are not kept
+            for dataRow in dataRows:
+                self.entity_map.pop(dataRow.id, None)
+                self.preprocessed.discard(dataRow.id)
+        return self.prepare_for_dataloader(dataRows)
+
+    @contextmanager
+    def _training_state(self):
+        """
+        Restore the max lengths, entity block and dictionaries of the training data after the
+        preprocessing of stories which are not in a data file
+        """
+        saved = {'max_word_length': self.max_word_length, 'num_entity_block': self.num_entity_block,
+                 'target_word2id': dict(self.target_word2id), 'target_id2word': dict(self.target_id2word),
+                 'unique_nodes': set(self.unique_nodes), 'unique_edge_dict': dict(self.unique_edge_dict)}
+        try:
+            yield
+        finally:
+            for name, value in saved.items():
+                setattr(self, name, value)
+
+    def check_story(self, record):
+        """
+        Check that a story which is not in a data file can be run by the model
+        :param record: dict with `story`, as for `process_stories`
+        :raise ValueError: if the story has more entities than the model has entity embeddings
+        """
+        num_entities = len(set(re.findall('\\[(.*?)\\]', record['story'])))
+        if num_entities > len(self.entity_ids):
+            raise ValueError("The story has {} entities, the model supports at most {}".format(
+                num_entities, len(self.entity_ids)))
+
     def _check_data(self, data):
         """
         Check if the file has correct headers.
@@ -220,6 +295,16 @@ class DataUtility():
             self.data_has_raw_graph = True
         return data
 
+    def _entity_rng(self, pid):
+        """
+        Random generator of the entity anonymization of a story. With a BERT feature store, the
+        anonymization is seeded by the story id, so that the stored features of a story stay valid
+        from one run to the next
+        """
+        if self.config.model.bert.feature_store:
+            return random.Random('{}:{}'.format(self.config.general.seed, pid))
+        return random
+
     def process_entities(self, data, placeholder='[]'):
         """
         extract entities and replace them with placeholders.
@@ -233,9 +318,11 @@ class DataUtility():
             for i,row in data.iterrows():
                 story = row['story']
                 ents = re.findall('\[(.*?)\]', story)
-                uniq_ents = set(ents)
-                uniq_ents = random.sample(list(uniq_ents), len(uniq_ents))
                 pid = row['id']
+                rng = self._entity_rng(pid)
+                # sorted, as the order of a set of strings changes with the hash seed of the process
+                uniq_ents = sorted(set(ents))
+                uniq_ents = rng.sample(uniq_ents, len(uniq_ents))
                 query = row['query'] if self.data_has_query else ''
                 query = list(make_tuple(query))
                 text_query = row['text_query'] if self.data_has_text_query else ''
@@ -243,7 +330,7 @@ class DataUtility():
                 entity_map = {}
                 entity_id_block = list(range(0, len(uniq_ents)))
                 for idx, ent in enumerate(uniq_ents):
-                    entity_id = random.choice(entity_id_block)
+                    entity_id = rng.choice(entity_id_block)
                     entity_id_block.remove(entity_id)
                     if self.process_bert:
                         # if bert, then replace the entities with pure numbers, as otherwise we would not
@@ -284,6 +371,7 @@ class DataUtility():
         :return:
         """
 
+        from nltk.tokenize import sent_tokenize
         words = Counter()
         max_sent_length = 0
         max_word_length = 0
@@ -381,6 +469,7 @@ class DataUtility():
         """
         words = []
         if self.tokenization == 'word':
+            from nltk.tokenize import word_tokenize
             words = word_tokenize(sent)
         if self.tokenization == 'char':
             words = sent.split('')
@@ -620,7 +709,9 @@ class DataUtility():
             num_nodes = [len(nodes)]
             dataRow.pattrs = [inp_row, s_inp_row, inp_ents, query, text_query, query_mask, target, text_target,
                sent_lengths, inp_ent_mask, geo_data, query_edge, num_nodes, sentence_pointer, orig_inp, orig_inp_sent, bert_inp,
-                              inp_row_pos, bert_input_mask, bert_segment_ids]
+                              inp_row_pos, bert_input_mask, bert_segment_ids, dataRow.id]
+            dataRow.bert_input_mask = bert_input_mask
+            dataRow.bert_segment_ids = bert_segment_ids
         return dataRows
 
 
@@ -657,21 +748,79 @@ class DataUtility():
                                collate_fn=collate_FN)
                                
         """
-        batches = self.precompute_batches(dataRows)
+        batches = self.precompute_batches(dataRows, shuffle=mode == 'train')
 
         return data.DataLoader(PreComputedDataLoader(batches),batch_size=1, collate_fn=pre_collate_fn)
 
 
-    def precompute_batches(self, dataRows:List[DataRow]):
+    def get_merged_test_dataloader(self, test_files, batch_size=None):
+        """
+        Single stream over the rows of all the test files, each row tagged with the index of its file
+        in `test_files`, to evaluate all of them in one pass with large batches
+        :param test_files: list of test file names
+        :param batch_size: inference batch size, defaults to `model.batch_size`
+        :return: DataLoader of precomputed batches with `file_ids`
+        """
+        dataRows = []
+        file_ids = []
+        for file_id, test_file in enumerate(test_files):
+            rows = [v for k, v in self.dataRows['test'][test_file].items()]
+            dataRows.extend(rows)
+            file_ids.extend([file_id] * len(rows))
+        logging.info("Total merged test rows : {} from {} files".format(len(dataRows), len(test_files)))
+        dataRows = self.prepare_for_dataloader(dataRows)
+        batches = self.precompute_batches(dataRows, batch_size=batch_size, file_ids=file_ids)
+        return data.DataLoader(PreComputedDataLoader(batches), batch_size=1, collate_fn=pre_collate_fn)
+
+    def batch_indices(self, dataRows:List[DataRow], batch_size=None, shuffle=False):
+        """
+        Group the rows into batches.
+        With BERT and `bert.max_tokens` set, the rows are sorted by token length and each batch holds
+        as many rows as fit in the token budget, counted on the padded length. Otherwise, fixed size
+        batches of `model.batch_size` consecutive rows.
+        :param dataRows:
+        :param shuffle: if True, shuffle the token budget batches, so that they are not fed in length order.
+            Only for the training split, with a generator of its own so that the global random state
+            (eg the entity anonymization) does not depend on it
+        :return: list of list of row indices
+        """
+        if not batch_size:
+            batch_size = self.config.model.batch_size
+        max_tokens = self.config.model.bert.max_tokens
+        if not (self.process_bert and max_tokens):
+            return [list(range(i, min(i + batch_size, len(dataRows)))) for i in range(0, len(dataRows), batch_size)]
+        order = sorted(range(len(dataRows)), key=lambda i: len(dataRows[i].pattrs[0]), reverse=True)
+        groups = []
+        group = []
+        for idx in order:
+            # sorted longest first, so the first row of the group sets the padded length
+            if len(group) > 0 and (len(group) + 1) * len(dataRows[group[0]].pattrs[0]) > max_tokens:
+                groups.append(group)
+                group = []
+            group.append(idx)
+        if len(group) > 0:
+            groups.append(group)
+        if shuffle:
+            # do not feed the batches in length order
+            self.batch_rng.shuffle(groups)
+        return groups
+
+    def precompute_batches(self, dataRows:List[DataRow], batch_size=None, file_ids=None, shuffle=False):
+        """
+        :param dataRows:
+        :param batch_size: defaults to `model.batch_size`
+        :param file_ids: optional file index of each row, kept in the batches as `file_ids`
+        :param shuffle: shuffle the token budget batches, see `batch_indices`
+        :return: list of Batch
+        """
         print("precomputing batches...")
-        batch_size = self.config.model.batch_size
         batches = []
-        for i in range(0, len(dataRows), batch_size):
-            data = [dataRows[i].pattrs for i in range(i, i+batch_size) if i < len(dataRows)]
-            data.sort(key=lambda x: len(x[0]), reverse=True)
+        for indices in self.batch_indices(dataRows, batch_size=batch_size, shuffle=shuffle):
+            indices = sorted(indices, key=lambda i: len(dataRows[i].pattrs[0]), reverse=True)
+            data = [dataRows[i].pattrs for i in indices]
             inp_data, s_inp_data, inp_ents, query, text_query, query_mask, target, text_target, \
             sent_lengths, inp_ent_mask, geo_data, query_edge, num_nodes, \
-            sentence_pointer, orig_inp, orig_inp_sent, bert_inp, _, bert_input_mask, bert_segment_ids = zip(
+            sentence_pointer, orig_inp, orig_inp_sent, bert_inp, _, bert_input_mask, bert_segment_ids, row_ids = zip(
                 *data)
             inp_data, inp_lengths = simple_merge(inp_data)
             s_inp_data, sent_lengths = sent_merge(s_inp_data, sent_lengths)
@@ -687,10 +836,13 @@ class DataUtility():
             # geo_data_col, geo_data_slices = collate_geometric(geo_data)
             slices = [p for n in num_nodes for p in n]
             max_node = max(slices)
-            # add extra node to all graphs in order to have padding
-            geo_data = [GeometricData(x=torch.arange(max_node).unsqueeze(1), edge_index=gd['edge_index'],
-                                      edge_attr=gd['edge_attr'], y=gd['y']) for gd in geo_data]
-            geo_batch = GeometricBatch.from_data_list(geo_data)
+            geo_batch = None
+            if self.graph_mode:
+                GeometricData, GeometricBatch = _geometric()
+                # add extra node to all graphs in order to have padding
+                geo_data = [GeometricData(x=torch.arange(max_node).unsqueeze(1), edge_index=gd['edge_index'],
+                                          edge_attr=gd['edge_attr'], y=gd['y']) for gd in geo_data]
+                geo_batch = GeometricBatch.from_data_list(geo_data)
             # update the slices - same number of nodes
             slices = [max_node for s in slices]
             query_edge = torch.LongTensor(query_edge)
@@ -717,17 +869,22 @@ class DataUtility():
                 query_edge=query_edge,
                 geo_slices=slices,
                 bert_segment_ids=bert_segment_ids,
-                bert_input_mask=bert_input_mask
+                bert_input_mask=bert_input_mask,
+                row_ids=row_ids,
+                inp_perm=LengthPermutation(inp_lengths),
+                sent_perm=LengthPermutation([s for sl in sent_lengths for s in sl]),
+                file_ids=torch.LongTensor([file_ids[i] for i in indices]) if file_ids is not None else None
             )
             #batch.to_device('cuda')
             batches.append(batch)
         print("done precomputing batches {}".format(len(batches)))
         return batches
 
-    def update_bert_cache(self, bert_cache:BertLocalCache):
+    def update_bert_cache(self, bert_cache:BertLocalCache, path=None):
         """
         Preload all sentences from BERT
-        :param bert_cache:
+        :param bert_cache: BertLocalCache or BertInProcessCache
+        :param path: if given, the in-process cache persists its progress there and resumes from it
         :return:
         """
         logging.info("Bert caching train rows .. ")
@@ -737,7 +894,27 @@ class DataUtility():
         for flname, dataRows in self.dataRows['test'].items():
             for idx, dataRow in dataRows.items():
                 bert_cache.update_cache(dataRow.story_sents)
-        bert_cache.run_bert()
+        bert_cache.run_bert(path)
+
+    def update_bert_feature_store(self, feature_store:BertFeatureStore, path, device='cpu'):
+        """
+        Make sure the frozen BERT features of every story are in the store, then load it.
+        Run after the dataloaders are created, as it needs the prepared rows
+        :param feature_store:
+        :param path: folder of the store
+        :return:
+        """
+        dataRows = list(self.dataRows['train'].values())
+        for flname, rows in self.dataRows['test'].items():
+            dataRows.extend(rows.values())
+        if feature_store.is_store_present(path):
+            feature_store.load_store(path)
+            if feature_store.is_valid_for(dataRows):
+                logging.info("BERT features present at {}".format(path))
+                return
+            logging.info("Stored BERT features do not match the current stories, extracting again")
+        feature_store.build_store(path, dataRows, device)
+        feature_store.load_store(path)
 
 
     def map_text_to_id(self, text):
@@ -897,6 +1074,7 @@ def collate_fn(data):
     #geo_data_col, geo_data_slices = collate_geometric(geo_data)
     slices = [p for n in num_nodes for p in n]
     max_node = max(slices)
+    GeometricData, GeometricBatch = _geometric()
     # add extra node to all graphs in order to have padding
     geo_data = [GeometricData(x=torch.arange(max_node).unsqueeze(1), edge_index=gd['edge_index'], edge_attr=gd['edge_attr'], y=gd['y']) for gd in geo_data]
     geo_batch = GeometricBatch.from_data_list(geo_data)
@@ -1059,6 +1237,7 @@ def pad_sent_lengths(sent_lens):
 def collate_geometric(data_list):
     r"""Collates a python list of data objects to the internal storage
     format of :class:`torch_geometric.data.InMemoryDataset`."""
+    GeometricData, _ = _geometric()
     keys = data_list[0].keys
     data = GeometricData()
 
@@ -17,10 +17,17 @@ class Experiment:
         self.device = None
         self.validation_metrics = None
         self.quality_metrics = None
+        # confusion matrix (targets x predictions) of the last epoch of each mode
+        self.confusion_matrices = Dict()
         self.metric_to_perform_early_stopping = None
         self.generator = None
+        # AsyncEvaluator, with log.async_test
+        self.async_evaluator = None
         self.epoch_index = 0
         self.iteration_index = Dict()
+        # training throughput
+        self.train_examples = 0
+        self.train_time = 0.0
         self.config = config
         self.comet_exp = None
         self.model_save_path = os.path.join(config.general.base_path, 'model')
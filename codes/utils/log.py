@@ -2,7 +2,6 @@ import json
 
 import numpy as np
 from pathlib import Path
-import pandas as pd
 import os
 
 from codes.utils.config import get_config
@@ -182,6 +181,7 @@ def write_sequences(true_inp, true_outp, pred_outp, mode, epoch=0, exp_name='',
             os.remove(prev_filename)
         except OSError:
             pass
+    import pandas as pd
     confs = [','.join([str(ci) for ci in c]) for c in conf]
     classes = [classes for d in true_inp]
     df = pd.DataFrame({'true_inp':true_inp, 'true_outp':true_outp, 'pred_outp': pred_outp, 'conf': confs, 'target_class': classes})
@@ -0,0 +1,76 @@
+# Phase timing and memory of the experiment startup
+import json
+import os
+import sys
+from contextlib import contextmanager
+from time import perf_counter
+
+try:
+    import resource
+except ImportError:
+    # not available on windows
+    resource = None
+
+
+def peak_rss_mb():
+    """
+    Peak resident memory of the process so far, in MB (0 if unknown)
+    """
+    if resource is None:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KB on linux
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def current_rss_mb():
+    """
+    Current resident memory of the process, in MB (0 if unknown)
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        return 0.0
+
+
+class StartupProfiler:
+    """
+    Time and memory of the named phases of the startup, in the order they ran. The memory of a phase is the
+    change of the resident memory over the phase, and the peak memory of the process when the phase ended,
+    which also covers the phases before it
+    """
+    def __init__(self):
+        self.start = perf_counter()
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name):
+        rss = current_rss_mb()
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append({
+                'phase': name,
+                'time': perf_counter() - start,
+                'rss_delta_mb': current_rss_mb() - rss,
+                'process_peak_rss_mb': peak_rss_mb(),
+            })
+
+    def report(self, **info):
+        """
+        :param info: description of the run, eg config id and dataset
+        :return: dict with the phases, the total time since the profiler was created and the peak memory
+        """
+        report = dict(info)
+        report['phases'] = self.phases
+        report['total_time'] = perf_counter() - self.start
+        report['peak_rss_mb'] = peak_rss_mb()
+        return report
+
+    def save(self, path, **info):
+        report = self.report(**info)
+        with open(path, 'w') as fp:
+            json.dump(report, fp, indent=2)
+        return report